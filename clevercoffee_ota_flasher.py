@@ -1,59 +1,34 @@
 import datetime
 import os
+import queue
 import subprocess
 import sys
 import threading
+import time
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import tempfile
 from pathlib import Path
-import queue
-
-try:
-    import requests
-    HAS_REQUESTS = True
-except ImportError:
-    import urllib.request
-    from urllib.error import URLError
-    HAS_REQUESTS = False
-
-
-def get_espota_path() -> str:
-    if hasattr(sys, '_MEIPASS'):
-        base_path = sys._MEIPASS
-    else:
-        base_path = os.path.dirname(os.path.abspath(__file__))
-
-    return os.path.join(base_path, 'espota.py')
-
 
-def get_download_directory():
-    """Get a user-friendly download directory"""
-    # Try to use the user's Downloads folder first
-    home = Path.home()
+from ota_cancel import CancelToken, Cancelled
+from ota_credentials import CredentialStore
+import ota_daemon
+import ota_autotune
+import ota_dashboard
+import ota_delta
+import ota_dlbench
+import ota_engine
+import ota_fakedevice
+import ota_fleetsim
+import ota_history
+import ota_inventory
+import ota_littlefs
+import ota_mirror
+import ota_prepare
+import ota_routes
+import ota_trace
+import ota_watch
+from ota_paths import get_download_directory
 
-    # Common download folder locations by OS
-    download_locations = [
-        home / "Downloads",         # Most common
-        home / "Desktop",           # Fallback
-        home / "Documents",         # Another fallback
-        Path(tempfile.gettempdir()) # System temp as last resort
-    ]
-
-    # Find the first location that exists and is writable
-    for location in download_locations:
-        if location.exists() and location.is_dir():
-            try:
-                # Test if we can write to this directory
-                test_file = location / "test_write.tmp"
-                test_file.touch()
-                test_file.unlink()
-                return location / "CleverCoffee_Binaries"
-            except (PermissionError, OSError):
-                continue
-
-    # If all else fails, use temp directory
-    return Path(tempfile.mkdtemp(prefix="clevercoffee_"))
 
 class CleverCoffeeOtaFlasher:
     def __init__(self, root):
@@ -67,6 +42,9 @@ class CleverCoffeeOtaFlasher:
         self.upload_button = None
         self.cancel_button = None
         self.log_text = None
+        self.history_tree = None
+        self.history_query = None
+        self.dashboard = None
         self.download_button = None
         self.open_folder_button = None
         self.download_path_var = None
@@ -83,15 +61,34 @@ class CleverCoffeeOtaFlasher:
         self.esp_port = tk.StringVar(value="3232")          # Default OTA port
         self.esp_password = tk.StringVar(value="otapass")   # Default CleverCoffee OTA password
         self.download_path_var = tk.StringVar()
+        self.mirror_url = tk.StringVar(value=",".join(ota_mirror.get_mirrors()))  # LAN mirror, empty = GitHub only
+        self.rate_limit = tk.StringVar(value="0")           # KB/s, 0 = unlimited
+        self.host_status = tk.StringVar()                   # address the host resolved to
+        self.follow_daemon = tk.BooleanVar(value=False)     # Fleet tab shows the daemon's jobs
+        self.daemon_api = tk.StringVar(value=f"{ota_daemon.DEFAULT_API_HOST}:{ota_daemon.DEFAULT_API_PORT}")
+        self.history_host = tk.StringVar()                  # host of the throughput trend, empty = the upload's
 
         # Upload options
         self.upload_firmware = tk.BooleanVar(value=True)
         self.upload_filesystem = tk.BooleanVar(value=True)
+        self.auto_flash = tk.BooleanVar(value=False)        # Re-flash when the selected files change
+        self.skip_unchanged = tk.BooleanVar(value=False)    # Skip images the device already got last time
+        self.send_delta = tk.BooleanVar(value=False)        # Send firmware as a delta to the last image
 
         # Control variables
         self.upload_in_progress = False
-        self.current_process = None
+        self.cancel_token = None
+        self.current_job = None
         self.last_download_dir = None
+        self.watch_token = None
+        self.change_times = {}          # job id -> time the watched file changed
+
+        # Per-host OTA passwords (in memory, plus OS keyring when available)
+        self.credentials = CredentialStore()
+
+        # Uploads run on the same engine the daemon uses; its events are processed on the Tk thread
+        self.engine = ota_engine.UploadEngine(workers=1, credentials=self.credentials)
+        self.engine_events = self.engine.subscribe()
 
         # GitHub release info
         # TODO hardcoded for pre-release
@@ -103,6 +100,8 @@ class CleverCoffeeOtaFlasher:
         }
 
         self.setup_ui()
+        # Look the default host up while files are being picked
+        self.root.after(0, self.on_host_changed)
 
     def center_window(self):
         """Center the window on the screen"""
@@ -125,14 +124,28 @@ class CleverCoffeeOtaFlasher:
 
     def setup_ui(self):
         """Create and arrange all GUI elements"""
-        # Main container with padding
-        main_frame = ttk.Frame(self.root, padding="10")
-        main_frame.grid(row=0, column=0, sticky="nsew")
+        # Tabs for the upload workflow and the upload history
+        notebook = ttk.Notebook(self.root)
+        notebook.grid(row=0, column=0, sticky="nsew")
 
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
+
+        # Main container with padding
+        main_frame = ttk.Frame(notebook, padding="10")
+        notebook.add(main_frame, text="Upload")
         main_frame.columnconfigure(1, weight=1)
 
+        history_frame = ttk.Frame(notebook, padding="10")
+        notebook.add(history_frame, text="History")
+        self.setup_history_tab(history_frame)
+        notebook.bind("<<NotebookTabChanged>>",
+                      lambda event: self.refresh_history() if notebook.index("current") == 1 else None)
+
+        fleet_frame = ttk.Frame(notebook, padding="10")
+        notebook.add(fleet_frame, text="Fleet")
+        self.setup_fleet_tab(fleet_frame)
+
         # Download from GitHub section
         download_frame = ttk.LabelFrame(main_frame, text="Download from GitHub", padding="5")
         download_frame.grid(row=0, column=0, columnspan=3, sticky="ew", pady=(0, 10))
@@ -157,6 +170,10 @@ class CleverCoffeeOtaFlasher:
                                         state='readonly', font=("TkDefaultFont", 8))
         download_path_entry.grid(row=0, column=1, sticky="ew", padx=(5, 5))
 
+        ttk.Label(path_frame, text="LAN mirror:", font=("TkDefaultFont", 8)).grid(row=1, column=0, sticky="w")
+        ttk.Entry(path_frame, textvariable=self.mirror_url,
+                  font=("TkDefaultFont", 8)).grid(row=1, column=1, sticky="ew", padx=(5, 5), pady=(2, 0))
+
         # Buttons frame
         button_frame = ttk.Frame(download_frame)
         button_frame.grid(row=2, column=0, columnspan=3, sticky="ew", pady=(5, 0))
@@ -201,13 +218,32 @@ class CleverCoffeeOtaFlasher:
                                                 command=self.browse_filesystem, state='disabled')
         self.filesystem_browse_btn.grid(row=1, column=2, pady=5)
 
+        self.filesystem_build_btn = ttk.Button(files_frame, text="Build...",
+                                               command=self.build_filesystem, state='disabled')
+        self.filesystem_build_btn.grid(row=1, column=3, pady=5, padx=(5, 0))
+
+        # Watch mode for development builds
+        ttk.Checkbutton(files_frame, text="Flash automatically when the selected files change",
+                        variable=self.auto_flash,
+                        command=self.on_auto_flash_changed).grid(row=2, column=0, columnspan=4, sticky="w", pady=5)
+        ttk.Checkbutton(files_frame, text="Skip images already on the device",
+                        variable=self.skip_unchanged).grid(row=3, column=0, columnspan=4, sticky="w", pady=5)
+        ttk.Checkbutton(files_frame, text="Send only the changes to the firmware (needs delta support on the device)",
+                        variable=self.send_delta).grid(row=4, column=0, columnspan=4, sticky="w", pady=5)
+
         # Connection settings
         conn_frame = ttk.LabelFrame(main_frame, text="ESP32 OTA Connection", padding="5")
         conn_frame.grid(row=2, column=0, columnspan=3, sticky="ew", pady=(0, 10))
 
-        # ESP32 host/IP address
+        # ESP32 host/IP address, or a device from the inventory
         ttk.Label(conn_frame, text="IP Address:").grid(row=0, column=0, sticky="w", pady=5)
-        ttk.Entry(conn_frame, textvariable=self.esp_ip, width=20).grid(row=0, column=1, sticky="w", pady=5, padx=(5, 0))
+        self.host_combo = ttk.Combobox(conn_frame, textvariable=self.esp_ip, width=18,
+                                       values=[device.name for device in self.engine.inventory.devices()])
+        self.host_combo.grid(row=0, column=1, sticky="w", pady=5, padx=(5, 0))
+        self.host_combo.bind("<FocusOut>", self.on_host_changed)
+        self.host_combo.bind("<<ComboboxSelected>>", self.on_host_changed)
+        ttk.Label(conn_frame, textvariable=self.host_status,
+                  font=("TkDefaultFont", 8), foreground="gray").grid(row=0, column=2, sticky="w", pady=5, padx=(5, 0))
 
         # ESP32 port
         ttk.Label(conn_frame, text="Port:").grid(row=1, column=0, sticky="w", pady=5)
@@ -222,6 +258,13 @@ class CleverCoffeeOtaFlasher:
         ttk.Label(conn_frame, text="(Default: otapass)",
                   font=("TkDefaultFont", 8), foreground="gray").grid(row=2, column=2, sticky="w", pady=5, padx=(5, 0))
 
+        # Bandwidth limit
+        ttk.Label(conn_frame, text="Rate limit (KB/s):").grid(row=3, column=0, sticky="w", pady=5)
+        ttk.Entry(conn_frame, textvariable=self.rate_limit, width=10).grid(row=3, column=1, sticky="w", pady=5,
+                                                                           padx=(5, 0))
+        ttk.Label(conn_frame, text="(0 = unlimited)",
+                  font=("TkDefaultFont", 8), foreground="gray").grid(row=3, column=2, sticky="w", pady=5, padx=(5, 0))
+
         # Progress bar
         self.progress = ttk.Progressbar(main_frame, mode='indeterminate')
         self.progress.grid(row=3, column=0, columnspan=3, sticky="ew", pady=(20, 10))
@@ -251,6 +294,118 @@ class CleverCoffeeOtaFlasher:
         # Add initial message
         self.log_message("CleverCoffee OTA Flasher ready. Download binaries from GitHub or select files manually.")
 
+        self.root.after(100, self.process_engine_events)
+
+    def setup_history_tab(self, history_frame):
+        """Create the upload history view"""
+        history_frame.columnconfigure(0, weight=1)
+        history_frame.rowconfigure(1, weight=1)
+
+        controls = ttk.Frame(history_frame)
+        controls.grid(row=0, column=0, sticky="ew", pady=(0, 10))
+
+        ttk.Label(controls, text="Show:").pack(side=tk.LEFT)
+        self.history_query = ttk.Combobox(controls, state='readonly', width=30,
+                                          values=["Recent uploads", "Slowest devices", "Last successful firmware",
+                                                  "Throughput trend"])
+        self.history_query.current(0)
+        self.history_query.pack(side=tk.LEFT, padx=(5, 10))
+        self.history_query.bind("<<ComboboxSelected>>", lambda event: self.refresh_history())
+
+        ttk.Label(controls, text="Host:").pack(side=tk.LEFT)
+        host_entry = ttk.Entry(controls, textvariable=self.history_host, width=20)
+        host_entry.pack(side=tk.LEFT, padx=(5, 10))
+        host_entry.bind("<Return>", lambda event: self.refresh_history())
+
+        ttk.Button(controls, text="Refresh", command=self.refresh_history).pack(side=tk.LEFT)
+
+        self.history_tree = ttk.Treeview(history_frame, show="headings")
+        self.history_tree.grid(row=1, column=0, sticky="nsew")
+
+        scrollbar = ttk.Scrollbar(history_frame, orient=tk.VERTICAL, command=self.history_tree.yview)
+        scrollbar.grid(row=1, column=1, sticky="ns")
+        self.history_tree.configure(yscrollcommand=scrollbar.set)
+
+    def setup_fleet_tab(self, fleet_frame):
+        """Create the per-device progress view of all uploads"""
+        fleet_frame.columnconfigure(0, weight=1)
+        fleet_frame.rowconfigure(1, weight=1)
+
+        controls = ttk.Frame(fleet_frame)
+        controls.grid(row=0, column=0, sticky="ew", pady=(0, 10))
+
+        ttk.Checkbutton(controls, text="Show the jobs of the daemon at", variable=self.follow_daemon,
+                        command=self.on_fleet_source_changed).pack(side=tk.LEFT)
+        ttk.Entry(controls, textvariable=self.daemon_api, width=22).pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Button(controls, text="Clear finished",
+                   command=lambda: self.dashboard.model.clear(finished_only=True)).pack(side=tk.LEFT)
+
+        self.dashboard = ota_dashboard.FleetDashboard(fleet_frame)
+        self.dashboard.grid(row=1, column=0, sticky="nsew")
+        self.dashboard.follow(engine=self.engine)
+
+    def on_fleet_source_changed(self):
+        """Switch the Fleet tab between this app's uploads and the daemon's"""
+        if self.follow_daemon.get():
+            host, _, port = self.daemon_api.get().strip().rpartition(":")
+            url = f"http://{host or ota_daemon.DEFAULT_API_HOST}:{port or ota_daemon.DEFAULT_API_PORT}"
+            self.dashboard.follow(url=url, log=lambda message: self.root.after(0, self.log_message, f"⚠️ {message}"))
+        else:
+            self.dashboard.follow(engine=self.engine)
+
+    def refresh_history(self):
+        """Reload the history view for the selected query"""
+        query = self.history_query.get()
+        try:
+            history = ota_history.UploadHistory()
+            try:
+                if query == "Slowest devices":
+                    columns = ("Host", "Uploads", "Avg throughput", "Min throughput", "Retries")
+                    rows = [(row['host'], row['uploads'], ota_history.format_rate(row['avg_throughput']),
+                             ota_history.format_rate(row['min_throughput']), row['retries'] or 0)
+                            for row in history.slowest_devices(50)]
+                elif query == "Last successful firmware":
+                    columns = ("Host", "Partition", "Release", "Digest", "Uploaded")
+                    rows = [(row['host'], row['partition'], row['release_tag'] or "-", row['image_digest'],
+                             ota_history.format_timestamp(row['started']))
+                            for row in history.last_successful()]
+                elif query == "Throughput trend":
+                    host = self.history_host.get().strip() or self.esp_ip.get().strip()
+                    columns = ("Time", "Partition", "Throughput", "Change", "Total", "Release")
+                    rows = []
+                    previous = {}       # partition -> throughput of the upload before
+                    for row in history.throughput_trend(host, 200):
+                        before = previous.get(row['partition'])
+                        change = "-"
+                        if before and row['throughput']:
+                            change = f"{(row['throughput'] / before - 1) * 100:+.0f}%"
+                        if row['throughput']:
+                            previous[row['partition']] = row['throughput']
+                        rows.append((ota_history.format_timestamp(row['started']), row['partition'],
+                                     ota_history.format_rate(row['throughput']), change,
+                                     f"{row['total_s']:.1f} s" if row['total_s'] else "-", row['release_tag'] or ""))
+                    rows.reverse()
+                else:
+                    columns = ("Time", "Host", "Partition", "Outcome", "Throughput", "Total", "Retries", "Release")
+                    rows = [(ota_history.format_timestamp(row['started']), row['host'], row['partition'],
+                             row['outcome'], ota_history.format_rate(row['throughput']),
+                             f"{row['total_s']:.1f} s" if row['total_s'] else "-", row['retries'] or 0,
+                             row['release_tag'] or "")
+                            for row in history.recent(200)]
+            finally:
+                history.close()
+        except Exception as e:
+            self.log_message(f"❌ Could not read upload history: {str(e)}")
+            return
+
+        self.history_tree.delete(*self.history_tree.get_children())
+        self.history_tree["columns"] = columns
+        for column in columns:
+            self.history_tree.heading(column, text=column)
+            self.history_tree.column(column, width=100, stretch=True)
+        for row in rows:
+            self.history_tree.insert("", tk.END, values=row)
+
     def _update_download_path_display(self):
         """Update the download path display"""
         download_dir = get_download_directory()
@@ -278,8 +433,10 @@ class CleverCoffeeOtaFlasher:
             return
 
         self.upload_in_progress = True
+        self.cancel_token = CancelToken()
         self.download_button.config(state='disabled')
         self.upload_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
         self.progress.start()
         self.log_message("🌐 Starting download from GitHub...")
 
@@ -291,59 +448,37 @@ class CleverCoffeeOtaFlasher:
     def _download_binaries_thread(self):
         """Download binaries in a separate thread"""
         try:
-            # Get download directory
-            download_dir = get_download_directory()
+            # Releases are kept side by side, one directory per tag, so a LAN mirror can serve them all
+            cache = ota_mirror.ReleaseCache(get_download_directory())
+            download_dir = cache.root / self.github_release_tag
 
             # Create directory if it doesn't exist
             download_dir.mkdir(parents=True, exist_ok=True)
             self.last_download_dir = download_dir
+            mirrors = [url.strip() for url in self.mirror_url.get().split(",") if url.strip()]
 
             self.log_message(f"📁 Download directory: {download_dir}")
 
             success_count = 0
             total_files = len(self.binary_urls)
 
-            for filename, url in self.binary_urls.items():
+            for filename in self.binary_urls:
+                if self.cancel_token.cancelled:
+                    break
                 try:
                     self.log_message(f"⬇️ Downloading {filename}...")
-                    local_path = download_dir / filename
-
-                    if HAS_REQUESTS:
-                        # Use requests for better SSL handling
-                        response = requests.get(url, stream=True, timeout=30)
-                        response.raise_for_status()
-
-                        total_size = int(response.headers.get('content-length', 0))
-
-                        with open(local_path, 'wb') as f:
-                            downloaded = 0
-                            for chunk in response.iter_content(chunk_size=8192):
-                                if chunk:
-                                    f.write(chunk)
-                                    downloaded += len(chunk)
-                                    if total_size > 0:
-                                        percent = (downloaded * 100) // total_size
-                                        if percent % 20 == 0 and percent > 0:
-                                            self.log_message(f"   Progress: {percent}%")
-                    else:
-                        # Fallback to urllib with SSL context workaround
-                        import ssl
-
-                        # Create unverified SSL context (less secure but works)
-                        ssl_context = ssl.create_default_context()
-                        ssl_context.check_hostname = False
-                        ssl_context.verify_mode = ssl.CERT_NONE
+                    logged = set()
 
-                        def progress_hook(block_num, block_size, total_size):
-                            if total_size > 0:
-                                percent = min(100, (block_num * block_size * 100) // total_size)
-                                if percent % 20 == 0 and percent > 0:
-                                    self.log_message(f"   Progress: {percent}%")
+                    def progress_hook(downloaded, total_size):
+                        if total_size > 0:
+                            step = (downloaded * 5) // total_size
+                            if step > 0 and step not in logged:
+                                logged.add(step)
+                                self.log_message(f"   Progress: {step * 20}%")
 
-                        # Use the SSL context with urllib
-                        opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl_context))
-                        urllib.request.install_opener(opener)
-                        urllib.request.urlretrieve(url, str(local_path), progress_hook)
+                    local_path = ota_mirror.fetch_release_asset(self.github_repo, self.github_release_tag,
+                                                                filename, cache, mirrors, cancel=self.cancel_token,
+                                                                progress=progress_hook, log=self.log_message)
 
                     # Verify file was downloaded and has content
                     if local_path.exists() and local_path.stat().st_size > 0:
@@ -362,6 +497,9 @@ class CleverCoffeeOtaFlasher:
                     else:
                         self.log_message(f"❌ Downloaded {filename} but file is empty or missing")
 
+                except Cancelled:
+                    self.log_message(f"⏹️ Download of {filename} cancelled, it will resume on the next download")
+                    break
                 except Exception as e:
                     self.log_message(f"❌ Failed to download {filename}: {str(e)}")
                     # Additional SSL-specific error info
@@ -370,7 +508,9 @@ class CleverCoffeeOtaFlasher:
                         self.log_message(
                             f"   Try downloading files manually from: https://github.com/{self.github_repo}/releases/tag/{self.github_release_tag}")
 
-            if success_count == total_files:
+            if self.cancel_token.cancelled:
+                self.log_message(f"⚠️ Downloaded {success_count}/{total_files} files before cancelling")
+            elif success_count == total_files:
                 self.log_message(f"✅ Successfully downloaded all {total_files} files!")
                 self.log_message(f"📂 Files saved to: {download_dir}")
                 self.log_message(
@@ -392,8 +532,10 @@ class CleverCoffeeOtaFlasher:
     def _update_ui_after_download(self):
         """Update UI elements after download completion"""
         self.upload_in_progress = False
+        self.cancel_token = None
         self.download_button.config(state='normal')
         self.upload_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
         self.progress.stop()
 
         # Enable "Open Folder" button if we have a download directory
@@ -404,6 +546,40 @@ class CleverCoffeeOtaFlasher:
         self.on_firmware_check_changed()
         self.on_filesystem_check_changed()
 
+    def on_host_changed(self, _event=None):
+        """Fill in what is known about the entered host and look it up in the background"""
+        host = self.esp_ip.get().strip()
+        if not host:
+            self.host_status.set("")
+            return
+
+        inventory = self.engine.inventory
+        device = inventory.get(host)
+        if device is not None:
+            self.esp_port.set(str(device.port))
+            if device.ip:
+                self.host_status.set(f"{device.ip} ({ota_inventory.format_age(device.age())})")
+
+        password = self.credentials.get(inventory.credential_key(host))
+        if password is not None and password != self.esp_password.get():
+            self.esp_password.set(password)
+            self.log_message(f"🔑 Using stored password for {host}")
+
+        # Warm the cache so the upload does not wait for DNS/mDNS
+        if not ota_inventory.is_ip_address(host):
+            inventory.refresh_async([host], lambda name, ip: self.root.after(0, self.show_resolution, name, ip))
+
+    def show_resolution(self, host: str, ip):
+        if host != self.esp_ip.get().strip():
+            return
+        device = self.engine.inventory.get(host)
+        if ip is not None:
+            self.host_status.set(ip)
+        elif device is not None and device.ip:
+            self.host_status.set(f"{device.ip} (lookup failing, last known)")
+        else:
+            self.host_status.set("cannot resolve")
+
     def on_firmware_check_changed(self):
         """Handle firmware checkbox state change"""
         if self.upload_firmware.get():
@@ -418,9 +594,11 @@ class CleverCoffeeOtaFlasher:
         if self.upload_filesystem.get():
             self.filesystem_entry.config(state='normal')
             self.filesystem_browse_btn.config(state='normal')
+            self.filesystem_build_btn.config(state='normal')
         else:
             self.filesystem_entry.config(state='disabled')
             self.filesystem_browse_btn.config(state='disabled')
+            self.filesystem_build_btn.config(state='disabled')
 
     def browse_firmware(self):
         """Open file dialog to select firmware binary"""
@@ -448,6 +626,30 @@ class CleverCoffeeOtaFlasher:
             self.filesystem_path.set(file_path)
             self.log_message(f"Selected filesystem: {os.path.basename(file_path)}")
 
+    def build_filesystem(self):
+        """Build a LittleFS image from a data directory and select it"""
+        data_dir = filedialog.askdirectory(title="Select the Data Directory of the Web UI")
+        if not data_dir:
+            return
+        if not ota_littlefs.HAS_LITTLEFS:
+            messagebox.showerror("Error", "Building filesystem images needs littlefs-python.\n"
+                                          "Install it with: pip install littlefs-python")
+            return
+
+        def build():
+            log = lambda message: self.root.after(0, self.log_message, message)
+            try:
+                result = ota_littlefs.build_image(data_dir, ota_littlefs.default_output(), log=log)
+            except (RuntimeError, ValueError, OSError) as e:
+                log(f"❌ Filesystem build failed: {str(e)}")
+                return
+            log(f"🧱 Built {result.files} files into {os.path.basename(result.path)}, MD5 {result.md5}"
+                f"{' (unchanged)' if result.reused else ''}")
+            self.root.after(0, self.filesystem_path.set, result.path)
+
+        self.log_message(f"Building filesystem image from {data_dir}...")
+        threading.Thread(target=build, daemon=True).start()
+
     def log_message(self, message: str):
         """Add a message to the log area with timestamp"""
         timestamp = datetime.datetime.now().strftime("%H:%M:%S")
@@ -495,6 +697,13 @@ class CleverCoffeeOtaFlasher:
             messagebox.showerror("Error", "Port must be a number")
             return False
 
+        try:
+            if int(self.rate_limit.get() or 0) < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Error", "Rate limit must be a positive number of KB/s (0 = unlimited)")
+            return False
+
         # Validate password is provided
         if not self.esp_password.get().strip():
             messagebox.showerror("Error", "Password is required for CleverCoffee OTA uploads.\nDefault password is 'otapass'")
@@ -502,49 +711,6 @@ class CleverCoffeeOtaFlasher:
 
         return True
 
-    def test_connectivity(self):
-        """Test basic network connectivity to the ESP32"""
-        try:
-            import socket
-
-            self.log_message(f"🔍 Testing basic connectivity to {self.esp_ip.get()}...")
-
-            # Try to resolve the hostname/IP first
-            try:
-                ip_address = socket.gethostbyname(self.esp_ip.get())
-                self.log_message(f"✅ Host resolution successful: {self.esp_ip.get()} -> {ip_address}")
-            except socket.gaierror:
-                self.log_message(f"❌ Cannot resolve hostname: {self.esp_ip.get()}")
-                return False
-
-            common_ports = [80, 443, 22, 23, 3232]  # Include the OTA port
-
-            reachable = False
-            for port in common_ports:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(2)  # Short timeout
-                    result = sock.connect_ex((ip_address, port))
-                    sock.close()
-
-                    if result == 0:
-                        self.log_message(f"✅ Host is reachable (responded on port {port})")
-                        reachable = True
-                        break
-                except:
-                    continue
-
-            if not reachable:
-                self.log_message(f"⚠️ Host may not be reachable on common ports")
-                self.log_message(f"This is normal for OTA-only devices - proceeding with upload")
-
-            return True
-
-        except Exception as e:
-            self.log_message(f"⚠️ Network test inconclusive: {str(e)}")
-            self.log_message(f"Proceeding with OTA upload anyway")
-            return True
-
     def start_upload(self):
         """Start the OTA upload process"""
         if not self.validate_inputs():
@@ -553,9 +719,23 @@ class CleverCoffeeOtaFlasher:
         if self.upload_in_progress:
             return
 
-        self.test_connectivity()
+        image_paths = self.selected_images()
+        release = None
+        if self.last_download_dir and any(Path(path).parent == self.last_download_dir
+                                          for path in image_paths.values()):
+            release = (self.github_repo, self.github_release_tag)
+        self.submit_upload(image_paths, release)
+
+    def selected_images(self) -> dict:
+        image_paths = {}
+        if self.upload_firmware.get():
+            image_paths["app"] = self.firmware_path.get()
+        if self.upload_filesystem.get():
+            image_paths["spiffs"] = self.filesystem_path.get()
+        return image_paths
 
-        # Start upload in a separate thread to prevent GUI freezing
+    def submit_upload(self, image_paths: dict, release=None):
+        """Hand an upload to the engine and switch the UI to the running state"""
         self.upload_in_progress = True
         self.upload_button.config(state='disabled')
         self.download_button.config(state='disabled')
@@ -563,188 +743,81 @@ class CleverCoffeeOtaFlasher:
         self.progress.start()
 
         self.log_message("Starting OTA upload...")
+        rate = int(self.rate_limit.get() or 0)
+        if rate > 0:
+            self.log_message(f"   Rate limit: {rate} KB/s")
+        self.engine.scheduler.set_global_rate(rate * 1024)
+        self.engine.delta = self.send_delta.get()
+
+        # The engine runs the pre-flight checks and uploads on its worker thread
+        self.current_job = self.engine.submit(self.esp_ip.get().strip(), image_paths,
+                                              password=self.esp_password.get(), port=int(self.esp_port.get()),
+                                              release=release, skip_unchanged=self.skip_unchanged.get())
+        return self.current_job
+
+    def on_auto_flash_changed(self):
+        """Start or stop watching the selected files"""
+        if self.watch_token is not None:
+            self.watch_token.cancel()
+            self.watch_token = None
+            self.log_message("👀 Stopped watching for changes")
+        if not self.auto_flash.get():
+            return
+        if not self.validate_inputs():
+            self.auto_flash.set(False)
+            return
 
-        # Run espota in a separate thread
-        upload_thread = threading.Thread(target=self.run_uploads)
-        upload_thread.daemon = True
-        upload_thread.start()
-
-    def run_uploads(self):
-        """Run the upload(s) in sequence"""
-        try:
-            upload_success = True
-
-            # Upload firmware first if selected
-            if self.upload_firmware.get():
-                self.log_message("Uploading firmware...")
-                if not self.run_single_upload(self.firmware_path.get(), "app"):
-                    upload_success = False
-
-            # Upload filesystem if selected and firmware succeeded (or not selected)
-            if self.upload_filesystem.get() and upload_success:
-                self.log_message("Uploading filesystem...")
-                if not self.run_single_upload(self.filesystem_path.get(), "spiffs"):
-                    upload_success = False
-
-            if upload_success:
-                self.log_message("✅ All uploads completed successfully!")
-                self.log_message("🔄 ESP32 should restart automatically with the new firmware.")
-            else:
-                self.log_message("❌ One or more uploads failed")
-
-        except Exception as e:
-            self.log_message(f"❌ Error: {str(e)}")
-        finally:
-            # Reset UI state
-            self.upload_in_progress = False
-            self.current_process = None
-            self.root.after(0, self.reset_ui)  # Schedule UI reset on main thread
-
-    def run_single_upload(self, file_path: str, partition_type: str) -> bool:
-        """Run a single espota upload"""
+        patterns = {partition: [path] for partition, path in self.selected_images().items()}
+        watcher = ota_watch.BuildWatcher(
+            patterns, lambda changes, detected: self.root.after(0, self.flash_changes, changes, detected),
+            log=lambda message: self.root.after(0, self.log_message, message),
+            in_use=lambda: ota_watch.pending_images(self.engine))
+        self.watch_token = CancelToken()
+        threading.Thread(target=watcher.run, args=(self.watch_token,), daemon=True).start()
+
+    def flash_changes(self, changes: dict, detected: float):
+        """Upload the partitions the watcher saw change (runs on the Tk thread)"""
+        image_paths = {partition: path for partition, (path, digest) in changes.items()}
+        for partition, (path, digest) in changes.items():
+            self.log_message(f"🔁 {partition} changed (MD5 {digest})")
+
+        # A newer build supersedes an upload of the same partitions
+        if self.current_job is not None and set(self.current_job.images) <= set(image_paths):
+            self.engine.cancel(self.current_job.id)
+        job = self.submit_upload(image_paths)
+        self.change_times[job.id] = detected
+
+    def process_engine_events(self):
+        """Show the progress of the current upload job (runs on the Tk thread)"""
         try:
-            # Build the espota command
-            espota_path = get_espota_path()
-            cmd = [
-                sys.executable,  # Python executable
-                espota_path,
-                "-i", self.esp_ip.get(),
-                "-p", self.esp_port.get(),
-                "-f", file_path,
-                "-d",  # Enable debug mode for more verbose output
-                "-r"  # Enable progress reporting
-            ]
-
-            # Add partition parameter for filesystem uploads
-            if partition_type == "spiffs":
-                cmd.append("-s")  # This tells espota to upload to SPIFFS partition
-
-            # Add password if provided
-            if self.esp_password.get().strip():
-                cmd.extend(["-a", self.esp_password.get()])
-
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            self.log_message(f"Uploading {file_name} ({file_size:,} bytes)")
-            self.log_message(f"Command: espota.py -i {self.esp_ip.get()} -p {self.esp_port.get()} -f {file_name}" +
-                             (" -s" if partition_type == "spiffs" else "") + " -d -r")
-
-            # Add troubleshooting info
-            self.log_message(f"🔍 Upload info:")
-            self.log_message(f"   File size: {file_size:,} bytes ({file_size / 1024 / 1024:.1f} MB)")
-            self.log_message(f"   Target: {self.esp_ip.get()}:{self.esp_port.get()}")
-            self.log_message(f"   Partition: {partition_type}")
-
-            # Create a queue for real-time output
-            output_queue = queue.Queue()
-
-            # Start the process
-            env = os.environ.copy()
-            env['PYTHONUNBUFFERED'] = '1'  # Force Python to be unbuffered
-
-            self.current_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=0,
-                universal_newlines=True,
-                env=env
-            )
-
-            # Start threads to read stdout and stderr
-            def read_output(pipe, queue_obj, stream_name):
-                try:
-                    for line in iter(pipe.readline, ''):
-                        if line:
-                            queue_obj.put((stream_name, line))
-                    pipe.close()
-                except:
-                    pass
-
-            stdout_thread = threading.Thread(target=read_output,
-                                             args=(self.current_process.stdout, output_queue, 'stdout'))
-            stderr_thread = threading.Thread(target=read_output,
-                                             args=(self.current_process.stderr, output_queue, 'stderr'))
-
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
-
-            # Process output in real-time
-            last_progress_line = ""
-            while self.current_process.poll() is None:
-                if not self.upload_in_progress:  # Check if cancelled
-                    self.current_process.terminate()
-                    return False
-
-                try:
-                    # Get output with a short timeout to allow checking for cancellation
-                    stream_name, line = output_queue.get(timeout=0.1)
-
-                    clean_line = line.strip()
-                    if not clean_line:
-                        continue
-
-                    # Handle progress updates (they come on stderr and contain progress bars)
-                    if "Uploading: [" in clean_line and "%" in clean_line:
-                        # This is a progress update, show it and overwrite previous progress
-                        self.update_progress_line(f"   {clean_line}")
-                        last_progress_line = clean_line
-                    else:
-                        # Regular output line
-                        if clean_line != last_progress_line:  # Avoid duplicate lines
-                            self.log_message(f"   {clean_line}")
-
-                            # Check for specific status messages
-                            if "Authentication OK" in clean_line:
-                                self.log_message("✅ Authentication successful, starting file transfer...")
-                            elif any(error in clean_line.upper() for error in ["ERROR:", "FAILED", "EXCEPTION"]):
-                                self.log_message(f"⚠️ Error detected: {clean_line}")
-                            elif "No response" in clean_line:
-                                self.log_message("No response from ESP32 - check if device is still connected")
-
-                except queue.Empty:
-                    continue  # No output available, continue checking
-                except:
-                    break
-
-            # Process any remaining output
-            while not output_queue.empty():
-                try:
-                    stream_name, line = output_queue.get_nowait()
-                    clean_line = line.strip()
-                    if clean_line and "Uploading: [" not in clean_line:
-                        self.log_message(f"   {clean_line}")
-                except queue.Empty:
-                    break
-
-            # Wait for threads to finish
-            stdout_thread.join(timeout=1)
-            stderr_thread.join(timeout=1)
-
-            # Get the final return code
-            return_code = self.current_process.wait()
-
-            if return_code == 0:
-                self.log_message(f"✅ {partition_type.title()} upload completed successfully!")
-                return True
-            else:
-                self.log_message(f"❌ {partition_type.title()} upload failed with return code: {return_code}")
-                self.log_message("💡 Troubleshooting suggestions:")
-                self.log_message("   • Try restarting the ESP32 device")
-                self.log_message("   • Check if the ESP32 has enough free memory")
-                self.log_message("   • Verify the IP address is correct and reachable")
-                self.log_message("   • Try uploading a smaller file first")
-                return False
+            for _ in range(200):
+                event = self.engine_events.get_nowait()
+                if self.current_job is None or event["job"] != self.current_job.id:
+                    continue
 
-        except FileNotFoundError:
-            self.log_message("❌ Error: espota.py not found. Please ensure it's in the same directory.")
-            return False
-        except Exception as e:
-            self.log_message(f"❌ Error during {partition_type} upload: {str(e)}")
-            return False
+                if event["type"] == "log":
+                    self.log_message(event["message"])
+                elif event["type"] == "progress":
+                    block = int(round(60 * event["percent"] / 100))
+                    self.update_progress_line(f"   Uploading: [{'=' * block}{' ' * (60 - block)}] "
+                                              f"{event['percent']}%")
+                elif event["type"] == "partition" and event["result"] != 0 and not self.current_job.cancel.cancelled:
+                    self.log_message("💡 Troubleshooting suggestions:")
+                    self.log_message("   • Try restarting the ESP32 device")
+                    self.log_message("   • Check if the ESP32 has enough free memory")
+                    self.log_message("   • Verify the IP address is correct and reachable")
+                    self.log_message("   • Try uploading a smaller file first")
+                elif event["type"] == "state" and event["state"] in ota_engine.FINISHED_STATES:
+                    detected = self.change_times.pop(event["job"], None)
+                    if event["state"] == ota_engine.SUCCESS and detected is not None:
+                        self.log_message(f"⏱️ Flashed {time.time() - detected:.1f} s after the change")
+                    if event["state"] == ota_engine.SUCCESS:
+                        self.host_combo.config(values=[device.name for device in self.engine.inventory.devices()])
+                    self.current_job = None
+                    self.reset_ui()
+        except queue.Empty:
+            pass
+        self.root.after(100, self.process_engine_events)
 
     def update_progress_line(self, message: str):
         """Update the last line in the log with progress information"""
@@ -770,22 +843,52 @@ class CleverCoffeeOtaFlasher:
         self.root.after(0, update_ui)
 
     def cancel_upload(self):
-        """Cancel the ongoing upload"""
-        if self.current_process:
-            self.current_process.terminate()
-            self.log_message("⏹️ Upload cancelled by user")
-        self.upload_in_progress = False
-        self.reset_ui()
+        """Cancel the ongoing download or upload
+
+        Sockets and files are released by the worker thread, which resets the
+        UI once it has stopped.
+        """
+        if self.current_job is not None:
+            self.engine.cancel(self.current_job.id)
+            self.log_message("⏹️ Cancelling...")
+        elif self.cancel_token and not self.cancel_token.cancelled:
+            self.cancel_token.cancel()
+            self.log_message("⏹️ Cancelling...")
+        self.cancel_button.config(state='disabled')
 
     def reset_ui(self):
         """Reset UI elements after upload completion or cancellation"""
+        self.upload_in_progress = False
+        self.cancel_token = None
         self.upload_button.config(state='normal')
         self.download_button.config(state='normal')
         self.cancel_button.config(state='disabled')
         self.progress.stop()
 
 
+# Headless subcommands, e.g. "python clevercoffee_ota_flasher.py history slowest"
+COMMANDS = {
+    "history": ota_history.main,
+    "daemon": ota_daemon.main,
+    "mirror": ota_mirror.main,
+    "watch": ota_watch.main,
+    "autotune": ota_autotune.main,
+    "fake-device": ota_fakedevice.main,
+    "simulate": ota_fleetsim.main,
+    "littlefs": ota_littlefs.main,
+    "inventory": ota_inventory.main,
+    "trace": ota_trace.main,
+    "prepare": ota_prepare.main,
+    "download-bench": ota_dlbench.main,
+    "delta": ota_delta.main,
+    "routes": ota_routes.main,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
     root = tk.Tk()
     CleverCoffeeOtaFlasher(root)
     root.mainloop()
@@ -35,13 +35,40 @@ import os
 import optparse
 import logging
 import hashlib
-import random
+import time
+import functools
+
+from ota_cancel import CancelToken, Cancelled
+from ota_credentials import CredentialStore
+from ota_delta import FirmwareArchive, plan_delta
+import ota_images
+import ota_shaping
+import ota_trace
+from ota_listener import PrivateListener
+from ota_routes import InvitationRace, Route, RoutePlan, plan_routes
+from ota_history import UploadHistory
+from ota_inventory import DeviceInventory
+from ota_profiles import DEFAULT_PROFILE, ProfileStore
 
 # Commands
 FLASH = 0
 SPIFFS = 100
 AUTH = 200
+# A delta to patch the running firmware with (see ota_delta); not part of stock ArduinoOTA
+DELTA = 300
+# serve() result when the device refused a delta, e.g. because it runs another firmware than its base
+DELTA_REFUSED = 2
+# serve() result when no delta invitation was answered, as by stock ArduinoOTA
+DELTA_UNANSWERED = 3
+# Invitations a delta is offered before giving up; stock ArduinoOTA ignores it without answering
+DELTA_INVITATIONS = 2
+# Seconds a device not yet known to accept deltas gets to answer the one probing invitation
+DELTA_PROBE_TIMEOUT = 2
 PROGRESS = False
+TIMEOUT = 10
+# Seconds the device gets to answer our authentication
+AUTH_TIMEOUT = 10
+POLL_INTERVAL = 0.25
 # update_progress() : Displays or updates a console progress bar
 ## Accepts a float between 0 and 1. Any int will be converted to a float.
 ## A value under 0 represents a 'halt'.
@@ -69,166 +96,335 @@ def update_progress(progress):
     sys.stderr.write('.')
     sys.stderr.flush()
 
-def serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command = FLASH):
-  # Create a TCP/IP socket
-  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  server_address = (localAddr, localPort)
-  logging.info('Starting on %s:%s', str(server_address[0]), str(server_address[1]))
+# prepare_handshake() : Precomputes the parts of the digest authentication that
+## do not depend on the nonce sent by the device (password MD5 and the image
+## part of the cnonce). Results are cached per image/password so concurrent
+## uploads of the same image share them.
+@functools.lru_cache(maxsize=32)
+def prepare_handshake(password, filename, content_size, file_md5):
+  passmd5 = hashlib.md5(password.encode()).hexdigest()
+  cnonce_prefix = '%s%u%s' % (filename, content_size, file_md5)
+  return (passmd5, cnonce_prefix)
+
+# auth_response() : Answers an AUTH challenge from the device.
+## Returns the (cnonce, response) pair for the AUTH command.
+def auth_response(handshake, nonce, remoteAddr):
+  passmd5, cnonce_prefix = handshake
+  cnonce = hashlib.md5((cnonce_prefix + remoteAddr).encode()).hexdigest()
+  result_text = '%s:%s:%s' % (passmd5, nonce, cnonce)
+  result = hashlib.md5(result_text.encode()).hexdigest()
+  return (cnonce, result)
+
+# _wait() : Runs a blocking socket operation in short slices, so a cancelled
+## upload gives up within POLL_INTERVAL instead of waiting for the full timeout.
+def _wait(sock, timeout, cancel, operation):
+  deadline = time.time() + timeout
+  while True:
+    cancel.check()
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      raise socket.timeout('timed out')
+    sock.settimeout(min(remaining, POLL_INTERVAL))
+    try:
+      return operation()
+    except socket.timeout:
+      continue
+
+# serve() : Uploads an image. profile sets chunk size, window, socket options
+## and timeouts (see ota_profiles). With sample, the transfer stops after that
+## many bytes; the device discards the incomplete image (used for calibration).
+## trace is an ota_trace.SessionRecorder that gets every step of the exchange.
+## With listener (an ota_listener.ConnectBackListener), the device connects
+## back to the shared listener; otherwise to one of this upload's own, on
+## localPort or, if that is 0, on a free port.
+## With delta (base MD5, target size, target MD5, see ota_delta.DeltaPlan),
+## the image is a delta sent with the DELTA command; with probe, it is offered
+## once for DELTA_PROBE_TIMEOUT seconds only. If no delta invitation is
+## answered, the result is DELTA_UNANSWERED.
+## With routes (an ota_routes.RoutePlan), the invitation races over its
+## routes, joined by its fallback routes after the first timeout, and the
+## one answered is set as its winner; without, it goes out over the route
+## the routing table picks.
+def serve(remoteAddr, localAddr, remotePort, localPort, password, filename, command = FLASH, timings = None, image = None, shaper = None, cancel = None, progress = None, profile = None, sample = None, trace = None, listener = None, delta = None, routes = None, probe = False):
+  if timings is None:
+    timings = {}
+  if profile is None:
+    profile = DEFAULT_PROFILE
+  # sockets of this upload are released through its own token, even when the
+  # caller's token covers several concurrent uploads
+  cancel = CancelToken(cancel)
+  # the image is shared with any concurrent upload of the same file
+  own_image = image is None
+  result = 1
   try:
-    sock.bind(server_address)
-    sock.listen(1)
-  except:
-    logging.error("Listen Failed")
+    if own_image:
+      try:
+        image = ota_images.registry.acquire(filename)
+      except (IOError, OSError) as e:
+        logging.error('Cannot read image: %s', e)
+        return 1
+    if trace is not None:
+      trace.begin(remoteAddr, remotePort, command, image.size, image.md5, profile)
+      record = trace.event
+    else:
+      record = lambda *event: None
+    try:
+      if listener is not None:
+        slot = listener.claim(remoteAddr, cancel = cancel)
+      else:
+        slot = PrivateListener(localAddr, localPort, profile.send_buffer, cancel)
+    except socket.timeout:
+      logging.error('No free connect-back port for %s', remoteAddr)
+      return 1
+    except (socket.error, OSError):
+      logging.error("Listen Failed")
+      return 1
+    try:
+      result = _serve(remoteAddr, slot, remotePort, password, filename, command, timings, image, shaper, cancel, progress, profile, sample, record, delta, routes, probe)
+    finally:
+      slot.release()
+    return result
+  except Cancelled:
+    sys.stderr.write('\n')
+    logging.warning('Upload to %s cancelled', remoteAddr)
     return 1
+  finally:
+    cancel.close()
+    if trace is not None and trace.header:
+      trace.finish(result)
+    if own_image and image is not None:
+      ota_images.registry.release(image)
+
+def _serve(remoteAddr, slot, remotePort, password, filename, command, timings, image, shaper, cancel, progress, profile, sample, record, delta, routes, probe):
+  localPort = slot.port
+  logging.info('Waiting for connect-back on port %d', localPort)
 
-  content_size = os.path.getsize(filename)
-  f = open(filename,'rb')
-  file_md5 = hashlib.md5(f.read()).hexdigest()
-  f.close()
+  content_size = image.size
+  file_md5 = image.md5
   logging.info('Upload size: %d', content_size)
   message = '%d %d %d %s\n' % (command, localPort, content_size, file_md5)
+  if delta is not None:
+    message = '%d %d %d %s %s %d %s\n' % ((command, localPort, content_size, file_md5) + tuple(delta))
+  handshake = prepare_handshake(password, filename, content_size, file_md5)
 
-  # Wait for a connection
-  inv_trys = 0
-  data = ''
-  msg = 'Sending invitation to %s ' % (remoteAddr)
-  sys.stderr.write(msg)
-  sys.stderr.flush()
-  while (inv_trys < 10):
-    inv_trys += 1
-    sock2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    remote_address = (remoteAddr, int(remotePort))
-    try:
-      sent = sock2.sendto(message.encode(), remote_address)
-    except:
-      sys.stderr.write('failed\n')
+  # Invite the device, racing the routes of the plan; it connects back over the one it answers
+  invitation = message.encode()
+  remote_address = (remoteAddr, int(remotePort))
+  race_routes = routes.routes if routes is not None else []
+  fallback = routes.fallback if routes is not None else []
+  while True:
+    inv_trys = 0
+    data = ''
+    msg = 'Sending invitation to %s ' % (remoteAddr)
+    sys.stderr.write(msg)
+    sys.stderr.flush()
+    inv_start = time.time()
+    attempts = 10
+    timeout = TIMEOUT
+    if (delta is not None):
+      attempts = 1 if probe else DELTA_INVITATIONS
+      timeout = DELTA_PROBE_TIMEOUT if probe else TIMEOUT
+    while (inv_trys < attempts):
+      inv_trys += 1
+      race = InvitationRace(remote_address, race_routes, cancel)
+      record('invite')
+      try:
+        data = race.invite(invitation, timeout)
+        sock2 = race.socket
+        record('reply', data)
+        break;
+      except socket.timeout:
+        sys.stderr.write('.')
+        sys.stderr.flush()
+        if (fallback):
+          # none of the likely interfaces was answered, try the others as well
+          logging.debug('No answer over %s, adding %s', ', '.join(str(route) for route in race_routes) or 'default route', ', '.join(str(route) for route in fallback))
+          race_routes = race_routes + fallback
+          fallback = []
+      except (socket.error, OSError):
+        cancel.check()
+        sys.stderr.write('failed\n')
+        sys.stderr.flush()
+        logging.error('Host %s Not Found', remoteAddr)
+        return 1
+    else:
+      sys.stderr.write('\n')
       sys.stderr.flush()
-      sock2.close()
-      logging.error('Host %s Not Found', remoteAddr)
+      if (delta is not None):
+        logging.warning('No answer to the delta invitation')
+        return DELTA_UNANSWERED
+      logging.error('No response from the ESP')
       return 1
-    sock2.settimeout(TIMEOUT)
-    try:
-      data = sock2.recv(37).decode()
-      break;
-    except:
-      sys.stderr.write('.')
-      sys.stderr.flush()
+    sys.stderr.write('\n')
+    sys.stderr.flush()
+    timings['invitation'] = time.time() - inv_start
+    timings['retries'] = inv_trys - 1
+    logging.info('Invitation answered by %s in %.3f s', remoteAddr, timings['invitation'])
+    if (routes is not None):
+      routes.winner = race.winner
+      if (len(race_routes) > 1):
+        logging.info('Answered over %s', race.winner)
+    if (data.startswith('ERR') and delta is not None):
+      logging.warning('Delta refused: %s', data)
       sock2.close()
-  sys.stderr.write('\n')
-  sys.stderr.flush()
-  if (inv_trys == 10):
-    logging.error('No response from the ESP')
-    return 1
-  if (data != "OK"):
-    if(data.startswith('AUTH')):
-      nonce = data.split()[1]
-      cnonce_text = '%s%u%s%s' % (filename, content_size, file_md5, remoteAddr)
-      cnonce = hashlib.md5(cnonce_text.encode()).hexdigest()
-      passmd5 = hashlib.md5(password.encode()).hexdigest()
-      result_text = '%s:%s:%s' % (passmd5 ,nonce, cnonce)
-      result = hashlib.md5(result_text.encode()).hexdigest()
-      sys.stderr.write('Authenticating...')
-      sys.stderr.flush()
-      message = '%d %s %s\n' % (AUTH, cnonce, result)
-      sock2.sendto(message.encode(), remote_address)
-      sock2.settimeout(10)
-      try:
-        data = sock2.recv(32).decode()
-      except:
-        sys.stderr.write('FAIL\n')
-        logging.error('No Answer to our Authentication')
-        sock2.close()
-        return 1
-      if (data != "OK"):
-        sys.stderr.write('FAIL\n')
-        logging.error('%s', data)
+      return DELTA_REFUSED
+    if (data != "OK"):
+      if(data.startswith('AUTH')):
+        auth_start = time.time()
+        nonce = data.split()[1]
+        cnonce, result = auth_response(handshake, nonce, remoteAddr)
+        sys.stderr.write('Authenticating...')
+        sys.stderr.flush()
+        message = '%d %s %s\n' % (AUTH, cnonce, result)
+        sock2.sendto(message.encode(), remote_address)
+        record('auth')
+        try:
+          data = _wait(sock2, AUTH_TIMEOUT, cancel, lambda: sock2.recv(32)).decode()
+          record('reply', data)
+        except:
+          cancel.check()
+          sock2.close()
+          if (race.invited > 1):
+            # The invitation over another route made the device drop its challenge
+            sys.stderr.write('no answer\n')
+            logging.warning('No answer to our authentication, inviting %s again over %s only', remoteAddr, race.winner)
+            race_routes = [race.winner]
+            continue
+          sys.stderr.write('FAIL\n')
+          logging.error('No Answer to our Authentication')
+          return 1
+        if (data != "OK"):
+          sys.stderr.write('FAIL\n')
+          logging.error('%s', data)
+          sock2.close()
+          return 1
+        sys.stderr.write('OK\n')
+        timings['auth'] = time.time() - auth_start
+        logging.info('Authentication with %s took %.3f s', remoteAddr, timings['auth'])
+      else:
+        logging.error('Bad Answer: %s', data)
         sock2.close()
-        sys.exit(1);
         return 1
-      sys.stderr.write('OK\n')
-    else:
-      logging.error('Bad Answer: %s', data)
-      sock2.close()
-      return 1
+    break
   sock2.close()
 
   logging.info('Waiting for device...')
+  connect_start = time.time()
   try:
-    sock.settimeout(10)
-    connection, client_address = sock.accept()
-    sock.settimeout(None)
+    connection = slot.wait(10, cancel)
+    record('connect')
+    cancel.register(connection)
+    if profile.nodelay:
+      connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if profile.send_buffer and slot.shared:
+      connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, profile.send_buffer)
     connection.settimeout(None)
+    timings['connect'] = time.time() - connect_start
   except:
+    cancel.check()
     logging.error('No response from device')
-    sock.close()
     return 1
   try:
-    f = open(filename, "rb")
-    if (PROGRESS):
+    if (progress is not None):
+      progress(0)
+    elif (PROGRESS):
       update_progress(0)
     else:
       sys.stderr.write('Uploading')
       sys.stderr.flush()
     offset = 0
-    while True:
-      chunk = f.read(1024)
-      if not chunk: break
+    end = content_size if sample is None else min(sample, content_size)
+    # with a window, acks of several chunks arrive together
+    ack_size = 10 if profile.window == 1 else 1024
+    unacked = 0
+    transfer_start = time.time()
+    while offset < end:
+      cancel.check()
+      chunk = image.chunk(offset, min(profile.chunk_size, end - offset))
       offset += len(chunk)
-      update_progress(offset/float(content_size))
-      connection.settimeout(10)
+      if (progress is not None):
+        progress(offset/float(content_size))
+      else:
+        update_progress(offset/float(content_size))
+      if shaper is not None:
+        shaper.throttle(len(chunk))
       try:
+        connection.settimeout(profile.ack_timeout)
+        if unacked == 0:
+          sent_at = time.time()
         connection.sendall(chunk)
-        res = connection.recv(10)
+        unacked += len(chunk)
+        if unacked < profile.window * profile.chunk_size and offset < end:
+          continue
+        res = _wait(connection, profile.ack_timeout, cancel, lambda: connection.recv(ack_size))
+        if shaper is not None:
+          shaper.record_ack(time.time() - sent_at, unacked)
+        unacked = 0
+        record('ack', offset)
         lastResponseContainedOK = 'OK' in res.decode()
+        if lastResponseContainedOK:
+          record('result', 'OK')
       except:
+        cancel.check()
         sys.stderr.write('\n')
         logging.error('Error Uploading')
         connection.close()
-        f.close()
-        sock.close()
         return 1
+    if sample is not None:
+      # a windowed sender runs ahead of the device; the sample only counts once
+      # the device has read it all and closed the connection on end of data
+      connection.shutdown(socket.SHUT_WR)
+      try:
+        while _wait(connection, profile.ack_timeout, cancel, lambda: connection.recv(1024)):
+          pass
+      except:
+        cancel.check()
+    timings['transfer'] = time.time() - transfer_start
+
+    if sample is not None:
+      sys.stderr.write('\n')
+      logging.info('Calibration sample of %d bytes sent', offset)
+      connection.close()
+      return 0
 
     if lastResponseContainedOK:
       logging.info('Success')
       connection.close()
-      f.close()
-      sock.close()
       return 0
 
     sys.stderr.write('\n')
     logging.info('Waiting for result...')
+    result_start = time.time()
     try:
       count = 0
       while True:
         count=count+1
-        connection.settimeout(60)
-        data = connection.recv(32).decode()
+        data = _wait(connection, profile.result_timeout, cancel, lambda: connection.recv(32)).decode()
+        if data.isdigit():
+          # late acks of a windowed transfer
+          count=count-1
+          continue
+        record('result', data)
         logging.info('Result: %s' ,data)
 
         if "OK" in data:
+          timings['result'] = time.time() - result_start
           logging.info('Success')
           connection.close()
-          f.close()
-          sock.close()
           return 0;
         if count == 5:
           logging.error('Error response from device')
           connection.close()
-          f.close()
-          sock.close()
           return 1
-    except e:
+    except:
+      cancel.check()
       logging.error('No Result!')
       connection.close()
-      f.close()
-      sock.close()
       return 1
 
   finally:
     connection.close()
-    f.close()
 
-  sock.close()
   return 1
 # end serve
 
@@ -250,9 +446,15 @@ def parser(unparsed_args):
   group.add_option("-I", "--host_ip",
     dest = "host_ip",
     action = "store",
-    help = "Host IP Address.",
+    help = "Host IP Address. By default the invitation races over every plausible interface.",
     default = "0.0.0.0"
   )
+  group.add_option("--single-route",
+    dest = "race",
+    action = "store_false",
+    help = "Send the invitation over the interface the routing table picks only.",
+    default = True
+  )
   group.add_option("-p", "--port",
     dest = "esp_port",
     type = "int",
@@ -262,8 +464,8 @@ def parser(unparsed_args):
   group.add_option("-P", "--host_port",
     dest = "host_port",
     type = "int",
-    help = "Host server ota Port. Default random 10000-60000",
-    default = random.randint(10000,60000)
+    help = "Host server ota Port. Default: a free port",
+    default = 0
   )
   parser.add_option_group(group)
 
@@ -271,7 +473,7 @@ def parser(unparsed_args):
   group = optparse.OptionGroup(parser, "Authentication")
   group.add_option("-a", "--auth",
     dest = "auth",
-    help = "Set authentication password.",
+    help = "Set authentication password. Defaults to the password stored for the host.",
     action = "store",
     default = ""
   )
@@ -291,6 +493,49 @@ def parser(unparsed_args):
     help = "Use this option to transmit a SPIFFS image and do not flash the module.",
     default = False
   )
+  group.add_option("--delta",
+    dest = "delta",
+    action = "store_true",
+    help = "Send only the changes against the firmware last flashed, if it is archived (needs firmware that accepts deltas). Falls back to the full image.",
+    default = False
+  )
+  parser.add_option_group(group)
+
+  # transfer
+  group = optparse.OptionGroup(parser, "Transfer")
+  group.add_option("--rate",
+    dest = "rate",
+    type = "int",
+    help = "Limit upload bandwidth to RATE KB/s. Lowered automatically when acks slow down. Default unlimited",
+    default = 0
+  )
+  group.add_option("--no-profile",
+    dest = "profile",
+    action = "store_false",
+    help = "Ignore the transport profile tuned for this host (see autotune) and use the defaults.",
+    default = True
+  )
+  parser.add_option_group(group)
+
+  # history
+  group = optparse.OptionGroup(parser, "History")
+  group.add_option("--history",
+    dest = "history",
+    help = "Append the result and phase timings of this upload to the history database FILE.",
+    metavar = "FILE",
+    default = None
+  )
+  group.add_option("--release",
+    dest = "release",
+    help = "Release tag of the image, stored in the upload history.",
+    default = ""
+  )
+  group.add_option("--record",
+    dest = "record",
+    help = "Write a timestamped trace of the protocol exchange to FILE (.gz to compress), see 'trace replay'.",
+    metavar = "FILE",
+    default = None
+  )
   parser.add_option_group(group)
 
   # output group
@@ -321,6 +566,64 @@ def parser(unparsed_args):
 # end parser
 
 
+class LastError(logging.Handler):
+  # Remembers the last error logged, to store it with the upload history
+  def __init__(self):
+    logging.Handler.__init__(self, logging.ERROR)
+    self.message = ''
+
+  def emit(self, record):
+    self.message = record.getMessage()
+
+
+def record_history(options, command, result, timings, started, error, image):
+  try:
+    history = UploadHistory(options.history)
+    history.record(options.esp_ip, 'spiffs' if command == SPIFFS else 'app',
+      'success' if result == 0 else 'failed', timings, release_tag = options.release,
+      image_path = os.path.abspath(options.image), image_digest = image.md5, size = image.size,
+      error = '' if result == 0 else error, started = started)
+    history.close()
+  except Exception as e:
+    logging.warning('Could not record upload history: %s', e)
+
+
+# serve_delta() : Sends a delta against the firmware the inventory says the
+## device runs, if that image is archived. Returns the result of serve(), or
+## None if there is no delta to send. A device not yet known to accept deltas
+## is only probed briefly. After a failure, timings are reset for the full
+## upload.
+def serve_delta(target, options, inventory, image, timings, share, profile, trace, routes):
+  device = inventory.get(options.esp_ip)
+  if (device is not None and device.deltas is False):
+    logging.info('The firmware of %s does not accept deltas, sending the full image', options.esp_ip)
+    return None
+  try:
+    plan = plan_delta(FirmwareArchive(), device.firmware_digest if device is not None else '', image)
+  except (IOError, OSError) as e:
+    logging.warning('Cannot make a delta: %s', e)
+    return None
+  if (plan is None):
+    logging.info('No delta worth sending (base firmware unknown or not archived), sending the full image')
+    return None
+  logging.info('Sending a %d byte delta from %s instead of %d bytes (%.0f%% less)', plan.size, plan.base_md5, image.size, plan.saved * 100)
+  try:
+    patch = ota_images.registry.acquire(plan.path)
+  except (IOError, OSError) as e:
+    logging.warning('Cannot read the delta: %s', e)
+    return None
+  try:
+    result = serve(target, options.host_ip, options.esp_port, options.host_port, options.auth, plan.path, DELTA, timings = timings, image = patch, shaper = share, profile = profile, trace = trace, delta = plan.invitation(), routes = routes, probe = device is None or device.deltas is None)
+  finally:
+    ota_images.registry.release(patch)
+  if (result in (0, DELTA_REFUSED)):
+    inventory.record_deltas(options.esp_ip, True)
+  if (result != 0):
+    logging.warning('Delta upload failed, sending the full image')
+    timings.clear()
+  return result
+
+
 def main(args):
   options = parser(args)
   loglevel = logging.WARNING
@@ -341,11 +644,89 @@ def main(args):
     logging.critical("Not enough arguments.")
     return 1
 
+  # fall back to a password remembered for this host
+  inventory = DeviceInventory()
+  if (not options.auth):
+    options.auth = CredentialStore().get(inventory.credential_key(options.esp_ip), "")
+
+  # resolve once, through the inventory's cache, instead of on every packet
+  try:
+    target = inventory.resolve(options.esp_ip)
+  except (socket.error, OSError) as e:
+    logging.critical('Cannot resolve %s: %s', options.esp_ip, e)
+    return 1
+
+  # the device connects back to the interface whose invitation it answers
+  routes = None
+  if (options.host_ip != '0.0.0.0'):
+    routes = RoutePlan([Route(options.host_ip, options.host_ip)])
+  elif (options.race):
+    device = inventory.get(options.esp_ip)
+    routes = plan_routes(target, device.route if device is not None else None)
+    logging.debug('Routes to %s: %s', target, routes)
+
   command = FLASH
   if (options.spiffs):
     command = SPIFFS
 
-  return serve(options.esp_ip, options.host_ip, options.esp_port, options.host_port, options.auth, options.image, command)
+  try:
+    image = ota_images.registry.acquire(options.image)
+  except (IOError, OSError) as e:
+    logging.critical('Cannot read image: %s', e)
+    return 1
+
+  profiles = ProfileStore()
+  profile = profiles.get(options.esp_ip) if options.profile else None
+  if (profile is not None):
+    logging.info('Using tuned transport profile: %s', profile.describe())
+
+  errors = LastError()
+  logging.getLogger().addHandler(errors)
+  scheduler = ota_shaping.BandwidthScheduler(options.rate * 1024)
+  share = scheduler.register(options.esp_ip)
+  timings = {}
+  started = time.time()
+  result = 1
+  delta_result = None
+  trace = ota_trace.SessionRecorder() if options.record else None
+  try:
+    if (options.delta and command == FLASH):
+      delta_result = result = serve_delta(target, options, inventory, image, timings, share, profile, trace, routes)
+    sent_delta = delta_result == 0
+    if (not sent_delta):
+      result = serve(target, options.host_ip, options.esp_port, options.host_port, options.auth, options.image, command, timings = timings, image = image, shaper = share, profile = profile, trace = trace, routes = routes)
+      if (result == 0 and delta_result == DELTA_UNANSWERED):
+        # the device took the image but ignored the delta invitation
+        inventory.record_deltas(options.esp_ip, False)
+    if (result == 0 and options.delta and command == FLASH):
+      # the base of the next delta
+      try:
+        FirmwareArchive().add(options.image, options.release, image.md5)
+      except (IOError, OSError) as e:
+        logging.warning('Could not archive the image: %s', e)
+    if (result == 0 and not sent_delta and profile is not None and timings.get('transfer') and
+        profiles.check_throughput(options.esp_ip, image.size / (timings['transfer'] + timings.get('result', 0)))):
+      logging.warning('Throughput far below the tuned profile; espota.py does not tune on its own, run'
+                      ' "clevercoffee_ota_flasher.py autotune %s" to tune it again', options.esp_ip)
+    if (result == 0):
+      inventory.record_upload(options.esp_ip, 'spiffs' if command == SPIFFS else 'app', image.md5, profile)
+      if (options.host_ip == '0.0.0.0' and routes is not None and routes.winner is not None):
+        inventory.record_route(options.esp_ip, routes.winner)
+    return result
+  finally:
+    stats = share.stats()
+    logging.info('Throughput: %.1f KB/s (allotted %s)', stats['achieved'] / 1024,
+      '%.1f KB/s' % (stats['allotted'] / 1024) if stats['allotted'] else 'unlimited')
+    scheduler.unregister(share)
+    if (options.history):
+      record_history(options, command, result, timings, started, errors.message, image)
+    if (trace is not None):
+      try:
+        trace.save(options.record)
+        logging.info('Session trace written to %s', options.record)
+      except (IOError, OSError) as e:
+        logging.warning('Could not write the session trace: %s', e)
+    ota_images.registry.release(image)
 # end main
 
 
@@ -0,0 +1,190 @@
+import argparse
+import hashlib
+import itertools
+import logging
+import os
+import statistics
+import sys
+import time
+
+import espota
+from ota_cancel import CancelToken, Cancelled
+from ota_credentials import CredentialStore
+from ota_inventory import DeviceInventory
+from ota_preflight import ESP_IMAGE_MAGIC, resolve_host
+from ota_profiles import DEFAULT_PROFILE, ProfileStore
+
+
+# Bytes sent per calibration transfer, and the image size announced to the device
+SAMPLE_SIZE = 256 * 1024
+DECLARED_SIZE = 1024 * 1024
+# Settings tried, in the order they are tuned
+SEARCH_SPACE = (
+    ("chunk_size", (1024, 1460, 2920, 4096)),
+    ("window", (1, 2, 4, 8)),
+    ("send_buffer", (0, 16 * 1024, 64 * 1024)),
+    ("nodelay", (False, True)),
+)
+# A setting must be this much faster to replace the current best
+MIN_GAIN = 0.05
+# Pause between calibration transfers so the device is back to idle
+PAUSE = 1.0
+# Seconds a calibration may take; settings not tried by then keep their best value so far
+BUDGET = 60
+
+
+class CalibrationImage:
+    """Random payload that looks like an application image to the device
+
+    Calibration transfers are cut off after the sample, so the device never
+    completes (or flashes) it; the app partition is used because an aborted
+    transfer there only touches the inactive OTA slot.
+    """
+
+    def __init__(self, size: int = DECLARED_SIZE):
+        self.path = "calibration.bin"
+        self.data = memoryview(bytes([ESP_IMAGE_MAGIC]) + os.urandom(size - 1))
+        self.size = size
+        self.md5 = hashlib.md5(self.data).hexdigest()
+
+    def chunk(self, offset: int, length: int):
+        return self.data[offset:offset + length]
+
+
+def measure(target: str, port: int, password: str, profile, image: CalibrationImage, sample: int,
+            repeats: int = 1, cancel=None):
+    """Median throughput in bytes/s of calibration transfers with profile, None if they fail"""
+    results = []
+    for _ in range(repeats):
+        if cancel is not None and cancel.sleep(PAUSE if results else 0):
+            raise Cancelled()
+        timings = {}
+        result = espota.serve(target, "0.0.0.0", port, 0, password, image.path,
+                              espota.FLASH, timings=timings, image=image, cancel=cancel, profile=profile,
+                              sample=sample, progress=lambda fraction: None)
+        if cancel is not None:
+            cancel.check()
+        if result != 0 or not timings.get("transfer"):
+            return None
+        results.append(sample / timings["transfer"])
+    return statistics.median(results)
+
+
+def grid():
+    """Every combination of SEARCH_SPACE"""
+    names = [name for name, values in SEARCH_SPACE]
+    for values in itertools.product(*[values for name, values in SEARCH_SPACE]):
+        yield DEFAULT_PROFILE.replace(**dict(zip(names, values)))
+
+
+def autotune(host: str, port: int = 3232, password: str = "", target: str = None, sample: int = SAMPLE_SIZE,
+             repeats: int = 1, full: bool = False, store: ProfileStore = None, cancel=None, log=print,
+             budget: float = BUDGET):
+    """Find the fastest transport profile for host and save it
+
+    Runs short calibration transfers with the settings of SEARCH_SPACE,
+    tuning one setting at a time (or trying every combination with full).
+    After budget seconds (0 = no limit) the best profile found so far is
+    kept. target is the address to connect to, host the name the profile
+    is saved under. Returns the best profile; raises IOError if the device
+    does not take calibration transfers at all.
+    """
+    store = store or ProfileStore()
+    cancel = CancelToken(cancel)
+    target = target or resolve_host(host)
+    image = CalibrationImage(max(DECLARED_SIZE, sample * 2))
+    deadline = time.time() + budget if budget else None
+    skipped = [0]
+
+    try:
+        baseline = measure(target, port, password, DEFAULT_PROFILE, image, sample, repeats, cancel)
+        if baseline is None:
+            raise IOError(f"Calibration transfer to {host} failed")
+        log(f"   {DEFAULT_PROFILE.describe()}: {baseline / 1024:.1f} KB/s")
+
+        best = [DEFAULT_PROFILE, baseline]
+
+        def attempt(profile):
+            if profile == best[0]:
+                return
+            if deadline is not None and time.time() >= deadline:
+                skipped[0] += 1
+                return
+            if cancel.sleep(PAUSE):
+                raise Cancelled()
+            throughput = measure(target, port, password, profile, image, sample, repeats, cancel)
+            if throughput is None:
+                log(f"   {profile.describe()}: failed")
+                return
+            log(f"   {profile.describe()}: {throughput / 1024:.1f} KB/s")
+            if throughput > best[1] * (1 + MIN_GAIN):
+                best[:] = [profile, throughput]
+
+        if full:
+            for profile in grid():
+                attempt(profile)
+        else:
+            # Coordinate search: tune one setting at a time, keeping the best of the others
+            for name, values in SEARCH_SPACE:
+                for value in values:
+                    attempt(best[0].replace(**{name: value}))
+    finally:
+        cancel.close()
+
+    profile, throughput = best
+    if skipped[0]:
+        log(f"⏱️ Stopped after {budget:.0f} s, {skipped[0]} settings not tried")
+    store.mark_tuned(host, profile, throughput)
+    log(f"✅ Best for {host}: {profile.describe()} at {throughput / 1024:.1f} KB/s"
+        f" ({throughput / baseline:.1f}x the defaults)")
+    return store.get(host)
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="autotune", description="Tune the OTA transport settings for a device.")
+    parser.add_argument("host", nargs="?", help="ESP32 IP address or hostname")
+    parser.add_argument("-p", "--port", type=int, default=3232)
+    parser.add_argument("-a", "--auth", help="OTA password (default: the one stored for the host)")
+    parser.add_argument("--sample", type=int, default=SAMPLE_SIZE // 1024,
+                        help="KB sent per calibration transfer (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=1, help="Transfers per setting (default: %(default)s)")
+    parser.add_argument("--full", action="store_true", help="Try every combination instead of one setting at a time")
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="Seconds to spend at most, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--list", action="store_true", help="Show the saved profiles")
+    parser.add_argument("--forget", action="store_true", help="Drop the saved profile of the host")
+    options = parser.parse_args(args)
+
+    store = ProfileStore()
+    if options.list:
+        for host in store.hosts():
+            profile = store.get(host)
+            throughput = f"{profile.throughput / 1024:.1f} KB/s" if profile.throughput else "-"
+            print(f"{host:<20} {profile.describe():<60} {throughput:>12}{'  (stale)' if profile.stale else ''}")
+        return 0
+    if not options.host:
+        parser.error("a host is required")
+    if options.forget:
+        store.forget(options.host)
+        return 0
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)-8s [%(levelname)s]: %(message)s',
+                        datefmt='%H:%M:%S')
+    inventory = DeviceInventory()
+    password = options.auth if options.auth is not None else CredentialStore().get(
+        inventory.credential_key(options.host), "")
+    print(f"🔧 Calibrating {options.host}...")
+    try:
+        autotune(options.host, options.port, password, target=inventory.resolve(options.host),
+                 sample=options.sample * 1024, repeats=options.repeats, full=options.full, store=store,
+                 budget=options.budget)
+    except (IOError, OSError) as e:
+        print(f"❌ {str(e)}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,102 @@
+import socket
+import threading
+
+
+class Cancelled(Exception):
+    """Raised inside an operation whose cancel token was triggered"""
+
+
+class CancelToken:
+    """Cooperative cancellation shared by downloads and uploads
+
+    Sockets, files and HTTP responses registered with a token are closed as
+    soon as it is cancelled, so blocked calls return promptly. Child tokens
+    are cancelled together with their parent but close only their own
+    resources, which lets one token cover several concurrent uploads.
+    """
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._resources = []
+        self._children = set()
+        self._parent = parent
+        if parent is not None:
+            parent._adopt(self)
+
+    def _adopt(self, child):
+        with self._lock:
+            self._children.add(child)
+            cancelled = self._event.is_set()
+        if cancelled:
+            child.cancel()
+
+    def child(self):
+        """New token cancelled together with this one"""
+        return CancelToken(self)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancel the operation and release everything registered with it"""
+        self._event.set()
+        with self._lock:
+            resources = list(self._resources)
+            children = list(self._children)
+        for resource in resources:
+            _close_quietly(resource)
+        for child in children:
+            child.cancel()
+
+    def check(self):
+        """Raise Cancelled if the token has been cancelled"""
+        if self._event.is_set():
+            raise Cancelled()
+
+    def sleep(self, seconds: float) -> bool:
+        """Sleep up to seconds; returns True if cancelled meanwhile"""
+        return self._event.wait(seconds)
+
+    def register(self, resource):
+        """Close resource on cancel; returns it for convenient chaining"""
+        with self._lock:
+            self._resources.append(resource)
+        if self._event.is_set():
+            _close_quietly(resource)
+        return resource
+
+    def unregister(self, resource):
+        with self._lock:
+            if resource in self._resources:
+                self._resources.remove(resource)
+
+    def close(self):
+        """Release this token's resources and detach it from its parent"""
+        with self._lock:
+            resources = list(self._resources)
+            self._resources = []
+        for resource in resources:
+            _close_quietly(resource)
+        if self._parent is not None:
+            with self._parent._lock:
+                self._parent._children.discard(self)
+
+    def open_resources(self) -> int:
+        """Number of resources still registered (used to detect leaks)"""
+        with self._lock:
+            return len(self._resources) + sum(child.open_resources() for child in self._children)
+
+
+def _close_quietly(resource):
+    if isinstance(resource, socket.socket):
+        # shutdown() wakes up threads blocked in accept()/recv() on Linux
+        try:
+            resource.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        resource.close()
+    except Exception:
+        pass
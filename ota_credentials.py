@@ -0,0 +1,73 @@
+import threading
+
+try:
+    import keyring
+    HAS_KEYRING = True
+except ImportError:
+    HAS_KEYRING = False
+
+
+KEYRING_SERVICE = "clevercoffee-ota"
+
+
+def normalize_host(host: str) -> str:
+    """Normalize a hostname/IP so lookups are case and whitespace insensitive"""
+    return host.strip().lower().rstrip('.')
+
+
+class CredentialStore:
+    """OTA passwords keyed by host, kept in memory and optionally in the OS keyring"""
+
+    def __init__(self, use_keyring: bool = True):
+        self._passwords = {}
+        self._lock = threading.Lock()
+        self.use_keyring = use_keyring and HAS_KEYRING
+
+    def get(self, host: str, default=None):
+        """Return the stored password for host, or default if none is known"""
+        key = normalize_host(host)
+        with self._lock:
+            if key in self._passwords:
+                return self._passwords[key]
+
+        if self.use_keyring:
+            try:
+                password = keyring.get_password(KEYRING_SERVICE, key)
+            except Exception:
+                # A broken or locked keyring backend must never block an upload
+                password = None
+            if password is not None:
+                with self._lock:
+                    self._passwords[key] = password
+                return password
+
+        return default
+
+    def set(self, host: str, password: str):
+        """Remember the password for host"""
+        key = normalize_host(host)
+        with self._lock:
+            self._passwords[key] = password
+
+        if self.use_keyring:
+            try:
+                keyring.set_password(KEYRING_SERVICE, key, password)
+            except Exception:
+                pass
+
+    def forget(self, host: str):
+        """Drop the stored password for host"""
+        key = normalize_host(host)
+        with self._lock:
+            self._passwords.pop(key, None)
+
+        if self.use_keyring:
+            try:
+                keyring.delete_password(KEYRING_SERVICE, key)
+            except Exception:
+                pass
+
+    def hosts(self):
+        """Hosts with a password cached in memory"""
+        with self._lock:
+            return sorted(self._passwords)
@@ -0,0 +1,390 @@
+import argparse
+import hmac
+import json
+import logging
+import os
+import queue
+import secrets
+import sys
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+
+from ota_engine import UploadEngine
+from ota_listener import DEFAULT_CONNECT_PORT, DEFAULT_POOL_SIZE
+from ota_paths import get_data_directory
+
+
+DEFAULT_API_PORT = 8266
+DEFAULT_API_HOST = "127.0.0.1"
+
+
+def get_token_path():
+    return get_data_directory() / "daemon_token"
+
+
+def read_api_token():
+    """Token the daemon of this user accepts, None if it never ran"""
+    try:
+        return get_token_path().read_text().strip() or None
+    except OSError:
+        return None
+
+
+def create_api_token() -> str:
+    """Token of the daemon, created on its first start and readable by this user only"""
+    token = read_api_token()
+    if token:
+        return token
+    token = secrets.token_urlsafe(32)
+    path = get_token_path()
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def api_headers() -> dict:
+    """Headers authenticating a client of the daemon API"""
+    token = read_api_token()
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+def prometheus_label(value) -> str:
+    """Escape a label value for the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Local JSON API of the flasher daemon
+
+    GET    /jobs          list jobs
+    POST   /jobs          submit {"host", "firmware", "filesystem", "password", "port", "release", "skip_unchanged"}
+    GET    /jobs/<id>     one job
+    DELETE /jobs/<id>     cancel a job
+    POST   /batches       submit {"jobs": [{"host", "firmware", "filesystem", "password", "port"}, ...],
+                          "release", "skip_unchanged"}; jobs start as their images are prepared
+    GET    /devices       the device inventory
+    GET    /events        newline-delimited JSON stream of progress events
+    GET    /metrics       engine metrics in the Prometheus text format
+
+    Every request needs the token of the daemon's data directory as
+    "Authorization: Bearer <token>". Requests from web pages (with an
+    Origin header) are refused, and request bodies must be
+    application/json, so a browser on the machine cannot submit jobs.
+    """
+
+    server_version = "CleverCoffeeOta/1"
+
+    @property
+    def engine(self) -> UploadEngine:
+        return self.server.engine
+
+    def log_message(self, format, *args):
+        logging.debug("API %s - %s", self.address_string(), format % args)
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self) -> bool:
+        """Check the request comes from a local client of this user; answers it if not"""
+        if self.headers.get("Origin"):
+            self.send_json(403, {"error": "cross-origin requests are not accepted"})
+            return False
+        scheme, _, token = self.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), self.server.token.encode()):
+            self.send_json(401, {"error": f"missing or wrong token, see {get_token_path()}"})
+            return False
+        return True
+
+    def job_id(self):
+        try:
+            return int(self.path.rstrip("/").rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == "/jobs":
+            self.send_json(200, [job.to_dict() for job in self.engine.jobs()])
+        elif self.path.startswith("/jobs/"):
+            job = self.engine.get(self.job_id())
+            if job is None:
+                self.send_json(404, {"error": "no such job"})
+            else:
+                self.send_json(200, job.to_dict())
+        elif self.path == "/events":
+            self.stream_events()
+        elif self.path == "/metrics":
+            self.send_metrics()
+        elif self.path == "/devices":
+            self.send_json(200, [device.to_dict() for device in self.engine.inventory.devices()])
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path not in ("/jobs", "/batches"):
+            self.send_json(404, {"error": "not found"})
+            return
+        if self.headers.get("Content-Type", "").split(";", 1)[0].strip().lower() != "application/json":
+            self.send_json(415, {"error": "the body must be application/json"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            release = request.get("release")
+            release = tuple(release) if release else None
+            skip_unchanged = bool(request.get("skip_unchanged"))
+            if self.path == "/batches":
+                jobs = self.engine.submit_batch([{"host": target["host"], "images": request_images(target),
+                                                  "password": target.get("password"), "port": target.get("port")}
+                                                 for target in request["jobs"]],
+                                                release=release, skip_unchanged=skip_unchanged)
+            else:
+                job = self.engine.submit(request["host"], request_images(request), password=request.get("password"),
+                                         port=request.get("port"), release=release, skip_unchanged=skip_unchanged)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        if self.path == "/batches":
+            self.send_json(201, [job.to_dict() for job in jobs])
+        else:
+            self.send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        if not self.path.startswith("/jobs/"):
+            self.send_json(404, {"error": "not found"})
+        elif self.engine.get(self.job_id()) is None:
+            self.send_json(404, {"error": "no such job"})
+        else:
+            self.send_json(200, {"cancelled": self.engine.cancel(self.job_id())})
+
+    def stream_events(self):
+        events = self.engine.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.close_connection = True
+            while not self.server.closing:
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    # Keep-alive so dead clients are noticed
+                    event = {"type": "heartbeat"}
+                self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.engine.unsubscribe(events)
+
+    def send_metrics(self):
+        metrics = self.engine.metrics()
+        lines = [
+            f"clevercoffee_ota_uptime_seconds {metrics['uptime_seconds']:.1f}",
+            f"clevercoffee_ota_workers {metrics['workers']}",
+            f"clevercoffee_ota_bytes_sent_total {metrics['bytes_sent']}",
+            f"clevercoffee_ota_images_loaded {metrics['images_loaded']}",
+            f"clevercoffee_ota_image_bytes {metrics['image_bytes']}",
+            f"clevercoffee_ota_resolved_hosts {metrics['resolved_hosts']}",
+        ]
+        for state, count in sorted(metrics["jobs"].items()):
+            lines.append(f'clevercoffee_ota_jobs{{state="{prometheus_label(state)}"}} {count}')
+        for transfer in metrics["transfers"]:
+            lines.append(f'clevercoffee_ota_transfer_bytes_per_second{{host="{prometheus_label(transfer["host"])}"}}'
+                         f' {transfer["achieved"]:.1f}')
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def request_images(request: dict) -> dict:
+    images = {}
+    if request.get("firmware"):
+        images["app"] = request["firmware"]
+    if request.get("filesystem"):
+        images["spiffs"] = request["filesystem"]
+    return images
+
+
+class DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine: UploadEngine, token: str):
+        super().__init__(address, ApiHandler)
+        self.engine = engine
+        self.token = token
+        self.closing = False
+
+    def server_close(self):
+        self.closing = True
+        super().server_close()
+
+
+def api_request(url: str, method: str = "GET", body=None):
+    """Call the daemon API and decode its JSON answer"""
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method,
+                                     headers={"Content-Type": "application/json", **api_headers()})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except HTTPError as e:
+        answer = json.loads(e.read().decode("utf-8") or "{}")
+        if e.code in (401, 403):
+            raise PermissionError(answer.get("error", e.reason))
+        return answer
+
+
+def print_job(job: dict):
+    progress = f"{job['bytes_sent'] * 100 // job['bytes_total']}%" if job["bytes_total"] else "-"
+    print(f"{job['id']:>5}  {job['host']:<20} {job['state']:<10} {progress:>5}  {job['error']}")
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="daemon", description="Run or talk to the flasher daemon.")
+    parser.add_argument("--api", default=f"{DEFAULT_API_HOST}:{DEFAULT_API_PORT}",
+                        help="Address of the daemon API (default: %(default)s)")
+    sub = parser.add_subparsers(dest="action")
+    sub.required = True
+    serve = sub.add_parser("serve", help="Run the daemon")
+    serve.add_argument("-w", "--workers", type=int, default=4, help="Concurrent uploads (default: %(default)s)")
+    serve.add_argument("--rate", type=int, default=0, help="Global bandwidth limit in KB/s (default: unlimited)")
+    serve.add_argument("--record", metavar="DIR", help="Write a session trace of every upload to DIR")
+    serve.add_argument("--connect-port", type=int, default=DEFAULT_CONNECT_PORT,
+                       help="First port devices connect back to; open it and the next %d in the firewall"
+                            " (default: %%(default)s)" % (DEFAULT_POOL_SIZE - 1))
+    serve.add_argument("--delta", action="store_true",
+                       help="Send firmware as a delta to the image a device last got, where it accepts deltas")
+    submit = sub.add_parser("submit", help="Queue an upload")
+    submit.add_argument("hosts", nargs="*", metavar="host", help="Hosts or inventory device names")
+    submit.add_argument("--all", action="store_true", help="Flash every device of the inventory")
+    submit.add_argument("--batch", metavar="FILE",
+                        help="Rollout plan with one 'host firmware [filesystem]' line per device")
+    submit.add_argument("-f", "--firmware")
+    submit.add_argument("-s", "--filesystem")
+    submit.add_argument("-a", "--auth", help="OTA password (default: the one stored for the host)")
+    submit.add_argument("-p", "--port", type=int, help="OTA port (default: the inventory's, else 3232)")
+    submit.add_argument("--skip-unchanged", action="store_true",
+                        help="Skip images identical to the last successful upload to the host")
+    sub.add_parser("jobs", help="List jobs")
+    cancel = sub.add_parser("cancel", help="Cancel a job")
+    cancel.add_argument("job", type=int)
+    sub.add_parser("events", help="Follow progress events")
+    sub.add_parser("metrics", help="Show engine metrics")
+    sub.add_parser("devices", help="List the device inventory")
+    options = parser.parse_args(args)
+
+    host, _, port = options.api.rpartition(":")
+    base_url = f"http://{host or DEFAULT_API_HOST}:{port}"
+
+    try:
+        if options.action == "serve":
+            logging.basicConfig(level=logging.INFO, format='%(asctime)-8s [%(levelname)s]: %(message)s',
+                                datefmt='%H:%M:%S')
+            engine = UploadEngine(workers=options.workers, rate=options.rate * 1024, trace_dir=options.record,
+                                  connect_port=options.connect_port, delta=options.delta)
+            server = DaemonServer((host or DEFAULT_API_HOST, int(port)), engine, create_api_token())
+            logging.info("Flasher daemon listening on %s", base_url)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                engine.shutdown()
+        elif options.action == "submit" and options.batch:
+            targets = []
+            with open(options.batch) as f:
+                for line in f:
+                    fields = line.split("#", 1)[0].split()
+                    if not fields:
+                        continue
+                    if len(fields) not in (2, 3):
+                        parser.error(f"bad line in {options.batch}: {line.strip()}")
+                    # Paths in the plan are relative to it, "-" skips the partition
+                    paths = [os.path.join(os.path.dirname(os.path.abspath(options.batch)), path)
+                             if path != "-" else None for path in fields[1:] + ["-"]]
+                    targets.append({"host": fields[0], "firmware": paths[0], "filesystem": paths[1],
+                                    "password": options.auth, "port": options.port})
+            jobs = api_request(f"{base_url}/batches", "POST", {"jobs": targets,
+                                                               "skip_unchanged": options.skip_unchanged})
+            if isinstance(jobs, dict):
+                print(f"❌ {jobs.get('error')}", file=sys.stderr)
+                return 1
+            for job in jobs:
+                print_job(job)
+        elif options.action == "submit":
+            if not options.firmware and not options.filesystem:
+                parser.error("submit needs --firmware and/or --filesystem")
+            hosts = list(options.hosts)
+            if options.all:
+                hosts += [device["name"] for device in api_request(f"{base_url}/devices")]
+            if not hosts:
+                parser.error("submit needs a host or --all")
+            failed = False
+            for host in hosts:
+                # The daemon may run in another directory
+                job = api_request(f"{base_url}/jobs", "POST", {
+                    "host": host,
+                    "firmware": os.path.abspath(options.firmware) if options.firmware else None,
+                    "filesystem": os.path.abspath(options.filesystem) if options.filesystem else None,
+                    "password": options.auth, "port": options.port, "skip_unchanged": options.skip_unchanged})
+                if "id" not in job:
+                    # An error answer; jobs carry an (empty) error field too
+                    print(f"❌ {host}: {job.get('error')}", file=sys.stderr)
+                    failed = True
+                    continue
+                print_job(job)
+            if failed:
+                return 1
+        elif options.action == "jobs":
+            for job in api_request(f"{base_url}/jobs"):
+                print_job(job)
+        elif options.action == "cancel":
+            print(api_request(f"{base_url}/jobs/{options.job}", "DELETE"))
+        elif options.action == "events":
+            with urllib.request.urlopen(urllib.request.Request(f"{base_url}/events", headers=api_headers())) as response:
+                for line in response:
+                    event = json.loads(line)
+                    if event["type"] == "log":
+                        print(f"[{event['job']} {event['host']}] {event['message']}")
+                    elif event["type"] != "heartbeat":
+                        print(json.dumps(event))
+        elif options.action == "devices":
+            for device in api_request(f"{base_url}/devices"):
+                print(f"{device['name']:<20} {device['hostname'] + ':' + str(device['port']):<28}"
+                      f" {device['ip'] or '-':<16} app {device['firmware_digest'][:8] or '-':<8}"
+                      f"  fs {device['filesystem_digest'][:8] or '-'}")
+        elif options.action == "metrics":
+            with urllib.request.urlopen(urllib.request.Request(f"{base_url}/metrics", headers=api_headers()),
+                                        timeout=10) as response:
+                print(response.read().decode("utf-8"), end="")
+    except (URLError, ConnectionError) as e:
+        print(f"Cannot reach the flasher daemon at {base_url}: {e}", file=sys.stderr)
+        return 1
+    except PermissionError as e:
+        print(f"The flasher daemon at {base_url} refused the request: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,409 @@
+import json
+import logging
+import math
+import queue
+import threading
+import time
+import tkinter as tk
+import urllib.request
+from tkinter import ttk
+from urllib.error import URLError
+
+from ota_cancel import CancelToken
+import ota_daemon
+import ota_engine
+
+
+# Fastest the view is redrawn; events arriving in between are folded into one update per row
+REFRESH_INTERVAL = 0.1
+# Time constant of the smoothed per-device throughput, in seconds
+THROUGHPUT_WINDOW = 3.0
+# Rows kept; beyond that the oldest finished devices are dropped
+MAX_ROWS = 5000
+# Used when the theme does not say how high a Treeview row is
+DEFAULT_ROW_HEIGHT = 20
+
+COLUMNS = (
+    ("device", "Device", 170),
+    ("phase", "Phase", 110),
+    ("progress", "Progress", 150),
+    ("throughput", "Throughput", 90),
+    ("eta", "ETA", 60),
+    ("retries", "Retries", 55),
+    ("result", "Result", 220),
+)
+
+
+def format_bytes(count: int) -> str:
+    if count >= 1024 * 1024:
+        return f"{count / 1024 / 1024:.1f} MB"
+    return f"{count / 1024:.0f} KB"
+
+
+def format_duration(seconds) -> str:
+    if seconds is None or math.isinf(seconds):
+        return "-"
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class DeviceRow:
+    """Upload state of one device (job) as shown in a dashboard row"""
+
+    def __init__(self, job: int, host: str):
+        self.job = job
+        self.host = host
+        self.phase = ota_engine.QUEUED
+        self.bytes_sent = 0
+        self.bytes_total = 0
+        self.throughput = 0.0           # bytes/s, smoothed
+        self.retries = 0
+        self.result = ""
+        self._sample = None             # (time, bytes_sent) of the previous progress event
+
+    @property
+    def finished(self) -> bool:
+        return self.phase in ota_engine.FINISHED_STATES
+
+    def add_sample(self, now: float, bytes_sent: int):
+        if self._sample is not None and now > self._sample[0] and bytes_sent >= self._sample[1]:
+            elapsed = now - self._sample[0]
+            rate = (bytes_sent - self._sample[1]) / elapsed
+            weight = 1 - math.exp(-elapsed / THROUGHPUT_WINDOW) if self.throughput else 1
+            self.throughput += weight * (rate - self.throughput)
+        self._sample = (now, bytes_sent)
+        self.bytes_sent = bytes_sent
+
+    def eta(self):
+        if self.finished or not self.throughput or not self.bytes_total:
+            return None
+        return max(0, self.bytes_total - self.bytes_sent) / self.throughput
+
+    def values(self) -> tuple:
+        if self.bytes_total:
+            progress = (f"{format_bytes(self.bytes_sent)} / {format_bytes(self.bytes_total)}"
+                        f" ({self.bytes_sent * 100 // self.bytes_total}%)")
+        else:
+            progress = "-"
+        active = self.phase.startswith(ota_engine.UPLOADING)
+        return (self.host, self.phase, progress,
+                f"{self.throughput / 1024:.1f} KB/s" if active and self.throughput else "-",
+                format_duration(self.eta()), self.retries or "", self.result)
+
+
+class FleetModel:
+    """Dashboard rows folded from engine events, one per job; safe to feed from any thread
+
+    apply() only updates the row and marks it as changed, so a device
+    sending many progress events between two redraws costs a single row
+    update on screen. changes() hands the changed rows to the view.
+    """
+
+    def __init__(self, max_rows: int = MAX_ROWS):
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._rows = {}                 # job id -> DeviceRow
+        self._order = []                # job ids in display order
+        self._dirty = set()
+        self._reordered = False
+        self._counts = {}               # phase -> rows in it
+        self.events = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._order)
+
+    def _row(self, job: int, host: str) -> DeviceRow:
+        row = self._rows.get(job)
+        if row is None:
+            row = self._rows[job] = DeviceRow(job, host)
+            self._order.append(job)
+            self._counts[row.phase] = self._counts.get(row.phase, 0) + 1
+            self._reordered = True
+            if len(self._order) > self.max_rows:
+                self._drop_finished(len(self._order) - self.max_rows)
+        return row
+
+    def _set_phase(self, row: DeviceRow, phase: str):
+        if phase != row.phase:
+            self._counts[row.phase] -= 1
+            self._counts[phase] = self._counts.get(phase, 0) + 1
+            row.phase = phase
+
+    def _drop_finished(self, count: int):
+        dropped = set()
+        for job in self._order:
+            if len(dropped) >= count:
+                break
+            if self._rows[job].finished:
+                dropped.add(job)
+        for job in dropped:
+            row = self._rows.pop(job)
+            self._counts[row.phase] -= 1
+        self._order = [job for job in self._order if job not in dropped]
+        self._dirty -= dropped
+        self._reordered = True
+
+    def apply(self, event: dict):
+        """Fold one engine event into its row"""
+        if "job" not in event:
+            return
+        with self._lock:
+            self.events += 1
+            row = self._row(event["job"], event.get("host", ""))
+            kind = event["type"]
+            if kind == "state":
+                state = event["state"]
+                if state == ota_engine.SUCCESS:
+                    row.result = "✅ OK"
+                elif state in (ota_engine.FAILED, ota_engine.CANCELLED):
+                    row.result = event.get("error") or state
+                if state != ota_engine.UPLOADING or not row.phase.startswith(ota_engine.UPLOADING):
+                    self._set_phase(row, state)
+            elif kind == "progress":
+                self._set_phase(row, f"{ota_engine.UPLOADING} {event['partition']}")
+                row.bytes_total = event.get("bytes_total") or row.bytes_total
+                row.add_sample(event.get("time") or time.time(), event.get("bytes_sent", 0))
+            elif kind == "partition":
+                row.retries += event.get("retries") or 0
+                if event.get("skipped"):
+                    row.result = f"{event['partition']} unchanged"
+            else:
+                return
+            self._dirty.add(row.job)
+
+    def load_jobs(self, jobs):
+        """Add rows for jobs (as returned by UploadJob.to_dict()) that started before the events were followed"""
+        for job in sorted(jobs, key=lambda job: job["id"]):
+            with self._lock:
+                row = self._row(job["id"], job["host"])
+                state = job["state"]
+                if state == ota_engine.UPLOADING and job.get("partition"):
+                    state = f"{ota_engine.UPLOADING} {job['partition']}"
+                self._set_phase(row, state)
+                row.bytes_sent, row.bytes_total = job["bytes_sent"], job["bytes_total"]
+                row.retries = sum(timings.get("retries") or 0 for timings in job["timings"].values())
+                if job["state"] == ota_engine.SUCCESS:
+                    row.result = "✅ OK"
+                elif job["state"] in ota_engine.FINISHED_STATES:
+                    row.result = job["error"] or job["state"]
+                self._dirty.add(row.job)
+
+    def clear(self, finished_only: bool = False):
+        with self._lock:
+            if finished_only:
+                self._drop_finished(len(self._order))
+            else:
+                self._rows, self._order, self._counts = {}, [], {}
+                self._dirty.clear()
+                self._reordered = True
+
+    def changes(self):
+        """(reordered, ids of changed rows) since the last call"""
+        with self._lock:
+            reordered, dirty = self._reordered, self._dirty
+            self._reordered, self._dirty = False, set()
+        return reordered, dirty
+
+    def ids(self, start: int, count: int) -> list:
+        with self._lock:
+            return self._order[start:start + count]
+
+    def values(self, job: int) -> tuple:
+        with self._lock:
+            row = self._rows.get(job)
+            return row.values() if row is not None else ()
+
+    def summary(self) -> str:
+        with self._lock:
+            counts = {phase: count for phase, count in self._counts.items() if count}
+            uploading = sum(count for phase, count in counts.items() if phase.startswith(ota_engine.UPLOADING))
+            throughput = sum(row.throughput for row in self._rows.values()
+                             if row.phase.startswith(ota_engine.UPLOADING)) if uploading else 0
+            parts = [f"{len(self._order)} devices"]
+        for phase in (ota_engine.QUEUED, ota_engine.PREFLIGHT):
+            if counts.get(phase):
+                parts.append(f"{counts[phase]} {phase}")
+        if uploading:
+            parts.append(f"{uploading} uploading at {throughput / 1024:.0f} KB/s")
+        for phase in ota_engine.FINISHED_STATES:
+            if counts.get(phase):
+                parts.append(f"{counts[phase]} {phase}")
+        return " · ".join(parts)
+
+
+def follow_engine(model: FleetModel, engine, cancel: CancelToken) -> threading.Thread:
+    """Feed model with the jobs and events of a local UploadEngine until cancel"""
+
+    def run():
+        events = engine.subscribe()
+        try:
+            model.load_jobs(job.to_dict() for job in engine.jobs())
+            while not cancel.cancelled:
+                try:
+                    model.apply(events.get(timeout=0.5))
+                except queue.Empty:
+                    pass
+        finally:
+            engine.unsubscribe(events)
+
+    thread = threading.Thread(target=run, name="ota-dashboard", daemon=True)
+    thread.start()
+    return thread
+
+
+def follow_daemon(model: FleetModel, base_url: str, cancel: CancelToken, log=logging.warning) -> threading.Thread:
+    """Feed model with the jobs and event stream of a flasher daemon until cancel"""
+
+    def run():
+        try:
+            request = urllib.request.Request(f"{base_url}/events", headers=ota_daemon.api_headers())
+            response = cancel.register(urllib.request.urlopen(request, timeout=10))
+            jobs = ota_daemon.api_request(f"{base_url}/jobs")
+            if isinstance(jobs, list):
+                model.load_jobs(jobs)
+            with response:
+                for line in response:
+                    model.apply(json.loads(line))
+        except (URLError, OSError, ValueError) as e:
+            if not cancel.cancelled:
+                log(f"Lost the flasher daemon at {base_url}: {e}")
+
+    thread = threading.Thread(target=run, name="ota-dashboard", daemon=True)
+    thread.start()
+    return thread
+
+
+class FleetDashboard(ttk.Frame):
+    """Table of every device of a FleetModel, with a summary line
+
+    The Treeview only holds as many items as fit on screen; scrolling
+    changes which rows of the model they show. Each redraw touches the
+    visible rows that changed since the previous one, so its cost depends
+    on the window size, not on the number of devices or events.
+    """
+
+    def __init__(self, master, model: FleetModel = None, interval: float = REFRESH_INTERVAL):
+        super().__init__(master)
+        self.model = model or FleetModel()
+        self.interval_ms = int(interval * 1000)
+        self.offset = 0
+        self.frames = 0
+        self.render_seconds = 0.0
+        self.slowest_render = 0.0
+        self._items = []                # Treeview items, top to bottom
+        self._shown = []                # job id each item shows, None when blank
+        self._stale = True              # redraw every item next time
+        self._feed = None
+
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(1, weight=1)
+        self.summary = tk.StringVar()
+        ttk.Label(self, textvariable=self.summary).grid(row=0, column=0, columnspan=2, sticky="w", pady=(0, 5))
+
+        self.tree = ttk.Treeview(self, columns=[column for column, _, _ in COLUMNS], show="headings",
+                                 selectmode="none")
+        for column, heading, width in COLUMNS:
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, stretch=column in ("device", "result"))
+        self.tree.grid(row=1, column=0, sticky="nsew")
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.grid(row=1, column=1, sticky="ns")
+
+        self.tree.bind("<Configure>", lambda event: self.invalidate())
+        self.tree.bind("<MouseWheel>", self._on_wheel)
+        self.tree.bind("<Button-4>", lambda event: self.yview("scroll", -3, "units") or "break")
+        self.tree.bind("<Button-5>", lambda event: self.yview("scroll", 3, "units") or "break")
+        self.after(self.interval_ms, self._tick)
+
+    # Feeds
+
+    def follow(self, engine=None, url: str = None, log=logging.warning):
+        """Show the jobs of a local engine, or of the daemon at url; stops following the previous source"""
+        self.stop()
+        self.model.clear()
+        self._feed = CancelToken()
+        if url:
+            follow_daemon(self.model, url, self._feed, log)
+        elif engine is not None:
+            follow_engine(self.model, engine, self._feed)
+
+    def stop(self):
+        if self._feed is not None:
+            self._feed.cancel()
+            self._feed = None
+
+    # Scrolling
+
+    def visible_rows(self) -> int:
+        try:
+            row_height = int(ttk.Style().lookup("Treeview", "rowheight") or DEFAULT_ROW_HEIGHT)
+        except (ValueError, tk.TclError):
+            row_height = DEFAULT_ROW_HEIGHT
+        # One row's worth of height goes to the headings
+        return max(1, self.tree.winfo_height() // row_height - 1)
+
+    def yview(self, *args):
+        count, total = self.visible_rows(), len(self.model)
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * total)
+        elif args[0] == "scroll":
+            self.offset += int(args[1]) * (count if args[2].startswith("page") else 1)
+        self.render()
+
+    def _on_wheel(self, event):
+        # Windows reports multiples of 120, macOS small steps
+        steps = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        self.yview("scroll", -3 * steps, "units")
+        return "break"
+
+    # Drawing
+
+    def invalidate(self):
+        self._stale = True
+
+    def _tick(self):
+        try:
+            # Hidden tabs are not drawn; the changed rows are redrawn once shown again
+            if self.winfo_ismapped():
+                self.render()
+            else:
+                self._stale = True
+        finally:
+            self.after(self.interval_ms, self._tick)
+
+    def render(self):
+        started = time.perf_counter()
+        reordered, dirty = self.model.changes()
+        full = self._stale or reordered
+        self._stale = False
+        count, total = self.visible_rows(), len(self.model)
+        self.offset = max(0, min(self.offset, total - count))
+        ids = self.model.ids(self.offset, count)
+
+        while len(self._items) < count:
+            self._items.append(self.tree.insert("", tk.END, values=()))
+            self._shown.append(None)
+        for index, item in enumerate(self._items):
+            job = ids[index] if index < len(ids) else None
+            if job is None:
+                if self._shown[index] is not None:
+                    self.tree.item(item, values=())
+                    self._shown[index] = None
+            elif full or job in dirty or self._shown[index] != job:
+                self.tree.item(item, values=self.model.values(job))
+                self._shown[index] = job
+
+        if full or dirty:
+            self.summary.set(self.model.summary())
+        self.scrollbar.set(*((self.offset / total, (self.offset + len(ids)) / total) if total else (0, 1)))
+
+        elapsed = time.perf_counter() - started
+        self.frames += 1
+        self.render_seconds += elapsed
+        self.slowest_render = max(self.slowest_render, elapsed)
+
+    def render_stats(self) -> str:
+        average = self.render_seconds / self.frames if self.frames else 0
+        return (f"{self.frames} redraws, {average * 1000:.2f} ms average, {self.slowest_render * 1000:.2f} ms slowest,"
+                f" {self.model.events} events")
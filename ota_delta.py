@@ -0,0 +1,428 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from ota_paths import get_data_directory
+
+
+# Delta format: DELTA_MAGIC, then a zlib stream of operations that write the
+# target image front to back. Every operation is an opcode followed by LEB128
+# varints:
+#   OP_COPY offset length          copy length bytes of the base from offset
+#   OP_ADD  offset length bytes    add bytes to the base from offset, byte by byte modulo 256
+#   OP_DATA length bytes           write bytes as they are
+#   OP_END                         the image is complete
+# OP_ADD covers code that only moved: the instructions stay the same while
+# the addresses in them change a little, so the added bytes are mostly zero
+# and compress well.
+DELTA_MAGIC = b"CCD1"
+OP_END = 0
+OP_COPY = 1
+OP_ADD = 2
+OP_DATA = 3
+
+# Length of the base blocks exact matches are looked up by
+BLOCK_SIZE = 32
+# A match is continued as OP_ADD while this many of WINDOW bytes stay equal
+WINDOW = 16
+MIN_SIMILAR = 8
+# Deltas larger than this fraction of the image are not worth the device patching
+MAX_RATIO = 0.7
+# Past firmware images kept as bases
+KEEP_IMAGES = 16
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(buffer, position: int):
+    """(value, next position), or None if buffer ends inside the varint"""
+    value = shift = 0
+    while position < len(buffer):
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+    return None
+
+
+def _match_length(base, b: int, target, t: int) -> int:
+    """Length of the exact match of target at t with base at b"""
+    limit = min(len(base) - b, len(target) - t)
+    length = 0
+    for step in (4096, 256, 16, 1):
+        while length + step <= limit and base[b + length:b + length + step] == target[t + length:t + length + step]:
+            length += step
+    return length
+
+
+def _similar_length(base, b: int, target, t: int) -> int:
+    """Length of target at t that stays close enough to base at b to be sent as differences"""
+    limit = min(len(base) - b, len(target) - t)
+    length = 0
+    while length + WINDOW <= limit:
+        ours = target[t + length:t + length + WINDOW]
+        theirs = base[b + length:b + length + WINDOW]
+        if ours != theirs and sum(x == y for x, y in zip(ours, theirs)) < MIN_SIMILAR:
+            break
+        length += WINDOW
+    return length
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """Delta that turns base into target
+
+    Blocks of the target that occur anywhere in the base are copied, the
+    code following a copied block is sent as differences for as long as it
+    stays similar to the base, and everything else as it is.
+    """
+    index = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(base[offset:offset + BLOCK_SIZE], offset)
+
+    ops = bytearray()
+
+    def literal(start: int, end: int):
+        if end > start:
+            ops.extend(bytes([OP_DATA]) + _varint(end - start))
+            ops.extend(target[start:end])
+
+    pending = 0                         # start of the target bytes not covered yet
+    t = 0
+    while t + BLOCK_SIZE <= len(target):
+        b = index.get(target[t:t + BLOCK_SIZE])
+        if b is None:
+            t += 1
+            continue
+        while t > pending and b > 0 and target[t - 1] == base[b - 1]:
+            t, b = t - 1, b - 1
+        literal(pending, t)
+        length = _match_length(base, b, target, t)
+        ops.extend(bytes([OP_COPY]) + _varint(b) + _varint(length))
+        t, b = t + length, b + length
+        similar = _similar_length(base, b, target, t)
+        if similar:
+            ops.extend(bytes([OP_ADD]) + _varint(b) + _varint(similar))
+            ops.extend((x - y) & 0xFF for x, y in zip(target[t:t + similar], base[b:b + similar]))
+            t += similar
+        pending = t
+    literal(pending, len(target))
+    ops.append(OP_END)
+    return DELTA_MAGIC + zlib.compress(bytes(ops), 9)
+
+
+class DeltaPatcher:
+    """Reference patcher: applies a delta while it is being received, as a device does
+
+    read_base(offset, length) returns bytes of the running image. feed()
+    takes the delta as it arrives and returns the target bytes it completes,
+    in order, so they can be written to the update partition straight away.
+    """
+
+    def __init__(self, read_base):
+        self.read_base = read_base
+        self.written = 0
+        self.done = False
+        self._header = b""
+        self._inflate = zlib.decompressobj()
+        self._buffer = bytearray()
+        self._op = None                 # OP_ADD or OP_DATA whose bytes are being received
+        self._remaining = 0
+        self._offset = 0
+
+    def feed(self, data: bytes) -> bytes:
+        if len(self._header) < len(DELTA_MAGIC):
+            needed = len(DELTA_MAGIC) - len(self._header)
+            self._header += data[:needed]
+            data = data[needed:]
+            if len(self._header) == len(DELTA_MAGIC) and self._header != DELTA_MAGIC:
+                raise ValueError("not a delta")
+        if data:
+            try:
+                self._buffer += self._inflate.decompress(data)
+            except zlib.error as e:
+                raise ValueError(f"delta is corrupt: {e}")
+        return self._run()
+
+    def finish(self) -> bytes:
+        """The last target bytes; raises ValueError if the delta is incomplete"""
+        try:
+            self._buffer += self._inflate.flush()
+        except zlib.error as e:
+            raise ValueError(f"delta is corrupt: {e}")
+        out = self._run()
+        if not self.done or self._buffer or not self._inflate.eof or self._inflate.unused_data:
+            raise ValueError("delta is truncated or has trailing data")
+        return out
+
+    def _base(self, offset: int, length: int) -> bytes:
+        data = self.read_base(offset, length)
+        if len(data) != length:
+            raise ValueError("delta reads past the end of the base image")
+        return data
+
+    def _run(self) -> bytes:
+        out = bytearray()
+        while not self.done:
+            if self._op is None:
+                if not self._buffer:
+                    break
+                op = self._buffer[0]
+                if op == OP_END:
+                    del self._buffer[:1]
+                    self.done = True
+                    break
+                values = []
+                position = 1
+                for _ in range(1 if op == OP_DATA else 2):
+                    parsed = _read_varint(self._buffer, position)
+                    if parsed is None:
+                        break
+                    value, position = parsed
+                    values.append(value)
+                else:
+                    del self._buffer[:position]
+                    if op == OP_COPY:
+                        out += self._base(*values)
+                    elif op == OP_ADD:
+                        self._op, self._offset, self._remaining = op, values[0], values[1]
+                    elif op == OP_DATA:
+                        self._op, self._remaining = op, values[0]
+                    else:
+                        raise ValueError(f"unknown delta operation {op}")
+                    continue
+                break                   # the operation's varints are not complete yet
+            take = min(self._remaining, len(self._buffer))
+            if not take and self._remaining:
+                break
+            chunk = bytes(self._buffer[:take])
+            del self._buffer[:take]
+            if self._op == OP_DATA:
+                out += chunk
+            else:
+                out += bytes((x + y) & 0xFF for x, y in zip(self._base(self._offset, take), chunk))
+                self._offset += take
+            self._remaining -= take
+            if not self._remaining:
+                self._op = None
+        self.written += len(out)
+        return bytes(out)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    patcher = DeltaPatcher(lambda offset, length: base[offset:offset + length])
+    return patcher.feed(delta) + patcher.finish()
+
+
+def md5_file(path) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_archive_directory() -> Path:
+    archive_dir = get_data_directory() / "firmware_archive"
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    return archive_dir
+
+
+class DeltaPlan:
+    """A delta ready to be sent instead of an image"""
+
+    def __init__(self, path: str, base_md5: str, target_size: int, target_md5: str):
+        self.path = path
+        self.base_md5 = base_md5
+        self.target_size = target_size
+        self.target_md5 = target_md5
+        self.size = os.path.getsize(path)
+
+    @property
+    def saved(self) -> float:
+        """Fraction of the image that is not sent"""
+        return 1 - self.size / self.target_size if self.target_size else 0
+
+    def invitation(self) -> tuple:
+        """What espota.serve() adds to a DELTA invitation"""
+        return self.base_md5, self.target_size, self.target_md5
+
+
+class FirmwareArchive:
+    """Past firmware images by MD5, the bases deltas are made from, and the deltas made so far
+
+    Images are copied into the archive directory, so a base stays available
+    after the build directory was cleaned. The newest keep images are kept.
+    """
+
+    def __init__(self, directory=None, keep: int = KEEP_IMAGES):
+        self.directory = Path(directory or get_archive_directory())
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.directory / "index.json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index: dict):
+        temp_path = self.directory / "index.json.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(temp_path, self.directory / "index.json")
+
+    def images(self) -> list:
+        """(md5, entry) of the archived images, oldest first"""
+        with self._lock:
+            return sorted(self._load().items(), key=lambda item: item[1]["added"])
+
+    def path(self, md5: str):
+        """Archived image with this MD5, or None"""
+        path = self.directory / f"{md5}.bin"
+        return path if md5 and path.exists() else None
+
+    def add(self, path, tag: str = "", md5: str = None) -> str:
+        """Archive an image (a no-op if it is already there); returns its MD5"""
+        md5 = md5 or md5_file(path)
+        with self._lock:
+            index = self._load()
+            target = self.directory / f"{md5}.bin"
+            if not target.exists():
+                temp_path = self.directory / f"{md5}.bin.tmp"
+                shutil.copyfile(path, temp_path)
+                os.replace(temp_path, target)
+            entry = index.setdefault(md5, {"size": os.path.getsize(target), "added": time.time(), "tag": ""})
+            entry["tag"] = tag or entry["tag"]
+            self._prune(index)
+            self._save(index)
+        return md5
+
+    def _prune(self, index: dict):
+        for md5, entry in sorted(index.items(), key=lambda item: item[1]["added"])[:-self.keep or None]:
+            del index[md5]
+            for path in [self.directory / f"{md5}.bin"] + list(self.directory.glob(f"*{md5}*.delta")):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def delta(self, base_md5: str, target_path, target_md5: str) -> Path:
+        """Delta from the archived base to target_path, made once and kept next to the images
+
+        Raises KeyError if the base is not archived.
+        """
+        base_path = self.path(base_md5)
+        if base_path is None:
+            raise KeyError(base_md5)
+        path = self.directory / f"{base_md5}-{target_md5}.delta"
+        with self._lock:
+            if not path.exists():
+                with open(base_path, 'rb') as f:
+                    base = f.read()
+                with open(target_path, 'rb') as f:
+                    target = f.read()
+                temp_path = path.with_name(path.name + ".tmp")
+                temp_path.write_bytes(make_delta(base, target))
+                os.replace(temp_path, path)
+        return path
+
+
+def plan_delta(archive: FirmwareArchive, base_md5: str, image, max_ratio: float = MAX_RATIO):
+    """DeltaPlan for sending image (an ota_images.Image) to a device running base_md5
+
+    None when there is nothing to gain: no known base, the base is not
+    archived, the device already runs the image, or the delta is not much
+    smaller than the image.
+    """
+    if not base_md5 or base_md5 == image.md5 or archive.path(base_md5) is None:
+        return None
+    plan = DeltaPlan(str(archive.delta(base_md5, image.path, image.md5)), base_md5, image.size, image.md5)
+    if plan.size > image.size * max_ratio:
+        return None
+    return plan
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="delta", description="Manage firmware deltas and the image archive.")
+    sub = parser.add_subparsers(dest="action")
+    sub.required = True
+    add = sub.add_parser("add", help="Archive firmware images as delta bases")
+    add.add_argument("images", nargs="+")
+    add.add_argument("--tag", default="", help="Release tag to note with the image")
+    sub.add_parser("list", help="Show the archived images")
+    make = sub.add_parser("make", help="Make a delta between two images and check it")
+    make.add_argument("base")
+    make.add_argument("target")
+    make.add_argument("-o", "--output", help="Write the delta to this file")
+    sub.add_parser("report", help="Bytes saved by deltas between consecutive archived images")
+    options = parser.parse_args(args)
+
+    archive = FirmwareArchive()
+    if options.action == "add":
+        for path in options.images:
+            try:
+                print(f"{archive.add(path, options.tag)}  {path}")
+            except OSError as e:
+                print(f"❌ {str(e)}", file=sys.stderr)
+                return 1
+    elif options.action == "list":
+        for md5, entry in archive.images():
+            added = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["added"]))
+            print(f"{md5}  {entry['size']:>10,}  {added}  {entry['tag']}")
+    elif options.action == "make":
+        try:
+            with open(options.base, 'rb') as f:
+                base = f.read()
+            with open(options.target, 'rb') as f:
+                target = f.read()
+        except OSError as e:
+            print(f"❌ {str(e)}", file=sys.stderr)
+            return 1
+        started = time.time()
+        delta = make_delta(base, target)
+        elapsed = time.time() - started
+        if apply_delta(base, delta) != target:
+            print("❌ The delta does not reproduce the target image", file=sys.stderr)
+            return 1
+        if options.output:
+            with open(options.output, 'wb') as f:
+                f.write(delta)
+        print(f"Delta {len(delta):,} bytes for a {len(target):,} byte image ({1 - len(delta) / len(target):.1%} saved,"
+              f" zlib alone {len(zlib.compress(target, 9)):,} bytes), made in {elapsed:.1f} s")
+    else:
+        images = archive.images()
+        if len(images) < 2:
+            print("Archive at least two images to compare releases")
+            return 0
+        print(f"{'From':<10} {'To':<10} {'Image':>11} {'Delta':>11} {'Saved':>7}")
+        for (base_md5, base_entry), (target_md5, entry) in zip(images, images[1:]):
+            delta = archive.delta(base_md5, archive.path(target_md5), target_md5)
+            size = delta.stat().st_size
+            print(f"{(base_entry['tag'] or base_md5[:8]):<10} {(entry['tag'] or target_md5[:8]):<10} {entry['size']:>11,}"
+                  f" {size:>11,} {1 - size / entry['size']:>7.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,380 @@
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import ota_download
+from ota_littlefs import DEFAULT_IMAGE_SIZE
+
+
+BENCH_VERSION = 2
+DEFAULT_FIRMWARE_SIZE = 2 * 1024 * 1024
+DEFAULT_CHUNK_SIZES = (8192, 65536, 262144)
+DEFAULT_REPEATS = 3
+# A result may be this much worse than the baseline before it counts as a regression
+DEFAULT_TOLERANCE = 0.2
+# Peak memory within this many bytes of the baseline is noise
+MEMORY_SLACK = 64 * 1024
+# Bytes the server writes at a time, and the granularity of its bandwidth limit
+SERVER_BLOCK = 16 * 1024
+
+
+class AssetHandler(BaseHTTPRequestHandler):
+    """Serves the fake release assets with Range and ETag support, after the latency and at the bandwidth set"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.assets.get(self.path.rsplit("/", 1)[-1])
+        if data is None:
+            self.send_error(404)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        etag = f'"{len(data):x}-{self.server.seed:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if self.headers.get("If-Range", etag) != etag:
+            match = None
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        view = memoryview(data)
+        began = time.perf_counter()
+        sent = 0
+        try:
+            for offset in range(start, len(data), SERVER_BLOCK):
+                block = view[offset:offset + SERVER_BLOCK]
+                self.wfile.write(block)
+                sent += len(block)
+                if self.server.bandwidth:
+                    ahead = sent / self.server.bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_assets(firmware_size: int, seed: int) -> dict:
+    generator = random.Random(seed)
+    return {
+        "firmware.bin": generator.randbytes(firmware_size),
+        "littlefs.bin": generator.randbytes(DEFAULT_IMAGE_SIZE),
+    }
+
+
+def _serve_assets(connection, firmware_size: int, latency: float, bandwidth: float, seed: int):
+    """Runs in the server process until the benchmark closes its end of connection"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AssetHandler)
+    server.daemon_threads = True
+    server.assets = make_assets(firmware_size, seed)
+    server.latency, server.bandwidth, server.seed = latency, bandwidth, seed
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send(server.server_address[1])
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    server.shutdown()
+
+
+class AssetServer:
+    """Local HTTP server with fake firmware.bin and littlefs.bin, in a process of its own
+
+    Serving from another process keeps its CPU time and system calls out of
+    the measurements. latency (s) delays every response, bandwidth (bytes/s,
+    0 = unlimited) paces the body.
+    """
+
+    def __init__(self, firmware_size: int = DEFAULT_FIRMWARE_SIZE, latency: float = 0, bandwidth: float = 0,
+                 seed: int = 1):
+        self.assets = {"firmware.bin": firmware_size, "littlefs.bin": DEFAULT_IMAGE_SIZE}
+        context = multiprocessing.get_context("spawn")
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_serve_assets, args=(child, firmware_size, latency, bandwidth, seed),
+                                        daemon=True)
+        self._process.start()
+        child.close()
+        if not self._connection.poll(30):
+            self.close()
+            raise RuntimeError("The benchmark server did not start")
+        self.url = f"http://127.0.0.1:{self._connection.recv()}"
+
+    def close(self):
+        self._connection.close()
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_proc_io():
+    """Counters of /proc/self/io (syscr, syscw, rchar, wchar, ...), None where there are none"""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f if ":" in line)}
+    except (OSError, ValueError):
+        return None
+
+
+class SocketReadCounter:
+    """Counts the receive calls on sockets of this process while active
+
+    /proc/self/io only counts read() system calls, and both download paths
+    read the connection with recv_into(), so reads are counted here.
+    """
+
+    METHODS = ("recv", "recv_into")
+
+    def __init__(self):
+        self.calls = 0
+        self._originals = {}
+
+    def _counted(self, original):
+        def method(sock, *args, **kwargs):
+            self.calls += 1
+            return original(sock, *args, **kwargs)
+        return method
+
+    def __enter__(self):
+        for name in self.METHODS:
+            self._originals[name] = socket.socket.__dict__.get(name)
+            setattr(socket.socket, name, self._counted(getattr(socket.socket, name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self._originals.items():
+            if original is None:
+                delattr(socket.socket, name)
+            else:
+                setattr(socket.socket, name, original)
+        self._originals = {}
+
+
+def _download_release(server: AssetServer, work_dir: Path, backend: str, chunk_size: int):
+    """Fetch every asset from scratch, as the GUI does; returns (bytes, progress callbacks)"""
+    callbacks = [0]
+
+    def progress(downloaded, total):
+        callbacks[0] += 1
+
+    size = 0
+    for name in server.assets:
+        local_path = work_dir / name
+        for path in (local_path, ota_download.partial_path(local_path), ota_download.etag_path(local_path)):
+            if path.exists():
+                path.unlink()
+        size += ota_download.download_file(f"{server.url}/{name}", local_path, progress=progress,
+                                           chunk_size=chunk_size, backend=backend)
+    return size, callbacks[0]
+
+
+def measure(server: AssetServer, backend: str, chunk_size: int, repeats: int = DEFAULT_REPEATS,
+            work_dir=None) -> dict:
+    """Median wall time, CPU time and write system calls of downloading the release, its socket reads and peak memory
+
+    An untimed download first takes connection setup and caches out of the
+    numbers. Socket reads and memory are measured in runs of their own, as
+    counting calls and tracing allocations slow the download down.
+    """
+    with tempfile.TemporaryDirectory(prefix="clevercoffee_dlbench_", dir=work_dir) as directory:
+        directory = Path(directory)
+        _download_release(server, directory, backend, chunk_size)
+        samples = []
+        size = callbacks = 0
+        for _ in range(max(1, repeats)):
+            io_before = read_proc_io()
+            cpu_before = time.process_time()
+            started = time.perf_counter()
+            size, callbacks = _download_release(server, directory, backend, chunk_size)
+            sample = {"seconds": time.perf_counter() - started, "cpu_seconds": time.process_time() - cpu_before}
+            io_after = read_proc_io()
+            if io_before is not None and io_after is not None:
+                sample["write_syscalls"] = io_after["syscw"] - io_before["syscw"]
+            samples.append(sample)
+
+        with SocketReadCounter() as reads:
+            _download_release(server, directory, backend, chunk_size)
+
+        tracemalloc.start()
+        try:
+            _download_release(server, directory, backend, chunk_size)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def median(key):
+        values = [sample[key] for sample in samples if key in sample]
+        return statistics.median(values) if values else None
+
+    seconds = median("seconds")
+    return {
+        "backend": backend,
+        "chunk_size": chunk_size,
+        "bytes": size,
+        "seconds": seconds,
+        "throughput": size / seconds if seconds else 0,
+        "cpu_seconds": median("cpu_seconds"),
+        "socket_reads": reads.calls,
+        "write_syscalls": median("write_syscalls"),
+        "callbacks": callbacks,
+        "peak_memory": peak_memory,
+    }
+
+
+def run_benchmark(backends, chunk_sizes, firmware_size: int = DEFAULT_FIRMWARE_SIZE, latency: float = 0,
+                  bandwidth: float = 0, repeats: int = DEFAULT_REPEATS, log=print) -> dict:
+    config = {"firmware_size": firmware_size, "latency": latency, "bandwidth": bandwidth}
+    results = []
+    with AssetServer(firmware_size, latency, bandwidth) as server:
+        for backend in backends:
+            for chunk_size in chunk_sizes:
+                log(f"⏱️ {backend} with {chunk_size // 1024} KB chunks...")
+                results.append(measure(server, backend, chunk_size, repeats))
+    return {"version": BENCH_VERSION, "config": config, "results": results}
+
+
+def per_megabyte(result: dict, key: str):
+    value = result.get(key)
+    if value is None or not result["bytes"]:
+        return None
+    return value * 1024 * 1024 / result["bytes"]
+
+
+def compare(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """Regressions of report against baseline, as messages; results without a baseline are not judged"""
+    if baseline.get("version") != BENCH_VERSION:
+        return [f"baseline is not a download benchmark of version {BENCH_VERSION}"]
+    if baseline.get("config") != report["config"]:
+        return [f"baseline was measured with {baseline.get('config')}, not {report['config']}"]
+    known = {(result["backend"], result["chunk_size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        base = known.get((result["backend"], result["chunk_size"]))
+        if base is None:
+            continue
+        name = f"{result['backend']} {result['chunk_size'] // 1024} KB"
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput'] / 1024 / 1024:.1f} MB/s,"
+                               f" baseline {base['throughput'] / 1024 / 1024:.1f} MB/s")
+        for key, label in (("cpu_seconds", "CPU time"), ("socket_reads", "socket reads"),
+                           ("write_syscalls", "write calls")):
+            now, before = per_megabyte(result, key), per_megabyte(base, key)
+            if now is not None and before is not None and now > before * (1 + tolerance):
+                regressions.append(f"{name}: {label} per MB {now:.4g}, baseline {before:.4g}")
+        if result["peak_memory"] > base["peak_memory"] * (1 + tolerance) + MEMORY_SLACK:
+            regressions.append(f"{name}: peak memory {result['peak_memory'] // 1024} KB,"
+                               f" baseline {base['peak_memory'] // 1024} KB")
+    return regressions
+
+
+def print_report(report: dict):
+    def number(value, format_spec):
+        return format(value, format_spec) if value is not None else "-"
+
+    config = report["config"]
+    print(f"Release:        {(config['firmware_size'] + DEFAULT_IMAGE_SIZE) / 1024 / 1024:.1f} MB"
+          f" in 2 assets, latency {config['latency'] * 1000:.0f} ms, bandwidth "
+          + (f"{config['bandwidth'] / 1024 / 1024:.1f} MB/s" if config["bandwidth"] else "unlimited"))
+    print(f"{'Backend':<10} {'Chunk':>7} {'Throughput':>12} {'CPU/MB':>9} {'Reads/MB':>9} {'Writes/MB':>10}"
+          f" {'Callbacks':>10} {'Peak mem':>9}")
+    for result in report["results"]:
+        cpu = per_megabyte(result, "cpu_seconds")
+        print(f"{result['backend']:<10} {result['chunk_size'] // 1024:>4} KB"
+              f" {result['throughput'] / 1024 / 1024:>7.1f} MB/s"
+              f" {number(cpu * 1000 if cpu is not None else None, '>6.1f')} ms"
+              f" {number(per_megabyte(result, 'socket_reads'), '>9.0f')}"
+              f" {number(per_megabyte(result, 'write_syscalls'), '>10.0f')}"
+              f" {result['callbacks']:>10} {result['peak_memory'] // 1024:>6} KB")
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="download-bench",
+                                     description="Compare the release download paths against a local server.")
+    parser.add_argument("--backend", action="append", choices=ota_download.BACKENDS,
+                        help="Download path to measure, may be repeated (default: all installed)")
+    parser.add_argument("--chunk-sizes", default=",".join(str(size // 1024) for size in DEFAULT_CHUNK_SIZES),
+                        help="Comma-separated read sizes in KB (default: %(default)s)")
+    parser.add_argument("--size", type=float, default=DEFAULT_FIRMWARE_SIZE / 1024 / 1024,
+                        help="Size of the fake firmware in MB (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0, help="Delay of every response in ms (default: none)")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Server bandwidth in MB/s (default: unlimited)")
+    parser.add_argument("-r", "--repeats", type=int, default=DEFAULT_REPEATS,
+                        help="Downloads per case, the median counts (default: %(default)s)")
+    parser.add_argument("--baseline", metavar="FILE", help="Fail if worse than the results saved in FILE")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Save the results to FILE")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed regression as a fraction (default: %(default)s)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    options = parser.parse_args(args)
+
+    try:
+        chunk_sizes = [int(float(size) * 1024) for size in options.chunk_sizes.split(",") if size.strip()]
+    except ValueError:
+        parser.error("--chunk-sizes must be numbers of KB")
+    backends = options.backend or [backend for backend in ota_download.BACKENDS
+                                   if backend != "requests" or ota_download.HAS_REQUESTS]
+    if "requests" in backends and not ota_download.HAS_REQUESTS:
+        parser.error("requests is not installed (pip install requests)")
+    if not ota_download.HAS_REQUESTS and not options.json:
+        print("ℹ️ requests is not installed, measuring urllib only")
+
+    report = run_benchmark(backends, chunk_sizes, int(options.size * 1024 * 1024), options.latency / 1000,
+                           options.bandwidth * 1024 * 1024, options.repeats,
+                           log=(lambda message: None) if options.json else print)
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if options.save_baseline:
+        with open(options.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+    if options.baseline:
+        try:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ Cannot read baseline: {str(e)}", file=sys.stderr)
+            return 1
+        regressions = compare(report, baseline, options.tolerance)
+        for regression in regressions:
+            print(f"❌ {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        if not options.json:
+            print("✅ No regression against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,221 @@
+import functools
+import json
+import os
+import ssl
+import urllib.request
+from pathlib import Path
+from urllib.error import HTTPError
+
+from ota_cancel import Cancelled
+
+try:
+    import requests
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+
+CHUNK_SIZE = 8192
+# Ways of downloading; requests is preferred when installed
+BACKENDS = ("requests", "urllib")
+
+
+def fetch_json(url: str, timeout: float = 10):
+    """GET url over a certificate-checking connection and decode the JSON response"""
+    if HAS_REQUESTS:
+        response = requests.get(url, timeout=timeout, headers={"Accept": "application/json"})
+        response.raise_for_status()
+        return response.json()
+
+    request = urllib.request.Request(url, headers={"Accept": "application/json"})
+    with _api_opener().open(request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+@functools.lru_cache(maxsize=None)
+def _api_opener():
+    # Release digests are what downloaded assets are checked against, so they must come from the real GitHub
+    return urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl.create_default_context()))
+
+
+@functools.lru_cache(maxsize=None)
+def _urllib_opener():
+    # Release assets are checked against the published digests, so bundled apps without CA certificates can still
+    # download them. Built once: creating an SSL context costs more CPU than downloading a release
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl_context))
+
+
+def partial_path(local_path: Path) -> Path:
+    """Where an interrupted download of local_path is kept until it completes"""
+    return local_path.with_name(local_path.name + ".part")
+
+
+def etag_path(local_path: Path) -> Path:
+    """Where the ETag of a completed download is remembered"""
+    return local_path.with_name(local_path.name + ".etag")
+
+
+def read_etag(local_path: Path):
+    try:
+        return etag_path(Path(local_path)).read_text().strip() or None
+    except OSError:
+        return None
+
+
+def download_file(url: str, local_path: Path, cancel=None, progress=None, chunk_size: int = CHUNK_SIZE,
+                  backend: str = None) -> int:
+    """Download url to local_path, resuming a previous partial download
+
+    Data is written to a ".part" file that is only renamed to local_path once
+    complete, so a cancelled or failed download can be resumed later with a
+    Range request. The resume is conditional on the ETag the partial file
+    started with (If-Range), so a rebuilt asset is downloaded from scratch
+    instead of being spliced onto the old one; partial files without an
+    ETag are not resumed. A complete file downloaded before is revalidated
+    with its ETag and kept as is when the server answers 304 Not Modified.
+    progress(downloaded, total) is called after every chunk. backend picks
+    "requests" or "urllib" (default: requests when installed). Raises
+    Cancelled if cancel is triggered. Returns the size in bytes.
+    """
+    local_path = Path(local_path)
+    part_path = partial_path(local_path)
+    part_etag = read_etag(part_path)
+    offset = part_path.stat().st_size if part_path.exists() and part_etag else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = part_etag
+    elif local_path.exists() and read_etag(local_path):
+        headers["If-None-Match"] = read_etag(local_path)
+
+    if backend is None:
+        backend = "requests" if HAS_REQUESTS else "urllib"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown download backend {backend}")
+    if backend == "requests" and not HAS_REQUESTS:
+        raise RuntimeError("The requests backend needs requests (pip install requests)")
+
+    if backend == "requests":
+        status, downloaded, total, etag = _download_with_requests(url, part_path, offset, headers, cancel, progress,
+                                                                  chunk_size)
+    else:
+        status, downloaded, total, etag = _download_with_urllib(url, part_path, offset, headers, cancel, progress,
+                                                                chunk_size)
+
+    if status == 416:
+        # Nothing past the partial file: it is complete or of another build, so start over
+        part_path.unlink(missing_ok=True)
+        etag_path(part_path).unlink(missing_ok=True)
+        return download_file(url, local_path, cancel, progress, chunk_size, backend)
+
+    if status == 304:
+        size = local_path.stat().st_size
+        if progress is not None:
+            progress(size, size)
+        return size
+
+    if total and downloaded < total:
+        raise IOError(f"Download of {local_path.name} incomplete ({downloaded} of {total} bytes)")
+
+    os.replace(str(part_path), str(local_path))
+    etag_path(part_path).unlink(missing_ok=True)
+    if etag:
+        etag_path(local_path).write_text(etag)
+    elif etag_path(local_path).exists():
+        etag_path(local_path).unlink()
+    return downloaded
+
+
+def _open_part(part_path: Path, offset: int, resumed: bool, etag):
+    # Append when the server honoured our Range request, otherwise start over
+    if resumed and offset:
+        return open(part_path, 'ab'), offset
+    # Remember what is being downloaded, an interrupted download only resumes on the same version
+    if etag:
+        etag_path(part_path).write_text(etag)
+    else:
+        etag_path(part_path).unlink(missing_ok=True)
+    return open(part_path, 'wb'), 0
+
+
+def _copy(read, f, downloaded, total, cancel, progress, chunk_size):
+    while True:
+        if cancel is not None:
+            cancel.check()
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        f.write(chunk)
+        downloaded += len(chunk)
+        if progress is not None:
+            progress(downloaded, total)
+    return downloaded
+
+
+def _download_with_requests(url, part_path, offset, headers, cancel, progress, chunk_size):
+    # Use requests for better SSL handling
+    response = requests.get(url, stream=True, timeout=30, headers=headers)
+    if cancel is not None:
+        cancel.register(response)
+    try:
+        if response.status_code == 304:
+            return 304, 0, 0, None
+        if response.status_code == 416:
+            return 416, 0, 0, None
+        response.raise_for_status()
+
+        resumed = response.status_code == 206
+        f, downloaded = _open_part(part_path, offset, resumed, response.headers.get('etag'))
+        total = int(response.headers.get('content-length', 0))
+        if total:
+            total += downloaded
+        with f:
+            iterator = response.iter_content(chunk_size=chunk_size)
+            downloaded = _copy(lambda size: next(iterator, b''), f, downloaded, total, cancel, progress, chunk_size)
+        return response.status_code, downloaded, total, response.headers.get('etag')
+    except (requests.RequestException, OSError, ValueError):
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled()
+        raise
+    finally:
+        if cancel is not None:
+            cancel.unregister(response)
+        response.close()
+
+
+def _download_with_urllib(url, part_path, offset, headers, cancel, progress, chunk_size):
+    opener = _urllib_opener()
+    request = urllib.request.Request(url, headers=headers)
+
+    try:
+        response = opener.open(request, timeout=30)
+    except HTTPError as e:
+        if e.code == 304:
+            return 304, 0, 0, None
+        if e.code == 416:
+            return 416, 0, 0, None
+        raise
+
+    if cancel is not None:
+        cancel.register(response)
+    try:
+        resumed = response.status == 206
+        f, downloaded = _open_part(part_path, offset, resumed, response.headers.get('etag'))
+        total = int(response.headers.get('content-length', 0))
+        if total:
+            total += downloaded
+        with f:
+            downloaded = _copy(response.read, f, downloaded, total, cancel, progress, chunk_size)
+        return response.status, downloaded, total, response.headers.get('etag')
+    except (OSError, ValueError):
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled()
+        raise
+    finally:
+        if cancel is not None:
+            cancel.unregister(response)
+        response.close()
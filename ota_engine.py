@@ -0,0 +1,647 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import espota
+from ota_autotune import autotune
+from ota_cancel import CancelToken, Cancelled
+from ota_credentials import CredentialStore
+from ota_delta import FirmwareArchive, plan_delta
+import ota_history
+import ota_images
+from ota_inventory import DEFAULT_OTA_PORT, DeviceInventory
+from ota_listener import DEFAULT_CONNECT_PORT, DEFAULT_POOL_SIZE, ConnectBackListener
+from ota_preflight import run_preflight
+from ota_prepare import ImagePreparer
+from ota_profiles import ProfileStore
+from ota_routes import plan_routes
+import ota_shaping
+import ota_trace
+
+
+# Partitions in upload order and the espota command for each
+PARTITIONS = (("app", espota.FLASH), ("spiffs", espota.SPIFFS))
+
+# Job states
+QUEUED = "queued"
+PREFLIGHT = "preflight"
+UPLOADING = "uploading"
+SUCCESS = "success"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCESS, FAILED, CANCELLED)
+
+
+class UploadJob:
+    """One device to flash with one or more partition images"""
+
+    def __init__(self, engine, job_id: int, host: str, images: dict, password: str, port: int, release,
+                 skip_unchanged: bool = False):
+        self.engine = engine
+        self.id = job_id
+        self.host = host
+        self.images = images            # partition -> path
+        self.password = password
+        self.port = port
+        self.release = release          # (repo, tag) or None
+        self.skip_unchanged = skip_unchanged    # don't upload images the device got last time
+        self.state = QUEUED
+        self.partition = None
+        self.bytes_sent = 0
+        self.bytes_total = 0
+        self.results = {}               # partition -> espota return code
+        self.timings = {}               # partition -> phase timings
+        self.error = ""
+        self.created = time.time()
+        self.finished = None
+        self.cancel = CancelToken()
+
+    def emit(self, event_type: str, **data):
+        data.update(type=event_type, job=self.id, host=self.host)
+        self.engine.publish(data)
+
+    def log(self, message: str):
+        self.emit("log", message=message)
+
+    def set_state(self, state: str, error: str = ""):
+        self.state = state
+        if error:
+            self.error = error
+        if state in FINISHED_STATES:
+            self.finished = time.time()
+        self.emit("state", state=state, error=self.error)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "host": self.host,
+            "port": self.port,
+            "images": self.images,
+            "release": list(self.release) if self.release else None,
+            "skip_unchanged": self.skip_unchanged,
+            "state": self.state,
+            "partition": self.partition,
+            "bytes_sent": self.bytes_sent,
+            "bytes_total": self.bytes_total,
+            "results": self.results,
+            "timings": self.timings,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """Routes espota's log records to the job running on the logging thread"""
+
+    TIMING_MESSAGES = ("Invitation answered", "Authentication with", "Throughput:")
+
+    def __init__(self, engine):
+        super().__init__(logging.INFO)
+        self.engine = engine
+
+    def emit(self, record):
+        job = self.engine.job_for_thread(record.thread)
+        if job is None:
+            return
+        message = record.getMessage()
+        if record.levelno >= logging.ERROR:
+            job.error = message
+            job.log(f"⚠️ Error detected: {message}")
+        elif message.startswith(self.TIMING_MESSAGES):
+            job.log(f"⏱️ {message}")
+        else:
+            job.log(f"   {message}")
+
+
+class UploadEngine:
+    """Job queue and worker pool flashing devices, shared by the GUI, the CLI and the daemon
+
+    Progress is reported as events (dicts) to every subscriber queue. The
+    engine keeps recently used images loaded and resolves hosts through the
+    device inventory, so repeated jobs skip that work. Successful uploads
+    are recorded in the inventory as the devices' last known good state.
+    With trace_dir, a session trace of every upload is written there.
+    Devices connect back to one shared listener on connect_port (0 picks
+    free ports); if that port is taken, each upload listens on its own.
+    With delta, firmware is sent as a delta against the image a device last
+    got when that is archived, falling back to the full image. Invitations
+    race over every plausible local interface, the one a device last
+    answered over first. With retune, devices whose uploads got much slower
+    than their tuned profile are calibrated again once no job is queued or
+    running; a job submitted meanwhile stops the calibration.
+    """
+
+    def __init__(self, workers: int = 4, rate: float = 0, history_path=None, credentials=None,
+                 keep_images: int = 4, profiles=None, inventory=None, trace_dir=None,
+                 connect_port: int = DEFAULT_CONNECT_PORT, connect_pool: int = DEFAULT_POOL_SIZE,
+                 delta: bool = False, archive=None, retune: bool = True):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._threads = {}
+        self._subscribers = []
+        self.started = time.time()
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ota-job")
+        self.scheduler = ota_shaping.BandwidthScheduler(rate)
+        self.credentials = credentials or CredentialStore()
+        self.profiles = profiles or ProfileStore()
+        self.inventory = inventory or DeviceInventory()
+        self.history_path = history_path
+        self.trace_dir = trace_dir
+        self.delta = delta
+        self.archive = archive or FirmwareArchive()
+        self.retune = retune
+        self._retunes = {}              # host -> (address, port, password) to calibrate again when idle
+        self._retune_thread = None
+        self._retune_cancel = CancelToken()
+        self._closing = False
+        self._preparer = None
+        try:
+            self.listener = ConnectBackListener(port=connect_port, pool_size=connect_pool)
+        except OSError as e:
+            logging.warning("Cannot listen on connect-back ports %d-%d (%s, another flasher running?), "
+                            "uploads will use their own ports", connect_port, connect_port + connect_pool - 1, e)
+            self.listener = None
+        ota_images.registry.keep = max(ota_images.registry.keep, keep_images)
+
+        # espota logs to the root logger; pick up its records for the running jobs
+        self.log_handler = JobLogHandler(self)
+        root = logging.getLogger()
+        root.addHandler(self.log_handler)
+        if root.getEffectiveLevel() > logging.INFO:
+            root.setLevel(logging.INFO)
+
+    # Events
+
+    def subscribe(self, maxsize: int = 10000) -> queue.Queue:
+        """Queue receiving every event published from now on"""
+        events = queue.Queue(maxsize=maxsize)
+        with self._lock:
+            self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events: queue.Queue):
+        with self._lock:
+            if events in self._subscribers:
+                self._subscribers.remove(events)
+
+    def publish(self, event: dict):
+        event.setdefault("time", time.time())
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # A stalled consumer must not block the uploads
+                pass
+
+    # Jobs
+
+    def submit(self, host: str, images: dict, password: str = None, port: int = None,
+               release=None, skip_unchanged: bool = False) -> UploadJob:
+        """Queue a job flashing images (partition -> path) to host
+
+        host may be the name of an inventory device, whose port and stored
+        password are used unless given. With skip_unchanged, partitions whose
+        image has the same MD5 as the last successful upload to the host (per
+        the history) are skipped.
+        """
+        job = self._create_job(host, images, password, port, release, skip_unchanged)
+        self.executor.submit(self._run, job)
+        return job
+
+    def submit_batch(self, targets: list, release=None, skip_unchanged: bool = False) -> list:
+        """Queue several jobs, each started as soon as its images are prepared
+
+        targets are dicts with the arguments of submit() ("host", "images",
+        optionally "password" and "port"). The images of all jobs are hashed
+        and validated in a process pool (see ota_prepare) instead of one
+        after the other on the workers. Returns the queued jobs.
+        """
+        # Check every target before queueing any, so a bad one does not leave the others orphaned
+        arguments = [self._job_arguments(target["host"], target["images"], target.get("password"),
+                                         target.get("port")) for target in targets]
+        jobs = [self._add_job(*args, release, skip_unchanged) for args in arguments]
+        waiting = {job.id: {(path, partition) for partition, path in job.images.items()} for job in jobs}
+        items = [item for job in jobs for item in sorted(waiting[job.id])]
+
+        with self._lock:
+            if self._preparer is None:
+                self._preparer = ImagePreparer()
+            preparer = self._preparer
+
+        def prepare():
+            dispatched = set()
+            try:
+                for prepared in preparer.prepare(items):
+                    item = (prepared.path, prepared.partition)
+                    for job in jobs:
+                        if job.id in dispatched or item not in waiting[job.id]:
+                            continue
+                        if prepared.error:
+                            job.log(f"⚠️ Could not prepare {os.path.basename(prepared.path)}: {prepared.error}")
+                        waiting[job.id].discard(item)
+                        if not waiting[job.id]:
+                            dispatched.add(job.id)
+                            self._dispatch(job)
+            finally:
+                # Whatever was not prepared is hashed by the pre-flight checks
+                for job in jobs:
+                    if job.id not in dispatched:
+                        self._dispatch(job)
+
+        threading.Thread(target=prepare, name="ota-prepare", daemon=True).start()
+        return jobs
+
+    def _create_job(self, host: str, images: dict, password, port, release, skip_unchanged: bool) -> UploadJob:
+        return self._add_job(*self._job_arguments(host, images, password, port), release, skip_unchanged)
+
+    def _job_arguments(self, host: str, images: dict, password, port) -> tuple:
+        """Check a job's arguments and fill in the defaults; raises ValueError"""
+        unknown = set(images) - {partition for partition, command in PARTITIONS}
+        if unknown or not images:
+            raise ValueError(f"images must map 'app' and/or 'spiffs' to a file, got {sorted(images)}")
+        device = self.inventory.get(host)
+        if port is None:
+            port = device.port if device is not None else DEFAULT_OTA_PORT
+        if password is None:
+            password = self.credentials.get(self.inventory.credential_key(host), "")
+        return host, dict(images), password, int(port)
+
+    def _add_job(self, host: str, images: dict, password: str, port: int, release, skip_unchanged: bool) -> UploadJob:
+        with self._lock:
+            job = UploadJob(self, next(self._ids), host, images, password, port, release, skip_unchanged)
+            self._jobs[job.id] = job
+            # Calibration transfers would slow the upload down; they start over once the engine is idle
+            self._retune_cancel.cancel()
+        job.emit("state", state=QUEUED, error="")
+        return job
+
+    def _dispatch(self, job: UploadJob):
+        try:
+            self.executor.submit(self._run, job)
+        except RuntimeError:
+            # Shut down while the job's images were being prepared
+            job.set_state(CANCELLED)
+
+    def get(self, job_id: int):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return False
+        job.cancel.cancel()
+        if job.state == QUEUED:
+            job.set_state(CANCELLED)
+        return True
+
+    def cancel_all(self):
+        for job in self.jobs():
+            self.cancel(job.id)
+
+    def job_for_thread(self, thread_id: int):
+        with self._lock:
+            return self._threads.get(thread_id)
+
+    def shutdown(self, cancel: bool = True):
+        if cancel:
+            self.cancel_all()
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            self._closing = True
+            self._retunes.clear()
+            retune_thread = self._retune_thread
+        self._retune_cancel.cancel()
+        if retune_thread is not None:
+            retune_thread.join()
+        self.inventory.close()
+        if self.listener is not None:
+            self.listener.close()
+        if self._preparer is not None:
+            self._preparer.shutdown()
+        logging.getLogger().removeHandler(self.log_handler)
+
+    def metrics(self) -> dict:
+        jobs = self.jobs()
+        states = {}
+        for job in jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+        images = ota_images.registry.stats()
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "workers": self.workers,
+            "jobs": states,
+            "bytes_sent": sum(job.bytes_sent for job in jobs),
+            "images_loaded": images["images"],
+            "image_bytes": images["bytes"],
+            "resolved_hosts": sum(1 for device in self.inventory.devices() if device.ip),
+            "transfers": self.scheduler.stats(),
+            "connect_back_ports": self.listener.ports if self.listener is not None else [],
+            "connect_back_sessions": self.listener.sessions() if self.listener is not None else 0,
+        }
+
+    # Worker
+
+    def _run(self, job: UploadJob):
+        if job.cancel.cancelled:
+            return
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._threads[thread_id] = job
+        preflight = None
+        try:
+            job.set_state(PREFLIGHT)
+            # Resolve, probe, hash and verify concurrently; the upload reuses the results
+            job.log(f"🔍 Running pre-flight checks for {job.host}...")
+            preflight = run_preflight(job.host, job.images, release=job.release, log=job.log,
+                                      cancel=job.cancel, resolver=self.inventory.resolve)
+            if job.cancel.cancelled:
+                job.set_state(CANCELLED)
+                return
+            if not preflight.ok:
+                job.log("❌ Pre-flight checks failed")
+                job.set_state(FAILED, "; ".join(preflight.problems))
+                return
+
+            skipped = set()
+            if job.skip_unchanged:
+                skipped = self._already_flashed(job.host, preflight.images)
+                for partition in sorted(skipped):
+                    job.log(f"⏭️ {partition.title()} image unchanged since the last upload to {job.host}, skipping")
+                    job.results[partition] = 0
+                    job.emit("partition", partition=partition, result=0, skipped=True)
+
+            profile = self.profiles.get(job.host)
+            if profile is not None and profile.stale and len(skipped) < len(job.images):
+                # Calibrating takes minutes on a slow link; the user's upload goes first with the old settings
+                job.log(f"⚠️ Uploads to {job.host} got slower since the transport was tuned,"
+                        f" {self._retune_hint(job.host)}")
+
+            job.bytes_total = sum(image.size for partition, image in preflight.images.items()
+                                  if partition not in skipped)
+            job.set_state(UPLOADING)
+            for partition, command in PARTITIONS:
+                if partition not in job.images or partition in skipped:
+                    continue
+                if job.cancel.cancelled:
+                    break
+                job.log("Uploading firmware..." if partition == "app" else "Uploading filesystem...")
+                if not self._upload(job, partition, command, preflight.images[partition], preflight.ip):
+                    break
+
+            if job.cancel.cancelled:
+                job.log("⏹️ Upload cancelled by user")
+                job.set_state(CANCELLED)
+            elif all(job.results.get(partition) == 0 for partition in job.images):
+                self.credentials.set(self.inventory.credential_key(job.host), job.password)
+                if self.retune and getattr(self.profiles.get(job.host), "stale", False):
+                    with self._lock:
+                        self._retunes[job.host] = (preflight.ip, job.port, job.password)
+                job.log("✅ All uploads completed successfully!")
+                job.log("🔄 ESP32 should restart automatically with the new firmware.")
+                job.set_state(SUCCESS)
+            else:
+                job.log("❌ One or more uploads failed")
+                job.set_state(FAILED)
+
+        except Exception as e:
+            job.log(f"❌ Error: {str(e)}")
+            job.set_state(FAILED, str(e))
+        finally:
+            if preflight is not None:
+                preflight.release()
+            with self._lock:
+                self._threads.pop(thread_id, None)
+            self._start_retunes()
+
+    # Re-tuning
+
+    def _retune_hint(self, host: str) -> str:
+        if self.retune:
+            return "it is tuned again once no upload is waiting"
+        return f"run 'autotune {host}' to tune it again"
+
+    def _start_retunes(self):
+        """Calibrate the devices waiting for it, if no job is queued or running"""
+        with self._lock:
+            busy = any(job.state not in FINISHED_STATES for job in self._jobs.values())
+            if busy or not self._retunes or self._retune_thread is not None:
+                return
+            retunes, self._retunes = self._retunes, {}
+            self._retune_cancel = CancelToken()
+            self._retune_thread = threading.Thread(target=self._run_retunes, args=(retunes, self._retune_cancel),
+                                                   name="ota-retune", daemon=True)
+            self._retune_thread.start()
+
+    def _run_retunes(self, retunes: dict, cancel: CancelToken):
+        try:
+            for host, (address, port, password) in retunes.items():
+                if cancel.cancelled:
+                    break
+                logging.info("Tuning the transport to %s again", host)
+                try:
+                    autotune(host, port, password, target=address, store=self.profiles, cancel=cancel,
+                             log=logging.info)
+                except Cancelled:
+                    pass
+                except Exception as e:
+                    logging.warning("Could not tune the transport to %s again: %s", host, e)
+        finally:
+            # Interrupted by a job: try the devices still out of tune again once the engine is idle
+            stale = {host: settings for host, settings in retunes.items()
+                     if cancel.cancelled and getattr(self.profiles.get(host), "stale", False)}
+            with self._lock:
+                self._retune_thread = None
+                if not self._closing:
+                    for host, settings in stale.items():
+                        self._retunes.setdefault(host, settings)
+            if not self._closing:
+                self._start_retunes()
+
+    def _upload(self, job: UploadJob, partition: str, command: int, image, target: str) -> bool:
+        job.partition = partition
+        timings = job.timings.setdefault(partition, {})
+        sent_before = job.bytes_sent
+        started = time.time()
+        result = 1
+        sent = [image.size]             # size of what is being sent, the image or a delta
+
+        file_name = os.path.basename(image.path)
+        job.log(f"Uploading {file_name} ({image.size:,} bytes)")
+        job.log(f"🔍 Upload info:")
+        job.log(f"   File size: {image.size:,} bytes ({image.size / 1024 / 1024:.1f} MB)")
+        job.log(f"   Target: {job.host}:{job.port}")
+        job.log(f"   Partition: {partition}")
+
+        last_percent = [-1]
+
+        def progress(fraction):
+            job.bytes_sent = sent_before + int(fraction * sent[0])
+            percent = int(fraction * 100)
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                job.emit("progress", partition=partition, percent=percent,
+                         bytes_sent=job.bytes_sent, bytes_total=job.bytes_total)
+
+        profile = self.profiles.get(job.host)
+        if profile is not None:
+            job.log(f"   Transport: {profile.describe()}")
+
+        job.error = ""
+        share = self.scheduler.register(job.host)
+        trace = ota_trace.SessionRecorder() if self.trace_dir else None
+        device = self.inventory.get(job.host)
+        routes = plan_routes(target, device.route if device is not None else None)
+        if len(routes.routes) > 1 or routes.fallback:
+            job.log(f"   Routes: {routes}")
+        try:
+            plan = self._plan_delta(job, image) if command == espota.FLASH else None
+            delta_result = None
+            if plan is not None:
+                job.log(f"🧩 Sending a {plan.size:,} byte delta against {plan.base_md5[:8]} ({plan.saved:.0%} less)")
+                job.bytes_total -= image.size - plan.size
+                sent[0] = plan.size
+                delta_result = result = self._serve_delta(job, plan, target, timings, share, progress, profile,
+                                                          trace, routes)
+                if result != 0:
+                    job.bytes_total += image.size - plan.size
+                    job.bytes_sent = sent_before
+                    sent[0] = image.size
+                    timings.clear()
+            if delta_result != 0 and not job.cancel.cancelled:
+                if delta_result is not None:
+                    job.log("⚠️ Delta upload failed, sending the full image")
+                result = espota.serve(target, "0.0.0.0", job.port, 0, job.password,
+                                      image.path, command, timings=timings, image=image, shaper=share,
+                                      cancel=job.cancel, progress=progress, profile=profile, trace=trace,
+                                      listener=self.listener, routes=routes)
+                if result == 0 and delta_result == espota.DELTA_UNANSWERED:
+                    # the device took the image but ignored the delta invitation
+                    self.inventory.record_deltas(job.host, False)
+            stats = share.stats()
+            timings["throughput"] = stats["achieved"]
+            job.log(f"⏱️ Throughput: {stats['achieved'] / 1024:.1f} KB/s")
+            # Acks of a windowed transfer are still coming in while waiting for the result
+            elapsed = (timings.get("transfer") or 0) + (timings.get("result") or 0)
+            if result == 0 and elapsed and self.profiles.check_throughput(job.host, sent[0] / elapsed):
+                job.log(f"⚠️ Throughput far below the tuned profile, {self._retune_hint(job.host)}")
+        finally:
+            self.scheduler.unregister(share)
+            if trace is not None:
+                self._save_trace(job, partition, trace, started)
+            job.results[partition] = result
+            self._record(job, partition, image, result, timings, started, sent[0])
+            if result == 0:
+                self.inventory.record_upload(job.host, partition, image.md5, self.profiles.get(job.host))
+                if routes.winner is not None:
+                    self.inventory.record_route(job.host, routes.winner)
+                if self.delta and command == espota.FLASH:
+                    self._archive(job, image)
+
+        job.emit("partition", partition=partition, result=result, throughput=timings.get("throughput"),
+                 retries=timings.get("retries") or 0)
+        if result == 0:
+            job.log(f"✅ {partition.title()} upload completed successfully!")
+            return True
+        if not job.cancel.cancelled:
+            job.log(f"❌ {partition.title()} upload failed with return code: {result}")
+        return False
+
+    def _plan_delta(self, job: UploadJob, image):
+        """DeltaPlan for the firmware image, if deltas are on and one is worth sending to the device"""
+        if not self.delta:
+            return None
+        device = self.inventory.get(job.host)
+        if device is None or device.deltas is False:
+            return None
+        try:
+            return plan_delta(self.archive, device.firmware_digest, image)
+        except OSError as e:
+            job.log(f"⚠️ Cannot make a delta: {str(e)}")
+            return None
+
+    def _serve_delta(self, job: UploadJob, plan, target: str, timings: dict, share, progress, profile, trace,
+                     routes) -> int:
+        try:
+            patch = ota_images.registry.acquire(plan.path)
+        except OSError as e:
+            job.log(f"⚠️ Cannot read the delta: {str(e)}")
+            return 1
+        try:
+            result = espota.serve(target, "0.0.0.0", job.port, 0, job.password, plan.path, espota.DELTA,
+                                  timings=timings, image=patch, shaper=share, cancel=job.cancel, progress=progress,
+                                  profile=profile, trace=trace, listener=self.listener, delta=plan.invitation(),
+                                  routes=routes, probe=self._deltas_unknown(job.host))
+        finally:
+            ota_images.registry.release(patch)
+        if result in (0, espota.DELTA_REFUSED):
+            self.inventory.record_deltas(job.host, True)
+        return result
+
+    def _deltas_unknown(self, host: str) -> bool:
+        """Whether host never answered a delta invitation, so it is only probed briefly"""
+        device = self.inventory.get(host)
+        return device is None or device.deltas is None
+
+    def _archive(self, job: UploadJob, image):
+        """Keep a flashed firmware image as the base of the next delta"""
+        try:
+            self.archive.add(image.path, job.release[1] if job.release else "", image.md5)
+        except OSError as e:
+            job.log(f"⚠️ Could not archive the image for deltas: {str(e)}")
+
+    def _save_trace(self, job: UploadJob, partition: str, trace, started: float):
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+        path = os.path.join(self.trace_dir, f"{job.host}-{partition}-{stamp}-{job.id}.json.gz")
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            trace.save(path)
+            job.log(f"   Session trace: {path}")
+        except OSError as e:
+            job.log(f"⚠️ Could not write the session trace: {str(e)}")
+
+    def _already_flashed(self, host: str, images: dict) -> set:
+        """Partitions whose image is the one last uploaded successfully to host"""
+        try:
+            history = ota_history.UploadHistory(self.history_path)
+            try:
+                last = {row["partition"]: row["image_digest"] for row in history.last_successful(host)}
+            finally:
+                history.close()
+        except Exception:
+            return set()
+        return {partition for partition, image in images.items() if last.get(partition) == image.md5}
+
+    def _record(self, job: UploadJob, partition: str, image, result: int, timings: dict, started: float,
+                size: int = None):
+        """Append the upload to the history database; size is the bytes sent, if not the image"""
+        if job.cancel.cancelled:
+            outcome = "cancelled"
+        else:
+            outcome = "success" if result == 0 else "failed"
+        release = job.release[1] if job.release else ""
+
+        try:
+            history = ota_history.UploadHistory(self.history_path)
+            try:
+                history.record(job.host, partition, outcome, timings, release_tag=release,
+                               image_path=os.path.abspath(image.path), image_digest=image.md5,
+                               size=image.size if size is None else size,
+                               error=job.error if outcome == "failed" else "", started=started)
+            finally:
+                history.close()
+        except Exception as e:
+            job.log(f"⚠️ Could not record upload history: {str(e)}")
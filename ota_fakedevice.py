@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import espota
+from ota_delta import DeltaPatcher
+
+
+# ArduinoOTA reads at most one TCP segment per loop iteration
+READ_SIZE = 1460
+# How long the device waits for the next data before giving up on an upload
+IDLE_TIMEOUT = 10
+
+
+class FakeDevice:
+    """Stand-in for an ESP32 running ArduinoOTA, for calibration, tests and load simulations
+
+    Speaks the same protocol as the device: answers invitations (with the
+    digest authentication when a password is set), connects back, acknowledges
+    every read with its length and answers "OK" once the MD5 matches. A
+    distant device is emulated with ack_delay (seconds per read) and rate
+    (bytes per second). An unreliable one ignores invitations (drop_rate),
+    loses the connection halfway (abort_rate) or reports a bad MD5
+    (corrupt_rate), each a probability per session. With replay (an
+    ota_trace.Replay), it behaves like a recorded device instead. With
+    deltas, it runs firmware that keeps the flashed image (starting with
+    firmware) and accepts deltas against it (see ota_delta); otherwise it
+    ignores DELTA invitations like stock ArduinoOTA. Finished sessions are
+    listed in `uploads`.
+    """
+
+    def __init__(self, port: int = 0, password: str = None, bind: str = "127.0.0.1", read_size: int = READ_SIZE,
+                 ack_delay: float = 0, rate: float = 0, recv_buffer: int = 0, drop_rate: float = 0,
+                 abort_rate: float = 0, corrupt_rate: float = 0, seed=None, replay=None, deltas: bool = False,
+                 firmware: bytes = None):
+        self.password = password
+        self.read_size = read_size
+        self.ack_delay = ack_delay
+        self.rate = rate
+        self.recv_buffer = recv_buffer
+        self.drop_rate = drop_rate
+        self.abort_rate = abort_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.replay = replay
+        self.deltas = deltas
+        self.firmware = firmware
+        self.uploads = []
+        self._ignored = 0               # invitations ignored so far while replaying
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((bind, port))
+        self.address = self.udp.getsockname()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"fake-esp-{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True):
+        """Stop answering; without wait, many devices can be stopped at once and joined later"""
+        self._stopping.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        self.udp.settimeout(espota.POLL_INTERVAL)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    data, peer = self.udp.recvfrom(256)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                try:
+                    self.session(data.decode(), peer)
+                except (OSError, ValueError) as e:
+                    logging.debug("Fake device %d: session failed: %s", self.port, e)
+        finally:
+            self.udp.close()
+
+    @property
+    def firmware_md5(self) -> str:
+        return hashlib.md5(self.firmware).hexdigest() if self.firmware is not None else ""
+
+    def session(self, invitation: str, peer):
+        command, local_port, size, md5, *delta = invitation.split()
+        command, local_port, size = int(command), int(local_port), int(size)
+        if command == espota.DELTA and (not self.deltas or self.replay is not None):
+            self.uploads.append({"command": command, "size": size, "received": 0, "result": "ignored"})
+            return
+        if command == espota.DELTA:
+            base_md5, target_size, target_md5 = delta
+            if base_md5 != self.firmware_md5:
+                self.udp.sendto(b"ERR BASE", peer)
+                self.uploads.append({"command": command, "size": size, "received": 0, "result": "other base"})
+                return
+            delta = (int(target_size), target_md5)
+        if self.replay is not None:
+            self.replay_session(command, local_port, size, md5, peer)
+            return
+        if self.random.random() < self.drop_rate:
+            self.uploads.append({"command": command, "size": size, "received": 0, "result": "dropped"})
+            return
+        abort_at = int(size * self.random.random()) if self.random.random() < self.abort_rate else None
+        corrupt = self.random.random() < self.corrupt_rate
+
+        if self.password:
+            peer = self.authenticate(peer)
+            if peer is None:
+                self.uploads.append({"command": command, "size": size, "received": 0, "result": "auth failed"})
+                return
+        self.udp.sendto(b"OK", peer)
+        self.transfer(command, local_port, size, md5, peer, abort_at, corrupt, delta)
+
+    def authenticate(self, peer, delay: float = 0):
+        """Challenge the uploader; returns its address, or None (after telling it) if the answer is wrong
+
+        Without a password (when replaying), any answer is accepted.
+        """
+        nonce = hashlib.md5(os.urandom(16)).hexdigest()
+        self.udp.sendto(f"AUTH {nonce}".encode(), peer)
+        self.udp.settimeout(espota.TIMEOUT)
+        try:
+            answer, peer = self.udp.recvfrom(256)
+        finally:
+            self.udp.settimeout(espota.POLL_INTERVAL)
+        auth, cnonce, response = answer.decode().split()
+        expected = response
+        if self.password:
+            passmd5 = hashlib.md5(self.password.encode()).hexdigest()
+            expected = hashlib.md5(f"{passmd5}:{nonce}:{cnonce}".encode()).hexdigest()
+        time.sleep(delay)
+        if int(auth) != espota.AUTH or response != expected:
+            self.udp.sendto(b"Authentication Failed", peer)
+            return None
+        return peer
+
+    def replay_session(self, command: int, local_port: int, size: int, md5: str, peer):
+        """Answer an invitation the way the recorded device did"""
+        replay = self.replay
+        if not replay.answers or self._ignored < replay.ignored_invitations:
+            self._ignored += 1
+            return
+        self._ignored = 0
+        time.sleep(replay.invitation_delay)
+        if replay.auth:
+            if replay.auth_reply is None:
+                # The recorded device never answered the authentication
+                self.udp.sendto(replay.reply.encode(), peer)
+                return
+            peer = self.authenticate(peer, replay.auth_delay)
+            if peer is None:
+                return
+            reply = replay.auth_reply
+        else:
+            reply = replay.reply
+        self.udp.sendto(reply.encode(), peer)
+        if reply != "OK" or not replay.connects:
+            self.uploads.append({"command": command, "size": size, "received": 0, "result": reply or "no connect"})
+            return
+        time.sleep(replay.connect_delay)
+        abort_at = int(size * replay.abort_at) if replay.abort_at is not None else None
+        self.transfer(command, local_port, size, md5, peer, abort_at, False)
+
+    def transfer(self, command: int, local_port: int, size: int, md5: str, peer, abort_at, corrupt: bool, delta=None):
+        """Connect back to the uploader and receive the image, or the delta to (target size, MD5)"""
+        replay = self.replay
+        # the firmware being written, when it is kept
+        firmware = bytearray() if self.deltas and command in (espota.FLASH, espota.DELTA) else None
+        patcher = None
+        if delta:
+            base = self.firmware
+            patcher = DeltaPatcher(lambda offset, length: base[offset:offset + length])
+        patch_error = None
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.recv_buffer:
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+        connection.settimeout(IDLE_TIMEOUT)
+        started = time.time()
+        received = 0
+        digest = hashlib.md5()
+        result = "aborted"
+        try:
+            connection.connect((peer[0], local_port))
+            started = time.time()
+            while received < size:
+                if abort_at is not None and received >= abort_at:
+                    break
+                data = connection.recv(min(self.read_size, size - received))
+                if not data:
+                    break
+                received += len(data)
+                digest.update(data)
+                if firmware is not None and patch_error is None:
+                    try:
+                        firmware += patcher.feed(data) if patcher is not None else data
+                    except ValueError as e:
+                        patch_error = str(e)
+                if self.ack_delay:
+                    time.sleep(self.ack_delay)
+                if self.rate:
+                    # Hold back until the emulated link has carried the data
+                    time.sleep(max(0.0, started + received / self.rate - time.time()))
+                if replay is not None:
+                    time.sleep(max(0.0, started + replay.ack_time(received, size) - time.time()))
+                connection.sendall(str(len(data)).encode())
+            if received == size:
+                result = "ok" if digest.hexdigest() == md5 and not corrupt else "md5 mismatch"
+                message = b"OK" if result == "ok" else b"ERROR[9]: MD5 Check Failed"
+                if result == "ok" and firmware is not None:
+                    if patcher is not None and patch_error is None:
+                        try:
+                            firmware += patcher.finish()
+                        except ValueError as e:
+                            patch_error = str(e)
+                    if patcher is not None and patch_error is None and (
+                            len(firmware) != delta[0] or hashlib.md5(firmware).hexdigest() != delta[1]):
+                        patch_error = "patched image does not match"
+                    if patch_error is not None:
+                        result, message = "patch failed", f"ERROR[10]: {patch_error}".encode()
+                    else:
+                        self.firmware = bytes(firmware)
+                if replay is not None:
+                    time.sleep(replay.result_delay)
+                    if result == "ok" and replay.result not in (None, "OK"):
+                        result, message = "replayed error", replay.result.encode()
+                connection.sendall(message)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+            self.uploads.append({"command": command, "size": size, "received": received, "result": result,
+                                 "seconds": time.time() - started})
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="fake-device", description="Run a fake ESP32 OTA endpoint.")
+    parser.add_argument("--bind", default="127.0.0.1", help="Address to listen on (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=3232, help="OTA port (default: %(default)s)")
+    parser.add_argument("-a", "--auth", help="OTA password (default: none)")
+    parser.add_argument("--latency", type=float, default=0, help="Delay before each ack in ms (default: none)")
+    parser.add_argument("--rate", type=float, default=0, help="Link speed in KB/s (default: unlimited)")
+    parser.add_argument("--read-size", type=int, default=READ_SIZE, help="Bytes per read (default: %(default)s)")
+    parser.add_argument("--drop", type=float, default=0, help="Probability of ignoring an invitation")
+    parser.add_argument("--abort", type=float, default=0, help="Probability of dropping the connection halfway")
+    parser.add_argument("--corrupt", type=float, default=0, help="Probability of reporting an MD5 mismatch")
+    parser.add_argument("--replay", metavar="TRACE", help="Behave like the device of a session trace (espota.py --record)")
+    parser.add_argument("--deltas", action="store_true", help="Keep the flashed image and accept deltas against it")
+    parser.add_argument("--firmware", metavar="FILE", help="Image the device runs at first, a base for deltas")
+    options = parser.parse_args(args)
+
+    replay = None
+    if options.replay:
+        # Imported here, ota_trace builds on this module
+        import ota_trace
+        replay = ota_trace.Replay(ota_trace.load_trace(options.replay))
+    device = FakeDevice(options.port, options.auth, options.bind, options.read_size, options.latency / 1000,
+                        options.rate * 1024, drop_rate=options.drop, abort_rate=options.abort,
+                        corrupt_rate=options.corrupt, replay=replay, deltas=options.deltas)
+    if options.firmware:
+        with open(options.firmware, 'rb') as f:
+            device.firmware = f.read()
+    print(f"Fake ESP32 listening on {options.bind}:{device.port}")
+    device.start()
+    reported = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            for upload in device.uploads[reported:]:
+                kind = {espota.SPIFFS: 'spiffs', espota.DELTA: 'delta'}.get(upload['command'], 'app')
+                print(f"{kind:<7} {upload['received']:>10,}"
+                      f" of {upload['size']:,} bytes  {upload['result']}")
+            reported = len(device.uploads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,269 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from ota_cancel import CancelToken
+from ota_credentials import CredentialStore
+import ota_engine
+from ota_fakedevice import FakeDevice
+from ota_inventory import DeviceInventory
+from ota_preflight import ESP_IMAGE_MAGIC
+from ota_profiles import ProfileStore
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+
+# How often process resources are sampled
+SAMPLE_INTERVAL = 0.05
+
+
+def percentile(values: list, fraction: float):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class ResourceMonitor:
+    """Samples open file descriptors, threads and RSS in the background and keeps the peaks"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_fds = open_fds()
+        self.peak_threads = threading.active_count()
+        self.peak_rss = rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fleetsim-monitor", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        fds, rss = open_fds(), rss_bytes()
+        if fds is not None:
+            self.peak_fds = max(self.peak_fds or 0, fds)
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+
+
+def write_image(path: str, size: int):
+    with open(path, 'wb') as f:
+        f.write(bytes([ESP_IMAGE_MAGIC]) + os.urandom(size - 1))
+    return path
+
+
+def failure_mode(job) -> str:
+    if job.state == ota_engine.SUCCESS:
+        return ""
+    return (job.error or job.state).splitlines()[0][:80]
+
+
+def simulate(devices: int = 200, workers: int = 50, image_size: int = 512 * 1024, latency: float = 0.002,
+             jitter: float = 0.5, rate: float = 0, drop_rate: float = 0, abort_rate: float = 0,
+             corrupt_rate: float = 0, password: str = "", distinct_images: bool = False, seed=None,
+             timeout: float = 600, log=print, model=None) -> dict:
+    """Flash `devices` fake ESP32s on loopback through one UploadEngine and report how it coped
+
+    Every device gets latency * uniform(1 - jitter, 1 + jitter) seconds per
+    ack, the link rate (bytes/s, 0 = unlimited) and the failure
+    probabilities. model (an ota_dashboard.FleetModel) is fed with the
+    engine's events. Returns the aggregate report as a dict.
+    """
+    chooser = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix="clevercoffee_fleetsim_") as work_dir, \
+            open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        images = [write_image(os.path.join(work_dir, f"firmware-{index}.bin"), image_size)
+                  for index in range(devices if distinct_images else 1)]
+
+        fleet = [FakeDevice(password=password or None,
+                            ack_delay=latency * chooser.uniform(1 - jitter, 1 + jitter),
+                            rate=rate, drop_rate=drop_rate, abort_rate=abort_rate, corrupt_rate=corrupt_rate,
+                            seed=chooser.random()).start()
+                 for _ in range(devices)]
+        engine = ota_engine.UploadEngine(workers=workers, history_path=os.path.join(work_dir, "history.sqlite3"),
+                                         credentials=CredentialStore(use_keyring=False),
+                                         profiles=ProfileStore(os.path.join(work_dir, "profiles.json")),
+                                         inventory=DeviceInventory(os.path.join(work_dir, "inventory.json")),
+                                         keep_images=len(images), connect_port=0,
+                                         connect_pool=workers)
+        feed = CancelToken()
+        if model is not None:
+            from ota_dashboard import follow_engine
+            follow_engine(model, engine, feed)
+        log(f"🚀 Flashing {devices} fake devices with {workers} workers, {image_size // 1024} KB each...")
+
+        cpu_before = os.times()
+        started = time.time()
+        with ResourceMonitor() as monitor:
+            jobs = [engine.submit(device.address[0], {"app": images[index % len(images)]}, password=password,
+                                  port=device.port)
+                    for index, device in enumerate(fleet)]
+            deadline = started + timeout
+            while time.time() < deadline and any(job.state not in ota_engine.FINISHED_STATES for job in jobs):
+                time.sleep(0.1)
+            elapsed = time.time() - started
+            engine.shutdown()
+        cpu_after = os.times()
+        feed.cancel()
+
+        for device in fleet:
+            device.stop(wait=False)
+        for device in fleet:
+            device.stop()
+
+    succeeded = [job for job in jobs if job.state == ota_engine.SUCCESS]
+    durations = [job.finished - job.created for job in succeeded if job.finished]
+    transfers = [job.timings["app"]["transfer"] for job in succeeded if job.timings.get("app", {}).get("transfer")]
+    invitations = [job.timings["app"]["invitation"] for job in jobs
+                   if job.timings.get("app", {}).get("invitation") is not None]
+
+    def summary(values):
+        return {"p50": percentile(values, 0.5), "p90": percentile(values, 0.9), "p99": percentile(values, 0.99),
+                "max": max(values) if values else None}
+
+    report = {
+        "devices": devices,
+        "workers": workers,
+        "image_size": image_size,
+        "elapsed": elapsed,
+        "states": dict(collections.Counter(job.state for job in jobs)),
+        "failures": dict(collections.Counter(failure_mode(job) for job in jobs if job.state != ota_engine.SUCCESS)),
+        "throughput": sum(job.bytes_total for job in succeeded) / elapsed if elapsed else 0,
+        "job_seconds": summary(durations),
+        "transfer_seconds": summary(transfers),
+        "invitation_seconds": summary(invitations),
+        "peak_fds": monitor.peak_fds,
+        "peak_threads": monitor.peak_threads,
+        "peak_rss": monitor.peak_rss,
+        "cpu_user": cpu_after.user - cpu_before.user,
+        "cpu_system": cpu_after.system - cpu_before.system,
+    }
+    if report["peak_rss"] is None and HAS_RESOURCE:
+        # ru_maxrss is in KB on Linux, bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        report["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return report
+
+
+def print_report(report: dict):
+    def seconds(value):
+        return f"{value:.2f} s" if value is not None else "-"
+
+    print(f"Devices:        {report['devices']} with {report['workers']} workers,"
+          f" {report['image_size'] // 1024} KB image")
+    print(f"Elapsed:        {report['elapsed']:.1f} s")
+    print(f"Outcome:        " + ", ".join(f"{count} {state}" for state, count in sorted(report["states"].items())))
+    print(f"Throughput:     {report['throughput'] / 1024:.1f} KB/s aggregate")
+    for name, label in (("job_seconds", "Job total"), ("transfer_seconds", "Transfer"),
+                        ("invitation_seconds", "Invitation")):
+        values = report[name]
+        print(f"{label + ':':<15} p50 {seconds(values['p50'])}  p90 {seconds(values['p90'])}"
+              f"  p99 {seconds(values['p99'])}  max {seconds(values['max'])}")
+    print(f"Peak FDs:       {report['peak_fds'] if report['peak_fds'] is not None else '-'}")
+    print(f"Peak threads:   {report['peak_threads']}")
+    rss = report["peak_rss"]
+    print(f"Peak RSS:       {rss / 1024 / 1024:.1f} MB" if rss else "Peak RSS:       -")
+    print(f"CPU:            {report['cpu_user']:.1f} s user, {report['cpu_system']:.1f} s system")
+    if report["failures"]:
+        print("Failure modes:")
+        for mode, count in sorted(report["failures"].items(), key=lambda item: -item[1]):
+            print(f"  {count:>5}  {mode}")
+
+
+def run_with_dashboard(run) -> dict:
+    """Run the simulation in the background while a window shows its dashboard; returns once both are done"""
+    import tkinter as tk
+    from ota_dashboard import FleetDashboard, FleetModel
+
+    root = tk.Tk()
+    root.title("Fleet simulation")
+    root.geometry("900x600")
+    root.columnconfigure(0, weight=1)
+    root.rowconfigure(0, weight=1)
+    dashboard = FleetDashboard(root, FleetModel())
+    dashboard.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
+
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(report=run(dashboard.model)), daemon=True)
+    thread.start()
+    root.mainloop()
+    thread.join()
+    print(f"Dashboard:      {dashboard.render_stats()}")
+    return result["report"]
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="simulate", description="Flash a fleet of fake ESP32s on loopback.")
+    parser.add_argument("-n", "--devices", type=int, default=200, help="Fake devices (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=50, help="Concurrent uploads (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=512, help="Image size in KB (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=2, help="Mean delay per ack in ms (default: %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.5,
+                        help="Spread of the latency between devices, as a fraction (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=0, help="Link speed per device in KB/s (default: unlimited)")
+    parser.add_argument("--drop", type=float, default=0, help="Probability a device ignores an invitation")
+    parser.add_argument("--abort", type=float, default=0, help="Probability a device drops the connection")
+    parser.add_argument("--corrupt", type=float, default=0, help="Probability a device reports an MD5 mismatch")
+    parser.add_argument("-a", "--auth", default="", help="OTA password of the fake devices (default: none)")
+    parser.add_argument("--distinct-images", action="store_true", help="Give every device its own image")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible fleets")
+    parser.add_argument("--timeout", type=float, default=600, help="Give up after this many seconds")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--dashboard", action="store_true", help="Watch the fleet in the GUI's Fleet view")
+    options = parser.parse_args(args)
+
+    run = lambda model=None: simulate(options.devices, options.workers, options.size * 1024, options.latency / 1000,
+                                      options.jitter, options.rate * 1024, options.drop, options.abort,
+                                      options.corrupt, options.auth, options.distinct_images, options.seed,
+                                      options.timeout, log=(lambda message: None) if options.json else print,
+                                      model=model)
+    if options.dashboard:
+        report = run_with_dashboard(run)
+    else:
+        report = run()
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
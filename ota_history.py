@@ -0,0 +1,166 @@
+import argparse
+import datetime
+import sqlite3
+import sys
+import threading
+import time
+
+from ota_paths import get_data_directory
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    host TEXT NOT NULL,
+    release_tag TEXT,
+    image_path TEXT,
+    image_digest TEXT,
+    partition TEXT NOT NULL,
+    size INTEGER,
+    invitation_s REAL,
+    auth_s REAL,
+    connect_s REAL,
+    transfer_s REAL,
+    result_s REAL,
+    total_s REAL,
+    throughput REAL,
+    retries INTEGER DEFAULT 0,
+    outcome TEXT NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_host_started ON uploads (host, started);
+CREATE INDEX IF NOT EXISTS uploads_outcome_host ON uploads (outcome, host, partition, started);
+CREATE INDEX IF NOT EXISTS uploads_throughput ON uploads (outcome, throughput);
+"""
+
+# Phases reported by espota.serve() in its timings dict
+PHASES = ("invitation", "auth", "connect", "transfer", "result")
+
+
+def get_history_path():
+    return get_data_directory() / "history.sqlite3"
+
+
+class UploadHistory:
+    """Append-only record of every OTA upload"""
+
+    def __init__(self, path=None):
+        self.path = str(path or get_history_path())
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, host: str, partition: str, outcome: str, timings: dict = None, release_tag: str = "",
+               image_path: str = "", image_digest: str = "", size: int = 0, error: str = "",
+               started: float = None) -> int:
+        """Append one upload; timings is the dict filled in by espota.serve()"""
+        timings = timings or {}
+        transfer = timings.get("transfer")
+        throughput = size / transfer if size and transfer else None
+        total = sum(timings.get(phase) or 0 for phase in PHASES)
+        row = (
+            started or time.time(), host, release_tag, image_path, image_digest, partition, size,
+            timings.get("invitation"), timings.get("auth"), timings.get("connect"), transfer,
+            timings.get("result"), total, throughput, timings.get("retries", 0), outcome, error,
+        )
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO uploads (started, host, release_tag, image_path, image_digest, partition, size,"
+                " invitation_s, auth_s, connect_s, transfer_s, result_s, total_s, throughput, retries, outcome,"
+                " error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            return cursor.lastrowid
+
+    def _query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params)]
+
+    def recent(self, limit: int = 50, host: str = None) -> list:
+        """Latest uploads, newest first"""
+        if host:
+            return self._query("SELECT * FROM uploads WHERE host = ? ORDER BY started DESC LIMIT ?", (host, limit))
+        return self._query("SELECT * FROM uploads ORDER BY started DESC LIMIT ?", (limit,))
+
+    def slowest_devices(self, limit: int = 10) -> list:
+        """Hosts ordered by their average throughput over successful uploads, slowest first"""
+        return self._query(
+            "SELECT host, COUNT(*) AS uploads, AVG(throughput) AS avg_throughput,"
+            " MIN(throughput) AS min_throughput, AVG(total_s) AS avg_total_s, SUM(retries) AS retries"
+            " FROM uploads WHERE outcome = 'success' AND throughput IS NOT NULL"
+            " GROUP BY host ORDER BY avg_throughput ASC LIMIT ?", (limit,))
+
+    def throughput_trend(self, host: str, limit: int = 100) -> list:
+        """Throughput of the successful uploads to host, oldest first"""
+        rows = self._query(
+            "SELECT started, partition, release_tag, throughput, total_s FROM uploads"
+            " WHERE outcome = 'success' AND host = ? ORDER BY started DESC LIMIT ?", (host, limit))
+        return list(reversed(rows))
+
+    def last_successful(self, host: str = None) -> list:
+        """Latest successful upload per host and partition"""
+        sql = ("SELECT u.host, u.partition, u.release_tag, u.image_digest, u.started FROM uploads u"
+               " WHERE u.outcome = 'success' AND u.started = (SELECT MAX(started) FROM uploads"
+               " WHERE outcome = 'success' AND host = u.host AND partition = u.partition)")
+        if host:
+            return self._query(sql + " AND u.host = ? ORDER BY u.partition", (host,))
+        return self._query(sql + " ORDER BY u.host, u.partition")
+
+
+def format_timestamp(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_rate(rate) -> str:
+    return f"{rate / 1024:.1f} KB/s" if rate else "-"
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="history", description="Query the OTA upload history.")
+    parser.add_argument("--db", help="History database (default: %(default)s)", default=str(get_history_path()))
+    sub = parser.add_subparsers(dest="query")
+    sub.required = True
+    recent = sub.add_parser("recent", help="Latest uploads")
+    recent.add_argument("host", nargs="?")
+    recent.add_argument("-n", "--limit", type=int, default=20)
+    slowest = sub.add_parser("slowest", help="Slowest devices by average throughput")
+    slowest.add_argument("-n", "--limit", type=int, default=10)
+    trend = sub.add_parser("trend", help="Throughput trend for one host")
+    trend.add_argument("host")
+    trend.add_argument("-n", "--limit", type=int, default=50)
+    last = sub.add_parser("last", help="Last successful firmware per machine")
+    last.add_argument("host", nargs="?")
+    options = parser.parse_args(args)
+
+    history = UploadHistory(options.db)
+    try:
+        if options.query == "recent":
+            for row in history.recent(options.limit, options.host):
+                print(f"{format_timestamp(row['started'])}  {row['host']:<20} {row['partition']:<7}"
+                      f" {row['outcome']:<8} {format_rate(row['throughput']):>12}  {row['release_tag'] or ''}")
+        elif options.query == "slowest":
+            for row in history.slowest_devices(options.limit):
+                print(f"{row['host']:<20} {format_rate(row['avg_throughput']):>12} avg"
+                      f" {format_rate(row['min_throughput']):>12} min  {row['uploads']} uploads,"
+                      f" {row['retries'] or 0} retries")
+        elif options.query == "trend":
+            for row in history.throughput_trend(options.host, options.limit):
+                print(f"{format_timestamp(row['started'])}  {row['partition']:<7}"
+                      f" {format_rate(row['throughput']):>12}  {row['release_tag'] or ''}")
+        elif options.query == "last":
+            for row in history.last_successful(options.host):
+                print(f"{row['host']:<20} {row['partition']:<7} {row['release_tag'] or '-':<16}"
+                      f" {row['image_digest']}  {format_timestamp(row['started'])}")
+    finally:
+        history.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+# Bytes read from an image file at a time
+READ_SIZE = 1024 * 1024
+
+
+class Image:
+    """A firmware/filesystem image loaded once and shared read-only between uploads
+
+    The file is copied into memory rather than mapped: builds rewrite
+    images in place, and a mapped file that shrinks kills the process with
+    SIGBUS on the next read instead of failing one upload. md5 and sha256
+    can be passed in when they are already known (see ota_prepare),
+    otherwise they are computed here.
+    """
+
+    def __init__(self, path: str, key, md5: str = None, sha256: str = None):
+        self.path = path
+        self.key = key
+        self.refs = 0
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = bytearray(size)
+            view = memoryview(data)
+            offset = 0
+            while offset < size:
+                read = f.readinto(view[offset:offset + READ_SIZE])
+                if not read:
+                    break
+                offset += read
+            view.release()
+            if offset != size or os.fstat(f.fileno()).st_size != size:
+                raise IOError(f"{os.path.basename(path)} changed while it was being read")
+        self.data = memoryview(data).toreadonly()
+
+        self.size = len(self.data)
+        self.md5 = md5 or hashlib.md5(self.data).hexdigest()
+        self._sha256 = sha256
+
+    def sha256(self) -> str:
+        """SHA-256 of the image (as published for GitHub release assets), computed on first use"""
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def chunk(self, offset: int, length: int) -> memoryview:
+        """Read-only view of length bytes starting at offset"""
+        return self.data[offset:offset + length]
+
+    def close(self):
+        """Drop the image; views still held by callers keep it alive until released"""
+        try:
+            self.data.release()
+        except BufferError:
+            pass
+
+
+class ImageRegistry:
+    """Loads each unique image once and reference counts it across concurrent uploads
+
+    Unreferenced images are evicted right away unless keep is set, in which
+    case the keep most recently used ones stay loaded for later uploads.
+    Digests computed elsewhere can be handed over with remember_digests().
+    """
+
+    # Remembered digests of images not loaded yet
+    MAX_DIGESTS = 256
+
+    def __init__(self, keep: int = 0):
+        self._images = {}
+        self._idle = OrderedDict()
+        self._digests = OrderedDict()
+        self._loading = {}              # key -> Event set once that image is loaded (or failed to load)
+        self._lock = threading.Lock()
+        self.keep = keep
+
+    @staticmethod
+    def _key(path: str):
+        st = os.stat(path)
+        return os.path.realpath(path), st.st_size, st.st_mtime_ns
+
+    def remember_digests(self, path: str, size: int, mtime_ns: int, md5: str, sha256: str = None):
+        """Use these digests when path is loaded, as long as it still has this size and mtime"""
+        key = (os.path.realpath(path), size, mtime_ns)
+        with self._lock:
+            self._digests[key] = (md5, sha256)
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.MAX_DIGESTS:
+                self._digests.popitem(last=False)
+
+    def acquire(self, path: str) -> Image:
+        """Return the shared image for path, loading and hashing it on first use
+
+        Images are read outside the registry lock, so different images load
+        in parallel; concurrent acquires of the same image wait for one load.
+        """
+        key = self._key(path)
+        while True:
+            with self._lock:
+                image = self._images.get(key)
+                if image is not None:
+                    self._idle.pop(key, None)
+                    image.refs += 1
+                    return image
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    md5, sha256 = self._digests.get(key, (None, None))
+                    break
+            # Another thread is reading this image; take it once published, or load it if that failed
+            loading.wait()
+
+        try:
+            image = Image(path, key, md5, sha256)
+        except BaseException:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+            raise
+        with self._lock:
+            del self._loading[key]
+            self._images[key] = image
+            image.refs += 1
+        loading.set()
+        return image
+
+    def release(self, image: Image):
+        """Drop a reference; the image is evicted once no upload needs it"""
+        evicted = []
+        with self._lock:
+            image.refs -= 1
+            if image.refs > 0:
+                return
+            if self._images.get(image.key) is not image:
+                evicted.append(image)
+            else:
+                self._idle[image.key] = image
+                while len(self._idle) > self.keep:
+                    key, idle = self._idle.popitem(last=False)
+                    del self._images[key]
+                    evicted.append(idle)
+        for idle in evicted:
+            idle.close()
+
+    def stats(self) -> dict:
+        """Number of loaded images, their total size and reference counts"""
+        with self._lock:
+            return {
+                "images": len(self._images),
+                "idle": len(self._idle),
+                "bytes": sum(image.size for image in self._images.values()),
+                "refs": {image.path: image.refs for image in self._images.values()},
+            }
+
+
+# Registry shared by every upload in this process
+registry = ImageRegistry()
@@ -0,0 +1,383 @@
+import argparse
+import ipaddress
+import logging
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ota_credentials import normalize_host
+from ota_jsonstore import file_stamp, read_json, update_json
+from ota_paths import get_data_directory
+
+
+DEFAULT_OTA_PORT = 3232
+# How long a resolved address is trusted
+RESOLVE_TTL = 300
+# After the TTL, the old address is still used for this long while it is looked up again in the background
+STALE_GRACE = 3600
+# Concurrent lookups of a background refresh (mDNS misses can take seconds each)
+REFRESH_WORKERS = 8
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.strip())
+        return True
+    except ValueError:
+        return False
+
+
+class Device:
+    """A known ESP32: how to reach it and what it was last flashed with"""
+
+    def __init__(self, name: str, hostname: str = None, port: int = DEFAULT_OTA_PORT, ip: str = None,
+                 resolved: float = None, resolve_error: str = "", credential: str = None,
+                 firmware_digest: str = "", filesystem_digest: str = "", profile: dict = None,
+                 last_flashed: float = None, deltas: bool = None, route: dict = None):
+        self.name = name
+        self.hostname = hostname or name
+        self.port = port
+        self.ip = ip                            # last address the hostname resolved to
+        self.resolved = resolved                # time of that lookup
+        self.resolve_error = resolve_error      # why the latest lookup failed, if it did
+        self.credential = credential            # key of the password in the CredentialStore, None = hostname
+        self.firmware_digest = firmware_digest  # MD5 of the images last flashed successfully
+        self.filesystem_digest = filesystem_digest
+        self.profile = profile                  # transport profile in use at the last upload
+        self.last_flashed = last_flashed
+        self.deltas = deltas                    # whether its firmware accepts deltas, None = not tried yet
+        self.route = route                      # local interface it last answered over, {"name", "address"}
+
+    def age(self, now: float = None):
+        """Seconds since the address was resolved, None if it never was"""
+        if self.resolved is None:
+            return None
+        return (now or time.time()) - self.resolved
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "hostname": self.hostname,
+            "port": self.port,
+            "ip": self.ip,
+            "resolved": self.resolved,
+            "resolve_error": self.resolve_error,
+            "credential": self.credential,
+            "firmware_digest": self.firmware_digest,
+            "filesystem_digest": self.filesystem_digest,
+            "profile": self.profile,
+            "last_flashed": self.last_flashed,
+            "deltas": self.deltas,
+            "route": self.route,
+        }
+
+    def update(self, data: dict):
+        """Take over the fields of data (a to_dict() of this device)"""
+        for key, value in Device.from_dict(data).to_dict().items():
+            setattr(self, key, value)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        fields = cls("").to_dict()
+        return cls(**{key: value for key, value in data.items() if key in fields})
+
+    def __repr__(self):
+        return f"Device({self.name}, {self.hostname}:{self.port})"
+
+
+def get_inventory_path():
+    return get_data_directory() / "inventory.json"
+
+
+class DeviceInventory:
+    """Known devices keyed by name, with cached address lookups, persisted as JSON
+
+    Devices can be looked up by name, hostname or address. Addresses are
+    reused for ttl seconds; for another grace seconds the old one is still
+    returned while a fresh lookup runs in the background, and when a lookup
+    fails the last known address is used. Hosts that are not in the
+    inventory are cached the same way, in memory only. The file is shared
+    with other flasher processes: it is read again whenever one of them
+    changed it, and each change is written on top of the current file.
+    """
+
+    def __init__(self, path=None, resolver=socket.gethostbyname, ttl: float = RESOLVE_TTL,
+                 grace: float = STALE_GRACE):
+        self.path = str(path or get_inventory_path())
+        self.resolver = resolver
+        self.ttl = ttl
+        self.grace = grace
+        self._lock = threading.Lock()
+        self._devices = None
+        self._stamp = None
+        self._unlisted = {}
+        self._refreshing = set()
+        self._executor = None
+
+    def _load(self) -> dict:
+        stamp = file_stamp(self.path)
+        if self._devices is None or stamp != self._stamp:
+            self._sync(read_json(self.path), stamp)
+        return self._devices
+
+    def _sync(self, data: dict, stamp):
+        """Take over the devices of the file, updating the Device objects already handed out"""
+        devices = {}
+        for name, fields in data.items():
+            device = (self._devices or {}).get(name)
+            if device is None:
+                device = Device.from_dict(fields)
+            else:
+                device.update(fields)
+            devices[name] = device
+        self._devices = devices
+        self._stamp = stamp
+
+    def _save(self, name: str, *fields):
+        """Write the device named name (or its removal) on top of the file; with fields, only those"""
+        device = self._devices.get(name)
+
+        def change(data):
+            if device is None:
+                data.pop(name, None)
+            elif fields and name in data:
+                current = device.to_dict()
+                data[name].update({field: current[field] for field in fields})
+            else:
+                data[name] = device.to_dict()
+
+        data = update_json(self.path, change)
+        self._sync(data, file_stamp(self.path))
+
+    def _find(self, host: str):
+        key = normalize_host(host)
+        devices = self._load()
+        if key in devices:
+            return devices[key]
+        for device in devices.values():
+            if normalize_host(device.hostname) == key or device.ip == key:
+                return device
+        return None
+
+    # Devices
+
+    def get(self, host: str, default=None):
+        """Return the device named host, or with host as hostname or address"""
+        with self._lock:
+            return self._find(host) or default
+
+    def devices(self) -> list:
+        with self._lock:
+            return [self._devices[name] for name in sorted(self._load())]
+
+    def add(self, name: str, hostname: str = None, port: int = DEFAULT_OTA_PORT, credential: str = None) -> Device:
+        """Add a device, or change how an existing one is reached"""
+        key = normalize_host(name)
+        with self._lock:
+            device = self._load().get(key) or self._unlisted.pop(key, None) or Device(key)
+            if hostname and normalize_host(hostname) != normalize_host(device.hostname):
+                device.hostname = hostname.strip()
+                device.ip = device.resolved = None
+            device.port = port
+            if credential:
+                device.credential = credential
+            self._devices[key] = device
+            self._save(key, "hostname", "port", "ip", "resolved", "credential")
+            return device
+
+    def remove(self, name: str) -> bool:
+        with self._lock:
+            if self._load().pop(normalize_host(name), None) is None:
+                return False
+            self._save(normalize_host(name))
+            return True
+
+    def credential_key(self, host: str) -> str:
+        """Key of host's password in the CredentialStore"""
+        device = self.get(host)
+        if device is None:
+            return host
+        return device.credential or device.hostname
+
+    def record_upload(self, host: str, partition: str, digest: str, profile=None):
+        """Remember what a device was flashed with; hosts flashed successfully join the inventory"""
+        key = normalize_host(host)
+        with self._lock:
+            device = self._find(host)
+            if device is None:
+                device = self._unlisted.pop(key, None) or Device(key, hostname=host.strip())
+                self._load()[key] = device
+            if partition == "app":
+                device.firmware_digest = digest
+            else:
+                device.filesystem_digest = digest
+            if profile is not None:
+                device.profile = profile.to_dict()
+            device.last_flashed = time.time()
+            self._save(device.name, "firmware_digest" if partition == "app" else "filesystem_digest", "profile",
+                       "last_flashed")
+
+    def record_route(self, host: str, route):
+        """Remember the local interface (an ota_routes.Route) a listed device answered over, to try it first"""
+        with self._lock:
+            device = self._find(host)
+            if device is not None and device.route != route.to_dict():
+                device.route = route.to_dict()
+                self._save(device.name, "route")
+
+    def record_deltas(self, host: str, supported: bool):
+        """Remember whether a listed device's firmware answered a delta invitation"""
+        with self._lock:
+            device = self._find(host)
+            if device is not None and device.deltas != supported:
+                device.deltas = supported
+                self._save(device.name, "deltas")
+
+    # Resolution
+
+    def resolve(self, host: str) -> str:
+        """Address of host, from the cache when it is recent enough; raises OSError if it was never resolved"""
+        host = host.strip()
+        if is_ip_address(host):
+            return host
+        with self._lock:
+            device = self._find(host) or self._unlisted.setdefault(normalize_host(host), Device(normalize_host(host),
+                                                                                                hostname=host))
+            ip, age = device.ip, device.age()
+        if age is None:
+            age = float("inf")
+        if ip is not None and age < self.ttl:
+            return ip
+        if ip is not None and age < self.ttl + self.grace:
+            self.refresh_async([host])
+            return ip
+        try:
+            return self.refresh(host)
+        except OSError as e:
+            if ip is None:
+                raise
+            logging.warning("Cannot resolve %s (%s), using its last known address %s", host, e, ip)
+            return ip
+
+    def refresh(self, host: str) -> str:
+        """Look host up now and cache the answer"""
+        with self._lock:
+            device = self._find(host) or self._unlisted.setdefault(normalize_host(host), Device(normalize_host(host),
+                                                                                                hostname=host))
+            hostname = device.hostname
+        try:
+            ip = self.resolver(hostname)
+        except OSError as e:
+            with self._lock:
+                device.resolve_error = str(e)
+                if self._devices.get(device.name) is device:
+                    self._save(device.name, "resolve_error")
+            raise
+        with self._lock:
+            changed = ip != device.ip or device.resolve_error
+            device.ip, device.resolved, device.resolve_error = ip, time.time(), ""
+            if self._devices.get(device.name) is device and changed:
+                self._save(device.name, "ip", "resolved", "resolve_error")
+        return ip
+
+    def refresh_async(self, hosts=None, callback=None):
+        """Resolve hosts (default: every device) in the background
+
+        callback(host, address or None) is called from a worker thread after
+        each lookup. Hosts already being looked up are skipped.
+        """
+        if hosts is None:
+            hosts = [device.name for device in self.devices()]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="ota-resolve")
+            hosts = [host for host in hosts if normalize_host(host) not in self._refreshing]
+            self._refreshing.update(normalize_host(host) for host in hosts)
+        for host in hosts:
+            self._executor.submit(self._refresh_in_background, host, callback)
+
+    def _refresh_in_background(self, host: str, callback):
+        ip = None
+        try:
+            ip = self.refresh(host)
+        except OSError as e:
+            logging.debug("Background lookup of %s failed: %s", host, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(normalize_host(host))
+        if callback is not None:
+            callback(host, ip)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def format_age(seconds) -> str:
+    if seconds is None:
+        return "never"
+    if seconds < 120:
+        return f"{seconds:.0f} s ago"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f} min ago"
+    return f"{seconds / 3600:.0f} h ago"
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="inventory", description="Manage the known devices.")
+    sub = parser.add_subparsers(dest="action")
+    sub.required = True
+    sub.add_parser("list", help="Show the devices")
+    add = sub.add_parser("add", help="Add a device or change its address")
+    add.add_argument("name")
+    add.add_argument("--hostname", help="Hostname or IP address (default: the name)")
+    add.add_argument("-p", "--port", type=int, default=DEFAULT_OTA_PORT)
+    add.add_argument("--credential", help="Use the password stored for this host (default: the hostname)")
+    remove = sub.add_parser("remove", help="Forget a device")
+    remove.add_argument("name")
+    sub.add_parser("refresh", help="Resolve every device again")
+    options = parser.parse_args(args)
+
+    inventory = DeviceInventory()
+    if options.action == "add":
+        device = inventory.add(options.name, options.hostname, options.port, options.credential)
+        print(f"Added {device.name} ({device.hostname}:{device.port})")
+    elif options.action == "remove":
+        if not inventory.remove(options.name):
+            print(f"No device named {options.name}", file=sys.stderr)
+            return 1
+    elif options.action == "refresh":
+        done = threading.Event()
+        remaining = [len(inventory.devices())]
+        lock = threading.Lock()
+
+        def report(host, ip):
+            with lock:
+                print(f"{host:<20} {ip or 'not resolved'}")
+                remaining[0] -= 1
+                if remaining[0] <= 0:
+                    done.set()
+
+        if remaining[0]:
+            inventory.refresh_async(callback=report)
+            done.wait()
+        inventory.close()
+    else:
+        now = time.time()
+        for device in inventory.devices():
+            address = device.ip or "-"
+            if device.resolve_error:
+                address += " (lookup failing)"
+            firmware = device.firmware_digest[:8] or "-"
+            filesystem = device.filesystem_digest[:8] or "-"
+            print(f"{device.name:<20} {device.hostname + ':' + str(device.port):<28} {address:<32}"
+                  f" {format_age(device.age(now)):<12} app {firmware:<8}  fs {filesystem}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
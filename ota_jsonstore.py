@@ -0,0 +1,75 @@
+import contextlib
+import json
+import os
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import msvcrt
+    HAS_MSVCRT = True
+except ImportError:
+    HAS_MSVCRT = False
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on path (through path + ".lock") against every other process"""
+    with open(path + ".lock", "a+b") as f:
+        if HAS_FCNTL:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif HAS_MSVCRT:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 s
+                    continue
+        try:
+            yield
+        finally:
+            if HAS_FCNTL:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif HAS_MSVCRT:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def file_stamp(path: str):
+    """Changes whenever path is rewritten, None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def read_json(path: str) -> dict:
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def update_json(path: str, change) -> dict:
+    """Apply change(data) to what is on disk now and write it back, under the lock; returns the new data
+
+    Several processes (the GUI, the daemon, watch mode, espota) write the
+    same files, so each writes its own change on top of the others' instead
+    of the copy it loaded earlier.
+    """
+    with file_lock(path):
+        data = read_json(path)
+        change(data)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+    return data
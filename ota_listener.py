@@ -0,0 +1,194 @@
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from ota_cancel import CancelToken
+
+
+# Port devices connect back to when uploads share a listener; one firewall rule covers every upload
+DEFAULT_CONNECT_PORT = 8268
+# Ports of the pool, for concurrent uploads to devices behind the same address (e.g. fake devices)
+DEFAULT_POOL_SIZE = 4
+POLL_INTERVAL = 0.25
+
+
+def claim_address(sock: socket.socket):
+    """Let a restarted flasher bind its ports again right away without sharing them with a running one
+
+    On Windows SO_REUSEADDR lets a second process bind a port that is in
+    use, and connections would go to either; there the port is claimed
+    exclusively instead, so binding fails as it does elsewhere.
+    """
+    if hasattr(socket, "SO_EXCLUSIVEADDRUSE"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+
+class Slot:
+    """A session's claim on a listener port for connections from one address"""
+
+    def __init__(self, listener, port: int, peer: str):
+        self.listener = listener
+        self.port = port
+        self.peer = peer
+        self.connection = None
+        self.shared = True
+        self._ready = threading.Event()
+
+    def deliver(self, connection) -> bool:
+        if self.connection is not None:
+            return False
+        self.connection = connection
+        self._ready.set()
+        return True
+
+    def wait(self, timeout: float, cancel=None):
+        """The connection of the peer; raises socket.timeout or Cancelled"""
+        deadline = time.time() + timeout
+        while not self._ready.wait(min(POLL_INTERVAL, max(0.0, deadline - time.time()))):
+            if cancel is not None:
+                cancel.check()
+            if time.time() >= deadline:
+                raise socket.timeout("timed out")
+        return self.connection
+
+    def release(self):
+        self.listener.release(self)
+
+
+class ConnectBackListener:
+    """One long-lived listener accepting the connect-backs of every upload
+
+    Each session claims a slot for the device's address before sending the
+    invitation, and the device's connection is handed to that session;
+    connections nobody waits for are closed. As the connection is told apart
+    by address only, concurrent sessions to the same address spread over the
+    ports of the pool (or wait for one to free up). Port 0 binds ephemeral
+    ports.
+    """
+
+    def __init__(self, bind: str = "0.0.0.0", port: int = DEFAULT_CONNECT_PORT, pool_size: int = DEFAULT_POOL_SIZE):
+        self.bind = bind
+        self._lock = threading.Condition()
+        self._slots = {}                # (peer, port) -> Slot
+        self._sockets = []
+        self._selector = selectors.DefaultSelector()
+        self._closing = False
+        try:
+            for index in range(max(1, pool_size)):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                claim_address(sock)
+                self._sockets.append(sock)
+                sock.bind((bind, port + index if port else 0))
+                sock.listen(128)
+                sock.setblocking(False)
+                self._selector.register(sock, selectors.EVENT_READ)
+        except OSError:
+            self.close()
+            raise
+        self.ports = [sock.getsockname()[1] for sock in self._sockets]
+        self._thread = threading.Thread(target=self._run, name="ota-connect-back", daemon=True)
+        self._thread.start()
+
+    def claim(self, peer: str, timeout: float = 60, cancel=None) -> Slot:
+        """Reserve a port for a session with peer, waiting while all of them are in use for it"""
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                for port in self.ports:
+                    if (peer, port) not in self._slots:
+                        slot = Slot(self, port, peer)
+                        self._slots[(peer, port)] = slot
+                        return slot
+                if cancel is not None:
+                    cancel.check()
+                if time.time() >= deadline or self._closing:
+                    raise socket.timeout(f"no free connect-back port for {peer}")
+                self._lock.wait(POLL_INTERVAL)
+
+    def release(self, slot: Slot):
+        with self._lock:
+            if self._slots.get((slot.peer, slot.port)) is slot:
+                del self._slots[(slot.peer, slot.port)]
+                self._lock.notify_all()
+
+    def sessions(self) -> int:
+        with self._lock:
+            return len(self._slots)
+
+    def _run(self):
+        while not self._closing:
+            try:
+                events = self._selector.select(POLL_INTERVAL)
+            except (OSError, ValueError):
+                break
+            for key, _ in events:
+                try:
+                    connection, address = key.fileobj.accept()
+                except OSError:
+                    continue
+                connection.setblocking(True)
+                port = key.fileobj.getsockname()[1]
+                with self._lock:
+                    slot = self._slots.get((address[0], port))
+                if slot is None or not slot.deliver(connection):
+                    logging.debug("Unexpected connection from %s on port %d", address[0], port)
+                    connection.close()
+
+    def close(self):
+        self._closing = True
+        with self._lock:
+            self._lock.notify_all()
+        for sock in self._sockets:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            sock.close()
+        self._selector.close()
+
+
+class PrivateListener:
+    """A listener of its own for a single session, on an ephemeral port unless one is given
+
+    Has the same interface as a Slot, so espota can use either.
+    """
+
+    def __init__(self, bind: str = "0.0.0.0", port: int = 0, send_buffer: int = 0, cancel: CancelToken = None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if cancel is not None:
+            cancel.register(self.sock)
+        claim_address(self.sock)
+        if send_buffer:
+            # inherited by the accepted connection
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+        try:
+            self.sock.bind((bind, port))
+            self.sock.listen(1)
+        except OSError:
+            self.sock.close()
+            raise
+        self.port = self.sock.getsockname()[1]
+        self.shared = False             # the socket options are inherited from the listener
+
+    def wait(self, timeout: float, cancel=None):
+        deadline = time.time() + timeout
+        while True:
+            if cancel is not None:
+                cancel.check()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            self.sock.settimeout(min(remaining, POLL_INTERVAL))
+            try:
+                connection, address = self.sock.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            return connection
+
+    def release(self):
+        self.sock.close()
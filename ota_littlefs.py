@@ -0,0 +1,214 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+from ota_paths import get_data_directory
+
+try:
+    import littlefs
+    HAS_LITTLEFS = True
+except ImportError:
+    HAS_LITTLEFS = False
+
+
+# Geometry used by mklittlefs for the ESP32; must match the firmware's LittleFS
+BLOCK_SIZE = 4096
+PAGE_SIZE = 256
+NAME_MAX = 64
+# Size of the "spiffs" partition in the default ESP32 partition table
+DEFAULT_IMAGE_SIZE = 0x170000
+# Bump when the way images are laid out changes, to invalidate cached images
+FORMAT_VERSION = 1
+# Built images kept around for switching back and forth between versions
+KEEP_IMAGES = 8
+
+
+def get_cache_directory() -> Path:
+    cache_dir = get_data_directory() / "littlefs"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileHashCache:
+    """SHA-256 of files keyed by (path, size, mtime), so unchanged files are not read again"""
+
+    def __init__(self, path=None):
+        self.path = str(path or get_cache_directory() / "hashes.json")
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self.path) as f:
+                self._hashes = json.load(f)
+        except (OSError, ValueError):
+            self._hashes = {}
+
+    def digest(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            cached = self._hashes.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = sha256_file(path)
+        with self._lock:
+            self._hashes[key] = [stat.st_size, stat.st_mtime_ns, digest]
+            self._dirty = True
+        return digest
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self._hashes, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+
+class BuildResult:
+    def __init__(self, path: str, md5: str, files: int, size: int, reused: bool):
+        self.path = path
+        self.md5 = md5
+        self.files = files
+        self.size = size
+        self.reused = reused            # served from the image cache, nothing was encoded
+
+
+def manifest(data_dir: str, hashes: FileHashCache) -> list:
+    """(relative path, size, sha256) of every file below data_dir, in a stable order"""
+    entries = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative = Path(os.path.relpath(path, data_dir)).as_posix()
+            entries.append((relative, os.path.getsize(path), hashes.digest(path)))
+    return entries
+
+
+def encode_image(data_dir: str, entries: list, image_size: int) -> bytes:
+    """Write the files into a fresh LittleFS, always in the same order, so equal input gives equal bytes"""
+    if not HAS_LITTLEFS:
+        raise RuntimeError("Building LittleFS images needs littlefs-python (pip install littlefs-python)")
+    fs = littlefs.LittleFS(block_size=BLOCK_SIZE, block_count=image_size // BLOCK_SIZE, read_size=PAGE_SIZE,
+                           prog_size=PAGE_SIZE, name_max=NAME_MAX)
+    for relative, size, digest in entries:
+        try:
+            directory = os.path.dirname(relative)
+            if directory:
+                fs.makedirs(directory, exist_ok=True)
+            with open(os.path.join(data_dir, relative), 'rb') as source, fs.open(relative, 'wb') as target:
+                target.write(source.read())
+        except littlefs.LittleFSError as e:
+            # Mostly a full filesystem, which the size check cannot rule out because of metadata overhead
+            raise ValueError(f"Cannot add {relative} to the {image_size // 1024} KB image: {str(e)}") from e
+    return bytes(fs.context.buffer)
+
+
+def _write_atomic(path: str, data: bytes):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    # Renamed into place, so an upload reading the image never sees a half-written one
+    os.replace(temp_path, path)
+
+
+def build_image(data_dir: str, output: str, image_size: int = None, cache_dir=None, log=print) -> BuildResult:
+    """Build a LittleFS image of data_dir at output, reusing earlier work where possible
+
+    Files are only hashed when their size or mtime changed, and an image is
+    only encoded when the set of file contents (or the geometry) is new;
+    otherwise the cached image with the same manifest is reused. The output
+    is byte-for-byte deterministic, so its MD5 can be used to skip uploads.
+    """
+    cache_dir = Path(cache_dir or get_cache_directory())
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if image_size is None:
+        image_size = os.path.getsize(output) if os.path.exists(output) else DEFAULT_IMAGE_SIZE
+    if image_size % BLOCK_SIZE:
+        raise ValueError(f"Image size must be a multiple of {BLOCK_SIZE} bytes")
+
+    hashes = FileHashCache(cache_dir / "hashes.json")
+    entries = manifest(data_dir, hashes)
+    hashes.save()
+    total = sum(size for relative, size, digest in entries)
+    if total > image_size:
+        raise ValueError(f"{data_dir} holds {total:,} bytes, more than fits into the {image_size:,} byte partition")
+    key = hashlib.sha256(json.dumps({
+        "files": entries, "image_size": image_size, "block_size": BLOCK_SIZE, "page_size": PAGE_SIZE,
+        "name_max": NAME_MAX, "format": FORMAT_VERSION,
+    }).encode("utf-8")).hexdigest()
+    cached = cache_dir / f"{key}.bin"
+
+    reused = cached.exists()
+    if reused:
+        image = cached.read_bytes()
+        os.utime(cached)
+    else:
+        log(f"🧱 Encoding {len(entries)} files into a {image_size // 1024} KB LittleFS image...")
+        image = encode_image(data_dir, entries, image_size)
+        _write_atomic(str(cached), image)
+        _prune(cache_dir)
+
+    md5 = hashlib.md5(image).hexdigest()
+    if not (os.path.exists(output) and os.path.getsize(output) == len(image) and _md5_file(output) == md5):
+        _write_atomic(output, image)
+    return BuildResult(output, md5, len(entries), len(image), reused)
+
+
+def _md5_file(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _prune(cache_dir: Path):
+    images = sorted(cache_dir.glob("*.bin"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in images[KEEP_IMAGES:]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def default_output() -> str:
+    return str(get_cache_directory() / "littlefs.bin")
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="littlefs", description="Build a LittleFS image from a data directory.")
+    parser.add_argument("data_dir", help="Directory with the web UI files, e.g. the project's data/")
+    parser.add_argument("-o", "--output", default=default_output(), help="Image to write (default: %(default)s)")
+    parser.add_argument("--size", type=lambda value: int(value, 0), default=None,
+                        help=f"Partition size in bytes (default: size of the existing output, else {DEFAULT_IMAGE_SIZE:#x})")
+    options = parser.parse_args(args)
+
+    if not os.path.isdir(options.data_dir):
+        parser.error(f"{options.data_dir} is not a directory")
+    try:
+        result = build_image(options.data_dir, options.output, options.size)
+    except (RuntimeError, ValueError, OSError) as e:
+        print(f"❌ {str(e)}", file=sys.stderr)
+        return 1
+    print(f"✅ {result.path}: {result.files} files, {result.size:,} bytes, MD5 {result.md5}"
+          f"{' (unchanged, from cache)' if result.reused else ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,311 @@
+import argparse
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from ota_cancel import Cancelled
+from ota_download import download_file, partial_path, read_etag
+from ota_paths import get_download_directory
+from ota_preflight import fetch_release_digests
+
+
+GITHUB = "https://github.com"
+DEFAULT_REPO = "rancilio-pid/clevercoffee"
+DEFAULT_ASSETS = ("firmware.bin", "littlefs.bin")
+DEFAULT_MIRROR_PORT = 8267
+
+# Mirrors use the same URL layout as GitHub release downloads
+ASSET_PATH = re.compile(r"^/(?P<repo>[^/]+/[^/]+)/releases/download/(?P<tag>[^/]+)/(?P<name>[^/]+)$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def asset_url(base: str, repo: str, tag: str, name: str) -> str:
+    return f"{base.rstrip('/')}/{repo}/releases/download/{tag}/{name}"
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ReleaseCache:
+    """Downloaded release assets, one directory per tag
+
+    An asset counts as verified once its SHA-256 has been checked against
+    the digest GitHub publishes and written next to it; only verified
+    assets are served to other flashers.
+    """
+
+    def __init__(self, root=None):
+        self.root = Path(root or get_download_directory())
+
+    def path(self, tag: str, name: str) -> Path:
+        return self.root / tag / name
+
+    def digest_path(self, tag: str, name: str) -> Path:
+        return self.path(tag, name + ".sha256")
+
+    def digest(self, tag: str, name: str):
+        """SHA-256 of a verified asset, None if missing or not verified"""
+        try:
+            digest = self.digest_path(tag, name).read_text().strip()
+        except OSError:
+            return None
+        return digest if self.path(tag, name).exists() else None
+
+    def check(self, tag: str, name: str, expected: str = None) -> str:
+        """Hash a downloaded asset without marking it verified; raises ValueError on a digest mismatch"""
+        digest = sha256_file(self.path(tag, name))
+        if expected and digest != expected:
+            self.digest_path(tag, name).unlink(missing_ok=True)
+            raise ValueError(f"{name} has SHA-256 {digest}, expected {expected}")
+        return digest
+
+    def verify(self, tag: str, name: str, expected: str) -> str:
+        """Check a downloaded asset against its published digest and mark it verified"""
+        if not expected:
+            raise ValueError(f"No published digest to verify {name} against")
+        digest = self.check(tag, name, expected)
+        self.digest_path(tag, name).write_text(digest)
+        return digest
+
+    def unverify(self, tag: str, name: str):
+        """Stop serving an asset that could not be verified"""
+        self.digest_path(tag, name).unlink(missing_ok=True)
+
+    def assets(self) -> list:
+        """(tag, name) of every verified asset"""
+        found = []
+        if not self.root.is_dir():
+            return found
+        for digest_file in sorted(self.root.glob("*/*.sha256")):
+            tag, name = digest_file.parent.name, digest_file.name[:-len(".sha256")]
+            if self.digest(tag, name):
+                found.append((tag, name))
+        return found
+
+
+def fetch_release_asset(repo: str, tag: str, name: str, cache: ReleaseCache, mirrors=(), expected: str = None,
+                        cancel=None, progress=None, log=print) -> Path:
+    """Get a release asset into the cache, preferring LAN mirrors and falling back to GitHub
+
+    Repeat fetches revalidate the cached copy with its ETag and interrupted
+    ones resume with a Range request, so they cost next to nothing. Without
+    a digest published by GitHub (expected, or looked up here), the asset is
+    only checked against the mirror's ETag and not marked verified, so it
+    is not served to other flashers.
+    """
+    path = cache.path(tag, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if expected is None:
+        try:
+            expected = fetch_release_digests(repo, tag).get(name)
+        except Exception as e:
+            log(f"⚠️ Cannot look up the published digest of {name}: {str(e)}")
+            expected = None
+
+    for base in list(mirrors) + [GITHUB]:
+        url = asset_url(base, repo, tag, name)
+        try:
+            download_file(url, path, cancel=cancel, progress=progress)
+        except Cancelled:
+            raise
+        except Exception as e:
+            if base != GITHUB:
+                log(f"⚠️ Mirror {base} failed for {name}: {str(e)}")
+                continue
+            raise
+
+        try:
+            if expected:
+                cache.verify(tag, name, expected)
+            else:
+                # Mirrors publish the SHA-256 as ETag; that catches a broken transfer, not a bad mirror
+                mirror_digest = (read_etag(path) or "").strip('"') if base != GITHUB else ""
+                cache.check(tag, name, mirror_digest or None)
+                cache.unverify(tag, name)
+                log(f"⚠️ {name} could not be checked against a published digest, it is not shared with the LAN")
+        except ValueError as e:
+            log(f"❌ {str(e)}")
+            path.unlink()
+            partial_path(path).unlink(missing_ok=True)
+            if base == GITHUB:
+                raise
+            continue
+
+        if base != GITHUB:
+            log(f"🏠 {name} from mirror {base}")
+        return path
+
+    raise IOError(f"Could not fetch {name}")
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Serves verified cached release assets with ETag, Last-Modified and Range support"""
+
+    server_version = "CleverCoffeeMirror/1"
+
+    def log_message(self, format, *args):
+        logging.info("Mirror %s - %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.serve_asset(send_body=False)
+
+    def do_GET(self):
+        if self.path in ("/", "/index.json"):
+            body = json.dumps([{"tag": tag, "name": name, "sha256": self.server.cache.digest(tag, name)}
+                               for tag, name in self.server.cache.assets()]).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.serve_asset(send_body=True)
+
+    def serve_asset(self, send_body: bool):
+        match = ASSET_PATH.match(self.path.split("?", 1)[0])
+        cache = self.server.cache
+        digest = match and cache.digest(match.group("tag"), match.group("name"))
+        if not digest:
+            self.send_error(404)
+            return
+
+        path = cache.path(match.group("tag"), match.group("name"))
+        stat = path.stat()
+        etag = f'"{digest}"'
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        if not self.headers.get("If-None-Match") and self.headers.get("If-Modified-Since"):
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+            except (TypeError, ValueError):
+                # Malformed dates are ignored, as RFC 9110 asks
+                since = None
+            if since is not None and int(stat.st_mtime) <= since.timestamp():
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+        start, end = 0, stat.st_size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if self.headers.get("If-Range", etag).strip() != etag:
+            # The client has part of another version, send it all
+            range_header = None
+        if range_header:
+            requested = RANGE.match(range_header.strip())
+            if requested and requested.group(1):
+                start = int(requested.group(1))
+                if requested.group(2):
+                    end = min(int(requested.group(2)), end)
+            elif requested and requested.group(2):
+                start = max(stat.st_size - int(requested.group(2)), 0)
+            if not requested or start >= stat.st_size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    block = f.read(min(64 * 1024, remaining))
+                    if not block:
+                        break
+                    self.wfile.write(block)
+                    remaining -= len(block)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache: ReleaseCache):
+        super().__init__(address, MirrorHandler)
+        self.cache = cache
+
+
+def get_mirrors() -> list:
+    """Mirrors configured through CLEVERCOFFEE_OTA_MIRROR (comma separated URLs)"""
+    return [url.strip() for url in os.environ.get("CLEVERCOFFEE_OTA_MIRROR", "").split(",") if url.strip()]
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="mirror", description="Share the local release cache on the LAN.")
+    parser.add_argument("--cache", default=None,
+                        help=f"Release cache directory (default: {get_download_directory()})")
+    sub = parser.add_subparsers(dest="action")
+    sub.required = True
+    serve = sub.add_parser("serve", help="Serve the verified release cache over HTTP")
+    serve.add_argument("--bind", default="0.0.0.0", help="Address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=DEFAULT_MIRROR_PORT, help="Port (default: %(default)s)")
+    fetch = sub.add_parser("fetch", help="Fill the cache with a release, preferring configured mirrors")
+    fetch.add_argument("tag")
+    fetch.add_argument("--repo", default=DEFAULT_REPO)
+    fetch.add_argument("--mirror", action="append", default=None,
+                       help="Mirror URL, may be repeated (default: $CLEVERCOFFEE_OTA_MIRROR)")
+    fetch.add_argument("assets", nargs="*", default=list(DEFAULT_ASSETS))
+    sub.add_parser("list", help="List the verified assets in the cache")
+    options = parser.parse_args(args)
+
+    cache = ReleaseCache(options.cache)
+    if options.action == "serve":
+        logging.basicConfig(level=logging.INFO, format='%(asctime)-8s [%(levelname)s]: %(message)s',
+                            datefmt='%H:%M:%S')
+        server = MirrorServer((options.bind, options.port), cache)
+        logging.info("Serving %d verified assets from %s on port %d", len(cache.assets()), cache.root, options.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif options.action == "fetch":
+        mirrors = options.mirror if options.mirror is not None else get_mirrors()
+        for name in options.assets:
+            try:
+                path = fetch_release_asset(options.repo, options.tag, name, cache, mirrors)
+            except (IOError, OSError, ValueError) as e:
+                print(f"❌ {name}: {str(e)}", file=sys.stderr)
+                return 1
+            print(f"✅ {path} ({path.stat().st_size:,} bytes)")
+    elif options.action == "list":
+        for tag, name in cache.assets():
+            print(f"{tag:<20} {name:<16} {cache.digest(tag, name)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
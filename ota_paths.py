@@ -0,0 +1,47 @@
+import os
+import tempfile
+from pathlib import Path
+
+
+def get_data_directory() -> Path:
+    """Directory for the flasher's persistent state (history, inventory, caches)"""
+    if os.environ.get("CLEVERCOFFEE_OTA_HOME"):
+        data_dir = Path(os.environ["CLEVERCOFFEE_OTA_HOME"])
+    else:
+        data_dir = Path.home() / ".clevercoffee_ota"
+
+    try:
+        data_dir.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        data_dir = Path(tempfile.gettempdir()) / "clevercoffee_ota"
+        data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir
+
+
+def get_download_directory():
+    """Get a user-friendly download directory"""
+    # Try to use the user's Downloads folder first
+    home = Path.home()
+
+    # Common download folder locations by OS
+    download_locations = [
+        home / "Downloads",         # Most common
+        home / "Desktop",           # Fallback
+        home / "Documents",         # Another fallback
+        Path(tempfile.gettempdir()) # System temp as last resort
+    ]
+
+    # Find the first location that exists and is writable
+    for location in download_locations:
+        if location.exists() and location.is_dir():
+            try:
+                # Test if we can write to this directory
+                test_file = location / "test_write.tmp"
+                test_file.touch()
+                test_file.unlink()
+                return location / "CleverCoffee_Binaries"
+            except (PermissionError, OSError):
+                continue
+
+    # If all else fails, use temp directory
+    return Path(tempfile.mkdtemp(prefix="clevercoffee_"))
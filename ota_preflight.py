@@ -0,0 +1,183 @@
+import functools
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ota_images
+from ota_download import fetch_json
+
+
+# Ports probed to check the device is up at all (OTA itself is UDP)
+COMMON_PORTS = [80, 443, 22, 23, 3232]
+PROBE_TIMEOUT = 2
+
+# First byte of an ESP32 application image
+ESP_IMAGE_MAGIC = 0xE9
+
+
+class PreflightResult:
+    """Everything the upload needs that can be worked out before it starts"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.ip = None
+        self.reachable_port = None
+        self.images = {}            # partition -> ota_images.Image
+        self.release_digests = {}   # asset name -> sha256
+        self.digest_mismatch = False    # an image differs from its published release asset
+        self.problems = []
+
+    @property
+    def ok(self) -> bool:
+        return (self.ip is not None and not self.digest_mismatch
+                and not any(image is None for image in self.images.values()))
+
+    def release(self):
+        """Give the preloaded images back to the registry"""
+        for image in self.images.values():
+            if image is not None:
+                ota_images.registry.release(image)
+        self.images = {}
+
+
+def resolve_host(host: str) -> str:
+    return socket.gethostbyname(host)
+
+
+def probe_port(ip: str, port: int, cancel=None) -> bool:
+    """True if something accepts TCP connections on ip:port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if cancel is not None:
+        cancel.register(sock)
+    try:
+        sock.settimeout(PROBE_TIMEOUT)
+        return sock.connect_ex((ip, port)) == 0
+    except OSError:
+        return False
+    finally:
+        if cancel is not None:
+            cancel.unregister(sock)
+        sock.close()
+
+
+# Bytes at the start of an image that validate_header() looks at
+HEADER_SIZE = 8192
+
+
+def validate_header(name: str, size: int, header: bytes, partition: str) -> list:
+    """Sanity checks of an image from its size and first HEADER_SIZE bytes; returns a list of warnings"""
+    warnings = []
+    if size == 0:
+        warnings.append(f"{name} is empty")
+    elif partition == "app" and header[0] != ESP_IMAGE_MAGIC:
+        warnings.append(f"{name} does not look like an ESP32 application image")
+    elif partition == "spiffs" and b"littlefs" not in header:
+        warnings.append(f"{name} does not look like a littlefs image")
+    return warnings
+
+
+def validate_image(image, partition: str) -> list:
+    """Sanity checks of an image's content; returns a list of warnings"""
+    return validate_header(os.path.basename(image.path), image.size, bytes(image.data[:HEADER_SIZE]), partition)
+
+
+@functools.lru_cache(maxsize=8)
+def fetch_release_digests(repo: str, tag: str) -> dict:
+    """SHA-256 digests GitHub publishes for the assets of a release"""
+    release = fetch_json(f"https://api.github.com/repos/{repo}/releases/tags/{tag}", timeout=5)
+    digests = {}
+    for asset in release.get("assets", []):
+        digest = asset.get("digest") or ""
+        if digest.startswith("sha256:"):
+            digests[asset["name"]] = digest[len("sha256:"):]
+    return digests
+
+
+def run_preflight(host: str, image_paths: dict, release=None, log=print, cancel=None,
+                  resolver=resolve_host) -> PreflightResult:
+    """Resolve the host, probe it, load/validate the images and look up release digests concurrently
+
+    image_paths maps partition ("app"/"spiffs") to a file path. release is an
+    optional (repo, tag) pair; images named like one of its assets are
+    checked against the published digest. The returned result holds
+    references to the loaded images, call release() when done with them.
+    resolver can replace the plain DNS lookup, e.g. by a caching one.
+    """
+    result = PreflightResult(host)
+
+    executor = ThreadPoolExecutor(max_workers=len(COMMON_PORTS) + len(image_paths) + 2)
+    image_futures = {}
+    try:
+        resolve_future = executor.submit(resolver, host)
+        image_futures = {executor.submit(ota_images.registry.acquire, path): partition
+                         for partition, path in image_paths.items()}
+        digest_future = executor.submit(fetch_release_digests, *release) if release else None
+
+        # Probe all ports at once as soon as the host is resolved
+        try:
+            result.ip = resolve_future.result()
+            log(f"✅ Host resolution successful: {host} -> {result.ip}")
+        except Exception:
+            # Not just OSError: malformed names like "a..b" raise UnicodeError
+            log(f"❌ Cannot resolve hostname: {host}")
+            result.problems.append(f"Cannot resolve hostname: {host}")
+
+        probe_futures = {}
+        if result.ip is not None and not (cancel is not None and cancel.cancelled):
+            probe_futures = {executor.submit(probe_port, result.ip, port, cancel): port for port in COMMON_PORTS}
+
+        for future in as_completed(image_futures):
+            partition = image_futures[future]
+            try:
+                image = future.result()
+            except OSError as e:
+                result.images[partition] = None
+                result.problems.append(f"Cannot read {image_paths[partition]}: {e}")
+                log(f"❌ Cannot read {os.path.basename(image_paths[partition])}: {str(e)}")
+                continue
+            result.images[partition] = image
+            log(f"✅ {os.path.basename(image.path)}: {image.size:,} bytes, MD5 {image.md5}")
+            for warning in validate_image(image, partition):
+                log(f"⚠️ {warning}")
+
+        if digest_future is not None:
+            try:
+                result.release_digests = digest_future.result()
+            except Exception as e:
+                log(f"⚠️ Could not look up release digests: {str(e)}")
+            for image in result.images.values():
+                if image is None:
+                    continue
+                expected = result.release_digests.get(os.path.basename(image.path))
+                if expected is None:
+                    continue
+                if image.sha256() == expected:
+                    log(f"✅ {os.path.basename(image.path)} matches the published release digest")
+                else:
+                    result.digest_mismatch = True
+                    result.problems.append(f"{image.path} does not match the release digest")
+                    log(f"❌ {os.path.basename(image.path)} does not match the published release digest")
+
+        if probe_futures:
+            for future in as_completed(probe_futures):
+                if future.result():
+                    result.reachable_port = probe_futures[future]
+                    break
+            if result.reachable_port is not None:
+                log(f"✅ Host is reachable (responded on port {result.reachable_port})")
+            else:
+                log(f"⚠️ Host may not be reachable on common ports")
+                log(f"This is normal for OTA-only devices - proceeding with upload")
+    except BaseException:
+        # Nobody gets the result, so give back every image loaded for it
+        for future in image_futures:
+            try:
+                ota_images.registry.release(future.result())
+            except Exception:
+                pass
+        raise
+    finally:
+        # Don't hold up the upload for probes still waiting on their timeout
+        executor.shutdown(wait=False)
+
+    return result
@@ -0,0 +1,239 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ota_images
+from ota_paths import get_data_directory
+from ota_preflight import HEADER_SIZE, validate_header
+
+
+# Bytes hashed per read
+READ_BLOCK = 1024 * 1024
+
+
+class PreparedImage:
+    """Digests and validation warnings of an image, computed once per (path, size, mtime)"""
+
+    def __init__(self, path: str, partition: str, size: int = 0, mtime_ns: int = 0, md5: str = "",
+                 sha256: str = "", warnings=(), cached: bool = False, error: str = ""):
+        self.path = path
+        self.partition = partition
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.md5 = md5
+        self.sha256 = sha256
+        self.warnings = list(warnings)
+        self.cached = cached            # taken from the cache, nothing was read
+        self.error = error              # why the image could not be prepared
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "partition": self.partition,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "md5": self.md5,
+            "sha256": self.sha256,
+            "warnings": self.warnings,
+        }
+
+
+def prepare_file(path: str, partition: str) -> dict:
+    """Hash and validate one image; runs in a worker process"""
+    before = os.stat(path)
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    header = b""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK), b''):
+            if len(header) < HEADER_SIZE:
+                header += block[:HEADER_SIZE - len(header)]
+            md5.update(block)
+            sha256.update(block)
+    after = os.stat(path)
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+        raise OSError(f"{path} changed while it was being read")
+    return PreparedImage(path, partition, after.st_size, after.st_mtime_ns, md5.hexdigest(), sha256.hexdigest(),
+                         validate_header(os.path.basename(path), after.st_size, header, partition)).to_dict()
+
+
+def get_cache_path():
+    return get_data_directory() / "prepared.json"
+
+
+class PreparationCache:
+    """Prepared images keyed by partition and real path, valid while size and mtime match, persisted as JSON"""
+
+    def __init__(self, path=None):
+        self.path = str(path or get_cache_path())
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _key(path: str, partition: str) -> str:
+        return f"{partition}:{os.path.realpath(path)}"
+
+    def get(self, path: str, partition: str, stat):
+        with self._lock:
+            entry = self._entries.get(self._key(path, partition))
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        entry = dict(entry, path=path, partition=partition)
+        return PreparedImage(cached=True, **entry)
+
+    def put(self, prepared: PreparedImage):
+        with self._lock:
+            self._entries[self._key(prepared.path, prepared.partition)] = prepared.to_dict()
+            self._dirty = True
+
+    def prune(self):
+        """Drop entries of files that no longer exist"""
+        with self._lock:
+            for key in [key for key in self._entries if not os.path.exists(key.split(":", 1)[1])]:
+                del self._entries[key]
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+
+class ImagePreparer:
+    """Hashes and validates images in a process pool, one image per core at a time
+
+    Results are cached, so images that did not change since the last run are
+    not read again, and handed to the image registry so uploads skip the
+    hashing as well. Falls back to preparing in this process where no
+    process pool can be started.
+    """
+
+    def __init__(self, workers: int = None, cache: PreparationCache = None):
+        self.workers = workers
+        self.cache = cache or PreparationCache()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                try:
+                    # Forking a process that runs threads (GUI, engine) is unsafe
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                except (OSError, NotImplementedError, ImportError):
+                    self._pool = False
+            return self._pool or None
+
+    def _ready(self, prepared: PreparedImage) -> PreparedImage:
+        if not prepared.error:
+            ota_images.registry.remember_digests(prepared.path, prepared.size, prepared.mtime_ns, prepared.md5,
+                                                 prepared.sha256)
+        return prepared
+
+    def prepare(self, items):
+        """Prepare (path, partition) pairs, yielding each PreparedImage as soon as it is ready
+
+        Cached images come first, the others in the order they finish.
+        Images that cannot be read are yielded with error set.
+        """
+        pending = []
+        for path, partition in dict.fromkeys(items):
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                yield PreparedImage(path, partition, error=str(e))
+                continue
+            cached = self.cache.get(path, partition, stat)
+            if cached is not None:
+                yield self._ready(cached)
+            else:
+                pending.append((path, partition))
+
+        try:
+            pool = self._get_pool() if pending else None
+            futures = {}
+            if pool is not None:
+                try:
+                    futures = {pool.submit(prepare_file, *item): item for item in pending}
+                except RuntimeError:
+                    # The pool broke down earlier; start a new one next time
+                    with self._lock:
+                        self._pool = None
+                    pool = None
+            if pool is None:
+                results = ((item, lambda item=item: prepare_file(*item)) for item in pending)
+            else:
+                results = ((futures[future], future.result) for future in as_completed(futures))
+            for (path, partition), result in results:
+                try:
+                    prepared = PreparedImage(**result())
+                except Exception as e:
+                    # Unreadable files, or a worker process that died
+                    yield PreparedImage(path, partition, error=str(e) or type(e).__name__)
+                    continue
+                self.cache.put(prepared)
+                yield self._ready(prepared)
+        finally:
+            try:
+                self.cache.save()
+            except OSError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=True)
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="prepare", description="Hash and check images ahead of a rollout.")
+    parser.add_argument("images", nargs="+", help="Images to prepare, as FILE or PARTITION=FILE (app/spiffs)")
+    parser.add_argument("-j", "--jobs", type=int, help="Worker processes (default: one per core)")
+    parser.add_argument("--prune", action="store_true", help="Forget cached images that no longer exist")
+    options = parser.parse_args(args)
+
+    items = []
+    for argument in options.images:
+        partition, _, path = argument.rpartition("=")
+        if partition not in ("", "app", "spiffs"):
+            parser.error(f"unknown partition {partition}")
+        items.append((path, partition or "app"))
+
+    preparer = ImagePreparer(options.jobs)
+    if options.prune:
+        preparer.cache.prune()
+    failed = False
+    try:
+        for prepared in preparer.prepare(items):
+            if prepared.error:
+                failed = True
+                print(f"❌ {prepared.path}: {prepared.error}")
+                continue
+            print(f"{'cached ' if prepared.cached else 'ready  '} {prepared.partition:<6} {prepared.md5}"
+                  f"  {prepared.size:>10,}  {prepared.path}")
+            for warning in prepared.warnings:
+                print(f"⚠️ {warning}")
+    finally:
+        preparer.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,146 @@
+import threading
+import time
+
+from ota_credentials import normalize_host
+from ota_jsonstore import file_stamp, read_json, update_json
+from ota_paths import get_data_directory
+
+
+# Uploads falling below this fraction of the tuned throughput mark the profile for re-tuning
+RETUNE_RATIO = 0.5
+
+
+class TransportProfile:
+    """Socket settings of an upload
+
+    The defaults are what espota has always used: 1 KB chunks, one chunk in
+    flight, OS socket buffers and Nagle enabled.
+    """
+
+    FIELDS = ("chunk_size", "window", "send_buffer", "nodelay", "ack_timeout", "result_timeout")
+
+    def __init__(self, chunk_size: int = 1024, window: int = 1, send_buffer: int = 0, nodelay: bool = False,
+                 ack_timeout: float = 10, result_timeout: float = 60, throughput: float = None,
+                 tuned: float = None, stale: bool = False):
+        self.chunk_size = chunk_size
+        self.window = window            # chunks sent before waiting for an ack
+        self.send_buffer = send_buffer  # SO_SNDBUF in bytes, 0 = OS default
+        self.nodelay = nodelay          # TCP_NODELAY
+        self.ack_timeout = ack_timeout
+        self.result_timeout = result_timeout
+        self.throughput = throughput    # bytes/s measured when tuned
+        self.tuned = tuned              # time of the calibration
+        self.stale = stale              # uploads got much slower since
+
+    def replace(self, **changes):
+        settings = self.to_dict()
+        settings.update(changes)
+        return TransportProfile(**settings)
+
+    def describe(self) -> str:
+        buffer = f"{self.send_buffer // 1024} KB" if self.send_buffer else "default"
+        return (f"{self.chunk_size} B chunks, window {self.window}, send buffer {buffer},"
+                f" nodelay {'on' if self.nodelay else 'off'}")
+
+    def to_dict(self) -> dict:
+        return {
+            "chunk_size": self.chunk_size,
+            "window": self.window,
+            "send_buffer": self.send_buffer,
+            "nodelay": self.nodelay,
+            "ack_timeout": self.ack_timeout,
+            "result_timeout": self.result_timeout,
+            "throughput": self.throughput,
+            "tuned": self.tuned,
+            "stale": self.stale,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{key: value for key, value in data.items() if key in cls().to_dict()})
+
+    def __eq__(self, other):
+        return isinstance(other, TransportProfile) and all(
+            getattr(self, field) == getattr(other, field) for field in self.FIELDS)
+
+    def __repr__(self):
+        return f"TransportProfile({self.describe()})"
+
+
+DEFAULT_PROFILE = TransportProfile()
+
+
+def get_profiles_path():
+    return get_data_directory() / "profiles.json"
+
+
+class ProfileStore:
+    """Tuned transport profiles keyed by host, persisted as JSON
+
+    Like the device inventory, the file is shared with other flasher
+    processes: it is read again when one of them changed it, and each
+    change is written on top of the current file.
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or get_profiles_path())
+        self._lock = threading.Lock()
+        self._profiles = None
+        self._stamp = None
+
+    def _load(self) -> dict:
+        stamp = file_stamp(self.path)
+        if self._profiles is None or stamp != self._stamp:
+            self._sync(read_json(self.path), stamp)
+        return self._profiles
+
+    def _sync(self, data: dict, stamp):
+        self._profiles = {host: TransportProfile.from_dict(settings) for host, settings in data.items()}
+        self._stamp = stamp
+
+    def _save(self, host: str):
+        """Write the profile of host (or its removal) on top of the file"""
+        profile = self._profiles.get(host)
+
+        def change(data):
+            if profile is None:
+                data.pop(host, None)
+            else:
+                data[host] = profile.to_dict()
+
+        data = update_json(self.path, change)
+        self._sync(data, file_stamp(self.path))
+
+    def get(self, host: str, default=None):
+        """Return the tuned profile for host, or default if it was never tuned"""
+        with self._lock:
+            return self._load().get(normalize_host(host), default)
+
+    def set(self, host: str, profile: TransportProfile):
+        with self._lock:
+            self._load()[normalize_host(host)] = profile
+            self._save(normalize_host(host))
+
+    def forget(self, host: str):
+        with self._lock:
+            if self._load().pop(normalize_host(host), None) is not None:
+                self._save(normalize_host(host))
+
+    def hosts(self):
+        with self._lock:
+            return sorted(self._load())
+
+    def check_throughput(self, host: str, throughput: float) -> bool:
+        """Compare an upload with the tuned throughput; marks the profile stale and returns True if far below"""
+        with self._lock:
+            profile = self._load().get(normalize_host(host))
+            if profile is None or not profile.throughput or profile.stale:
+                return False
+            if throughput >= RETUNE_RATIO * profile.throughput:
+                return False
+            profile.stale = True
+            self._save(normalize_host(host))
+            return True
+
+    def mark_tuned(self, host: str, profile: TransportProfile, throughput: float):
+        self.set(host, profile.replace(throughput=throughput, tuned=time.time(), stale=False))
@@ -0,0 +1,311 @@
+import argparse
+import ipaddress
+import logging
+import selectors
+import socket
+import struct
+import sys
+import time
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+
+# Routes an invitation goes out on at most
+MAX_ROUTES = 4
+# Head start of each route over the next, so a device that answers at once gets a single invitation
+RACE_DELAY = 0.3
+POLL_INTERVAL = 0.25
+
+# Linux ioctls reading an interface's flags, address and netmask
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891B
+IFF_UP = 0x1
+
+
+class Route:
+    """A local IPv4 interface invitations can be sent from"""
+
+    def __init__(self, name: str, address: str, netmask: str = ""):
+        self.name = name
+        self.address = address
+        self.netmask = netmask
+
+    def reaches(self, ip: str) -> bool:
+        """Whether ip is on this interface's subnet"""
+        if not self.netmask:
+            return False
+        try:
+            return ipaddress.ip_address(ip) in ipaddress.ip_network(f"{self.address}/{self.netmask}", strict=False)
+        except ValueError:
+            return False
+
+    def matches(self, remembered) -> bool:
+        """Whether this is the route remembered as {"name", "address"} (the address may have changed since)"""
+        return bool(remembered) and remembered.get("name") == self.name
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "address": self.address}
+
+    def __str__(self):
+        return self.address if self.name == self.address else f"{self.name} ({self.address})"
+
+    def __repr__(self):
+        return f"Route({self})"
+
+
+def _linux_routes() -> list:
+    routes = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            request = struct.pack("256s", name.encode()[:15])
+            try:
+                flags = struct.unpack("H", fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+                if not flags & IFF_UP:
+                    continue
+                address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, request)[20:24])
+            except OSError:
+                continue                # no IPv4 address
+            routes.append(Route(name, address, netmask))
+    finally:
+        sock.close()
+    return routes
+
+
+def local_routes() -> list:
+    """IPv4 interfaces that are up, loopback included
+
+    Uses psutil where it is installed, else asks the Linux kernel directly;
+    elsewhere only the addresses of the host name are known, without their
+    interfaces and subnets.
+    """
+    if HAS_PSUTIL:
+        stats = psutil.net_if_stats()
+        return [Route(name, address.address, address.netmask or "")
+                for name, addresses in psutil.net_if_addrs().items() if name not in stats or stats[name].isup
+                for address in addresses if address.family == socket.AF_INET]
+    if HAS_FCNTL and sys.platform.startswith("linux") and hasattr(socket, "if_nameindex"):
+        try:
+            return _linux_routes()
+        except OSError:
+            pass
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)}
+    except OSError:
+        addresses = set()
+    return [Route(address, address) for address in sorted(addresses)]
+
+
+def source_address(target: str) -> str:
+    """Local address the routing table sends packets to target from, "" if there is no route"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # connecting a UDP socket only looks up the route, nothing is sent
+        sock.connect((target, 9))
+        return sock.getsockname()[0]
+    except OSError:
+        return ""
+    finally:
+        sock.close()
+
+
+class RoutePlan:
+    """Local routes to race an invitation over; espota.serve() sets winner to the one answered
+
+    The fallback routes only join the race once the routes have gone
+    unanswered for a whole invitation timeout.
+    """
+
+    def __init__(self, routes, fallback=()):
+        self.routes = list(routes)
+        self.fallback = list(fallback)
+        self.winner = None
+
+    def __str__(self):
+        text = ", ".join(str(route) for route in self.routes) or "default route"
+        if self.fallback:
+            text += ", then " + ", ".join(str(route) for route in self.fallback)
+        return text
+
+
+def plan_routes(target: str, remembered=None, limit: int = MAX_ROUTES) -> RoutePlan:
+    """The plausible routes to target (an address), best first
+
+    The route remembered for the device comes first, then interfaces on the
+    device's subnet, then the one the routing table picks. Every extra
+    invitation resets a device waiting for its AUTH answer, so the other
+    interfaces but loopback (docker, VPN, ...) are only fallback routes, and
+    only when no interface is on the device's subnet. Link-local interfaces
+    only count for link-local targets. An empty plan leaves the choice to
+    the routing table.
+    """
+    try:
+        ip = ipaddress.ip_address(target)
+    except ValueError:
+        return RoutePlan([])
+    if ip.version != 4:
+        return RoutePlan([])
+    if ip.is_loopback:
+        return RoutePlan([Route("lo", "127.0.0.1", "255.0.0.0")])
+    routes = [route for route in local_routes()
+              if not ipaddress.ip_address(route.address).is_loopback
+              and (ipaddress.ip_address(route.address).is_link_local == ip.is_link_local)]
+    source = source_address(target)
+    if source and not any(route.address == source for route in routes):
+        routes.append(Route(source, source))
+    likely = [route for route in routes
+              if route.matches(remembered) or route.reaches(target) or route.address == source]
+    others = [route for route in routes if route not in likely]
+    if any(route.reaches(target) for route in routes):
+        others = []
+    elif not likely:
+        likely, others = others, []
+    likely.sort(key=lambda route: (not route.matches(remembered), not route.reaches(target), route.address != source))
+    likely = likely[:limit]
+    return RoutePlan(likely, others[:max(0, limit - len(likely))])
+
+
+class InvitationRace:
+    """Sends an invitation from several routes and keeps the one answered first
+
+    The first route gets a head start of delay, then the next one joins,
+    and so on. The device connects back to the address the answered
+    invitation came from, and the rest of the exchange goes through the
+    winner's socket. A device waiting for the answer to its AUTH challenge
+    gives up when another invitation arrives, so with invited > 1 a lost
+    authentication is worth retrying over the winner alone. Without routes,
+    the routing table picks the interface.
+    """
+
+    def __init__(self, remote: tuple, routes=(), cancel=None, delay: float = RACE_DELAY):
+        self.remote = remote
+        self.routes = list(routes) or [None]
+        self.cancel = cancel
+        self.delay = delay
+        self.winner = None              # the Route answered, None for the default route
+        self.socket = None
+        self.invited = 0                # routes the invitation went out on before the answer
+
+    def _open(self, route):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.cancel is not None:
+            self.cancel.register(sock)
+        if route is None:
+            return sock
+        try:
+            if len(self.routes) > 1 and route.name != route.address and hasattr(socket, "SO_BINDTODEVICE"):
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, route.name.encode())
+                except OSError:
+                    pass                # needs privileges; the bound source address is the next best thing
+            sock.bind((route.address, 0))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def invite(self, message: bytes, timeout: float) -> str:
+        """Send message until a route is answered, returning the answer
+
+        Raises socket.timeout if no route is answered within timeout, and
+        OSError if the invitation could not be sent from any route.
+        """
+        pending = list(self.routes)
+        sockets = {}
+        selector = selectors.DefaultSelector()
+        error = None
+        now = started = time.time()
+        next_send = started
+        try:
+            while True:
+                if self.cancel is not None:
+                    self.cancel.check()
+                while pending and now >= next_send:
+                    route = pending.pop(0)
+                    try:
+                        sock = self._open(route)
+                    except OSError as e:
+                        error = e
+                        continue
+                    try:
+                        sock.sendto(message, self.remote)
+                    except OSError as e:
+                        logging.debug("Invitation from %s failed: %s", route or "default route", e)
+                        sock.close()
+                        error = e
+                        continue
+                    sockets[sock] = route
+                    selector.register(sock, selectors.EVENT_READ)
+                    self.invited += 1
+                    next_send = now + self.delay
+                if not sockets:
+                    if not pending and self.invited:
+                        raise socket.timeout("refused")
+                    if not pending:
+                        raise error or OSError(f"no route to {self.remote[0]}")
+                    now = next_send = time.time()
+                    continue
+                if now >= started + timeout:
+                    raise socket.timeout("timed out")
+                wait = min(POLL_INTERVAL, started + timeout - now)
+                if pending:
+                    wait = min(wait, next_send - now)
+                for key, _ in selector.select(max(0.0, wait)):
+                    try:
+                        data = key.fileobj.recv(37)
+                    except OSError:
+                        # e.g. an ICMP port unreachable that came back over this route
+                        selector.unregister(key.fileobj)
+                        sockets.pop(key.fileobj).close()
+                        continue
+                    self.socket = key.fileobj
+                    self.winner = sockets.pop(key.fileobj)
+                    return data.decode()
+                now = time.time()
+        finally:
+            selector.close()
+            for sock in sockets:
+                sock.close()
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="routes", description="Show the routes invitations to a device go out on.")
+    parser.add_argument("host", nargs="?", help="Device address, hostname or inventory name")
+    options = parser.parse_args(args)
+
+    print(f"{'Interface':<16} {'Address':<16} {'Netmask':<16}")
+    for route in local_routes():
+        print(f"{route.name:<16} {route.address:<16} {route.netmask or '-':<16}")
+    if not HAS_PSUTIL and not sys.platform.startswith("linux"):
+        print("⚠️ Install psutil to list every interface")
+    if options.host:
+        # Imported here, the inventory is only needed for this
+        from ota_inventory import DeviceInventory
+        inventory = DeviceInventory()
+        try:
+            target = inventory.resolve(options.host)
+        except OSError as e:
+            print(f"❌ Cannot resolve {options.host}: {str(e)}", file=sys.stderr)
+            return 1
+        device = inventory.get(options.host)
+        remembered = device.route if device is not None else None
+        print(f"\nInvitations to {options.host} ({target}) go out on: {plan_routes(target, remembered)}")
+        if remembered:
+            print(f"Last answered on: {remembered['name']} ({remembered['address']})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,173 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket limiting a byte stream to rate bytes/s (no limit when rate is 0)"""
+
+    def __init__(self, rate: float = 0, burst: float = 0):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self._capacity()
+        self.stamp = time.monotonic()
+
+    def _capacity(self) -> float:
+        # Allow roughly 100 ms of traffic in one burst, but at least a few chunks
+        return self.burst or max(self.rate * 0.1, 4096)
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self._capacity())
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._capacity(), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, nbytes: int):
+        """Take nbytes from the bucket, sleeping until the rate allows it"""
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill()
+            self.tokens -= nbytes
+            deficit = -self.tokens
+            rate = self.rate
+        if deficit > 0:
+            time.sleep(deficit / rate)
+
+
+class HostShare:
+    """One host's slice of the shared bandwidth, adapted to its ack latency"""
+
+    # Ack latency this many times above the best seen means the link is congested
+    CONGESTION_FACTOR = 3.0
+    # Never react to latencies below this, they are just scheduling noise
+    LATENCY_FLOOR = 0.05
+    ADJUST_INTERVAL = 0.5
+    MIN_RATE = 2048
+
+    def __init__(self, scheduler, host: str):
+        self.scheduler = scheduler
+        self.host = host
+        self.bucket = TokenBucket()
+        self.allotted = 0.0
+        self.limit = 0.0        # adaptive cap, 0 while the link looks healthy
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+        self.latency_avg = None
+        self.latency_min = None
+        self._window_start = self.started
+        self._window_bytes = 0
+        self._window_rate = 0.0
+
+    def throttle(self, nbytes: int):
+        """Block until nbytes may be sent to this host"""
+        self.bucket.consume(nbytes)
+
+    def record_ack(self, latency: float, nbytes: int):
+        """Account a sent chunk and the time it took the device to acknowledge it"""
+        self.bytes_sent += nbytes
+        self._window_bytes += nbytes
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        else:
+            self.latency_avg = 0.8 * self.latency_avg + 0.2 * latency
+        if self.latency_min is None or latency < self.latency_min:
+            self.latency_min = latency
+
+        now = time.monotonic()
+        if now - self._window_start < self.ADJUST_INTERVAL:
+            return
+        self._window_rate = self._window_bytes / (now - self._window_start)
+        self._window_start = now
+        self._window_bytes = 0
+
+        threshold = max(self.latency_min * self.CONGESTION_FACTOR, self.LATENCY_FLOOR)
+        if self.latency_avg > threshold:
+            # Multiplicative decrease below what the link currently achieves
+            self.limit = max(self._window_rate * 0.7, self.MIN_RATE)
+        elif self.limit:
+            # Additive increase; lift the cap entirely once it is far above the allotment
+            self.limit += max(self.limit * 0.1, self.MIN_RATE)
+            if self.allotted and self.limit > 2 * self.allotted:
+                self.limit = 0.0
+        else:
+            return
+        self.scheduler.rebalance()
+
+    def achieved(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "host": self.host,
+            "allotted": self.allotted,
+            "achieved": self.achieved(),
+            "bytes": self.bytes_sent,
+            "ack_latency": self.latency_avg,
+        }
+
+
+class BandwidthScheduler:
+    """Global bandwidth cap shared fairly (max-min) between all active transfers"""
+
+    def __init__(self, global_rate: float = 0):
+        self._lock = threading.Lock()
+        self.global_rate = global_rate
+        self.shares = []
+
+    def register(self, host: str) -> HostShare:
+        share = HostShare(self, host)
+        with self._lock:
+            self.shares.append(share)
+        self.rebalance()
+        return share
+
+    def unregister(self, share: HostShare):
+        with self._lock:
+            if share in self.shares:
+                self.shares.remove(share)
+        self.rebalance()
+
+    def set_global_rate(self, rate: float):
+        self.global_rate = rate
+        self.rebalance()
+
+    def rebalance(self):
+        """Split the global rate between hosts, giving capped hosts' leftovers to the rest"""
+        with self._lock:
+            shares = list(self.shares)
+            budget = self.global_rate
+        if not shares:
+            return
+
+        if not budget:
+            for share in shares:
+                share.allotted = share.limit
+                share.bucket.set_rate(share.limit)
+            return
+
+        # Water filling: hosts limited below the fair share keep their limit
+        pending = sorted(shares, key=lambda s: s.limit or float('inf'))
+        while pending:
+            fair = budget / len(pending)
+            share = pending[0]
+            if share.limit and share.limit < fair:
+                rate = share.limit
+            else:
+                rate = fair
+            share.allotted = rate
+            share.bucket.set_rate(rate)
+            budget -= rate
+            pending.pop(0)
+
+    def stats(self) -> list:
+        """Allotted versus achieved throughput for every active host"""
+        with self._lock:
+            return [share.stats() for share in self.shares]
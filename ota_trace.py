@@ -0,0 +1,252 @@
+import argparse
+import bisect
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import espota
+from ota_fakedevice import FakeDevice
+from ota_preflight import ESP_IMAGE_MAGIC
+from ota_profiles import DEFAULT_PROFILE, TransportProfile
+
+
+TRACE_VERSION = 1
+# A replayed transfer may take this much longer than the recorded one before it counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+class SessionRecorder:
+    """Timestamped record of one OTA session, filled in by espota.serve()
+
+    Events are [seconds since the invitation, kind, data...]: "invite" for
+    every invitation sent, "reply" for every datagram of the device, "auth"
+    when the challenge was answered (the answer itself is not kept, it would
+    allow guessing the password offline), "connect", "ack" with the bytes
+    acknowledged so far, "result" with the device's final message and "end"
+    with the return code.
+    """
+
+    def __init__(self):
+        self.header = {}
+        self.started = time.time()
+        self.events = []
+
+    def begin(self, host: str, port: int, command: int, size: int, md5: str, profile=None):
+        self.header = {
+            "version": TRACE_VERSION,
+            "host": host,
+            "port": port,
+            "command": command,
+            "size": size,
+            "md5": md5,
+            "profile": (profile or DEFAULT_PROFILE).to_dict(),
+            "recorded": time.time(),
+        }
+        self.started = time.time()
+        self.events = []
+
+    def event(self, kind: str, *data):
+        self.events.append([round(time.time() - self.started, 4), kind, *data])
+
+    def finish(self, result: int):
+        self.event("end", result)
+
+    def to_dict(self) -> dict:
+        trace = dict(self.header)
+        trace["events"] = self.events
+        return trace
+
+    def save(self, path: str):
+        data = json.dumps(self.to_dict(), separators=(",", ":")).encode("utf-8")
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wb") as f:
+            f.write(data)
+
+
+def load_trace(path: str) -> dict:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        trace = json.loads(f.read().decode("utf-8"))
+    if trace.get("version") != TRACE_VERSION:
+        raise ValueError(f"{path} is not a session trace of version {TRACE_VERSION}")
+    return trace
+
+
+def phases(trace: dict) -> dict:
+    """Durations of the phases of a traced session, as in espota's timings"""
+    events = trace["events"]
+    first = {}
+    for event in events:
+        first.setdefault(event[1], event[0])
+    replies = [event[0] for event in events if event[1] == "reply"]
+    acks = [event[0] for event in events if event[1] == "ack"]
+    result = {"invitations": sum(1 for event in events if event[1] == "invite")}
+    if replies:
+        result["invitation"] = replies[0] - first.get("invite", 0)
+    if "auth" in first and len(replies) > 1:
+        result["auth"] = replies[1] - replies[0]
+    if "connect" in first:
+        result["connect"] = first["connect"] - (replies[-1] if replies else 0)
+        if acks:
+            result["transfer"] = acks[-1] - first["connect"]
+    if "result" in first and acks:
+        result["result"] = first["result"] - acks[-1]
+    result["end"] = next((event[2] for event in events if event[1] == "end"), None)
+    return result
+
+
+class Replay:
+    """How a traced device behaved, for FakeDevice to do the same again
+
+    The device ignores the same number of invitations, answers them and the
+    authentication after the recorded delays, connects back after the
+    recorded delay and acknowledges data no earlier than it did in the
+    trace (the progress is scaled to the size of the replayed image). It
+    then reports the recorded result, drops the connection where the
+    recorded one broke off, or never connects if it did not.
+    """
+
+    def __init__(self, trace: dict):
+        self.trace = trace
+        self.size = trace["size"]
+        events = trace["events"]
+        invites = [event[0] for event in events if event[1] == "invite"]
+        replies = [(event[0], event[2]) for event in events if event[1] == "reply"]
+        auth = [event[0] for event in events if event[1] == "auth"]
+        connect = next((event[0] for event in events if event[1] == "connect"), None)
+        acks = [(event[0], event[2]) for event in events if event[1] == "ack"]
+        result = next(((event[0], event[2]) for event in events if event[1] == "result"), None)
+
+        self.answers = bool(replies)
+        if replies:
+            answered = [t for t in invites if t <= replies[0][0]]
+            self.ignored_invitations = max(0, len(answered) - 1)
+            self.invitation_delay = replies[0][0] - (answered[-1] if answered else 0)
+        else:
+            self.ignored_invitations = len(invites)
+            self.invitation_delay = 0
+        self.reply = replies[0][1] if replies else None
+        self.auth = bool(self.reply and self.reply.startswith("AUTH"))
+        self.auth_reply = replies[1][1] if self.auth and len(replies) > 1 else None
+        self.auth_delay = replies[1][0] - auth[0] if self.auth_reply is not None and auth else 0
+        self.connects = connect is not None
+        self.connect_delay = connect - replies[-1][0] if connect is not None and replies else 0
+        # Acknowledged bytes over time since the connection, as (seconds, offset)
+        self.timeline = [(t - connect, offset) for t, offset in acks] if connect is not None else []
+        self._times = [t for t, offset in self.timeline]
+        self._offsets = [offset for t, offset in self.timeline]
+        self.result = result[1] if result is not None else None
+        last_ack = acks[-1][0] if acks else (connect or 0)
+        self.result_delay = result[0] - last_ack if result is not None else 0
+        # Where the recorded connection broke off, as a fraction of the image
+        self.abort_at = None
+        if self.connects and result is None and self.size:
+            self.abort_at = (self._offsets[-1] if self._offsets else 0) / self.size
+
+    def ack_time(self, received: int, size: int) -> float:
+        """Seconds after the connection at which the device had acknowledged as far into the image"""
+        if not self.timeline:
+            return 0
+        offset = received * self.size / size if size else 0
+        index = bisect.bisect_left(self._offsets, offset)
+        if index >= len(self._offsets):
+            return self._times[-1]
+        if index == 0:
+            previous_time, previous_offset = 0, 0
+        else:
+            previous_time, previous_offset = self._times[index - 1], self._offsets[index - 1]
+        span = self._offsets[index] - previous_offset
+        if span <= 0:
+            return self._times[index]
+        return previous_time + (self._times[index] - previous_time) * (offset - previous_offset) / span
+
+
+def replay(trace: dict, profile=None, log=print) -> dict:
+    """Upload an image of the traced size to a FakeDevice replaying the trace
+
+    Uses the recorded transport profile unless profile is given. Returns
+    the phases of the recorded and of the replayed session.
+    """
+    profile = profile or TransportProfile.from_dict(trace.get("profile") or {})
+    device = FakeDevice(password="replay", replay=Replay(trace)).start()
+    recorder = SessionRecorder()
+    with tempfile.TemporaryDirectory(prefix="clevercoffee_replay_") as work_dir:
+        path = os.path.join(work_dir, "replay.bin")
+        with open(path, "wb") as f:
+            f.write(bytes([ESP_IMAGE_MAGIC]) + os.urandom(max(trace["size"], 1) - 1))
+        log(f"▶️ Replaying a {trace['size']:,} byte session with {trace['host']} ({profile.describe()})")
+        try:
+            espota.serve("127.0.0.1", "127.0.0.1", device.port, 0, "replay", path,
+                         trace.get("command", espota.FLASH), profile=profile, trace=recorder,
+                         progress=lambda fraction: None)
+        finally:
+            device.stop()
+    return {"recorded": phases(trace), "replayed": phases(recorder.to_dict())}
+
+
+def print_phases(recorded: dict, replayed: dict = None):
+    def seconds(value):
+        return f"{value:.3f} s" if value is not None else "-"
+
+    print(f"{'Phase':<12} {'Recorded':>12}" + (f" {'Replayed':>12}" if replayed is not None else ""))
+    for phase in ("invitation", "auth", "connect", "transfer", "result"):
+        line = f"{phase:<12} {seconds(recorded.get(phase)):>12}"
+        if replayed is not None:
+            line += f" {seconds(replayed.get(phase)):>12}"
+        print(line)
+    line = f"{'return code':<12} {str(recorded.get('end')):>12}"
+    if replayed is not None:
+        line += f" {str(replayed.get('end')):>12}"
+    print(line)
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="trace", description="Inspect and replay recorded OTA sessions.")
+    sub = parser.add_subparsers(dest="action")
+    sub.required = True
+    show = sub.add_parser("show", help="Summarize a trace")
+    show.add_argument("trace", help="Trace written by espota.py --record")
+    run = sub.add_parser("replay", help="Upload to a fake device behaving like the traced one")
+    run.add_argument("trace", help="Trace written by espota.py --record")
+    run.add_argument("--default-profile", action="store_true",
+                     help="Upload with the default transport settings instead of the recorded ones")
+    run.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                     help="Allowed slowdown of the transfer as a fraction (default: %(default)s)")
+    options = parser.parse_args(args)
+
+    try:
+        trace = load_trace(options.trace)
+    except (OSError, ValueError) as e:
+        print(f"❌ {str(e)}", file=sys.stderr)
+        return 1
+
+    if options.action == "show":
+        partition = "spiffs" if trace.get("command") == espota.SPIFFS else "app"
+        print(f"{trace['host']}:{trace['port']}  {partition}  {trace['size']:,} bytes  MD5 {trace['md5']}")
+        print(f"Transport: {TransportProfile.from_dict(trace.get('profile') or {}).describe()}")
+        print(f"Events: {len(trace['events'])}")
+        print_phases(phases(trace))
+        return 0
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)-8s [%(levelname)s]: %(message)s',
+                        datefmt='%H:%M:%S')
+    result = replay(trace, DEFAULT_PROFILE if options.default_profile else None)
+    recorded, replayed = result["recorded"], result["replayed"]
+    print_phases(recorded, replayed)
+    if recorded.get("end") != replayed.get("end"):
+        print(f"❌ Result differs: recorded {recorded.get('end')}, replayed {replayed.get('end')}")
+        return 1
+    if recorded.get("transfer") and replayed.get("transfer") and \
+            replayed["transfer"] > recorded["transfer"] * (1 + options.tolerance):
+        print(f"❌ Transfer {replayed['transfer'] / recorded['transfer'] - 1:.0%} slower than recorded")
+        return 1
+    print("✅ Replay matches the recording")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,331 @@
+import argparse
+import ctypes
+import glob
+import hashlib
+import os
+import queue
+import select
+import shutil
+import struct
+import sys
+import time
+
+from ota_cancel import CancelToken
+import ota_engine
+from ota_paths import get_data_directory
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+    HAS_INOTIFY = sys.platform.startswith("linux")
+except (OSError, AttributeError, TypeError):
+    HAS_INOTIFY = False
+
+
+# PlatformIO build output of every environment
+DEFAULT_PATTERNS = {
+    "app": [os.path.join(".pio", "build", "*", "firmware.bin")],
+    "spiffs": [os.path.join(".pio", "build", "*", "littlefs.bin"), os.path.join(".pio", "build", "*", "spiffs.bin")],
+}
+
+# A file must keep its size and mtime this long before it is considered written
+DEBOUNCE = 0.5
+# Wake-up interval when polling, and the longest inotify wait between cancel checks
+POLL_INTERVAL = 0.25
+# How often directories are globbed again, to pick up new build environments
+RESCAN_INTERVAL = 2.0
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Wakes up at a fixed interval; works everywhere"""
+
+    def __init__(self, interval: float = POLL_INTERVAL):
+        self.interval = interval
+
+    def watch(self, directory: str):
+        pass
+
+    def wait(self, timeout: float, cancel: CancelToken) -> bool:
+        cancel.sleep(min(timeout, self.interval))
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Wakes up as soon as something is written to a watched directory (Linux)"""
+
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories = set()
+
+    def watch(self, directory: str):
+        if directory in self.directories:
+            return
+        if _libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) >= 0:
+            self.directories.add(directory)
+
+    def wait(self, timeout: float, cancel: CancelToken) -> bool:
+        readable, _, _ = select.select([self.fd], [], [], min(timeout, POLL_INTERVAL))
+        if not readable:
+            return False
+        # Drain the queue; which file changed is worked out from stat() anyway
+        try:
+            while os.read(self.fd, 64 * EVENT_HEADER.size):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _signature(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class BuildWatcher:
+    """Watches build output and reports partitions whose content really changed
+
+    patterns maps a partition ("app"/"spiffs") to glob patterns. A change is
+    reported once the file has stopped changing for `debounce` seconds and
+    its digest differs from the last one seen; the file is then copied to a
+    snapshot, so the upload is not disturbed by the next build rewriting it.
+    on_change receives {partition: (snapshot_path, digest)} and the time the
+    first write was noticed. on_tick, if given, is called after every
+    wake-up on the watching thread. Superseded snapshots are deleted once
+    in_use, if given, no longer returns them (see pending_images).
+    """
+
+    def __init__(self, patterns: dict, on_change, debounce: float = DEBOUNCE, use_inotify: bool = True,
+                 snapshot_dir=None, log=print, on_tick=None, in_use=None):
+        self.patterns = patterns
+        self.on_change = on_change
+        self.on_tick = on_tick
+        self.in_use = in_use
+        self.debounce = debounce
+        self.log = log
+        self.snapshot_dir = snapshot_dir or (get_data_directory() / "watch")
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self.watcher = InotifyWatcher() if use_inotify and HAS_INOTIFY else PollingWatcher()
+        self.signatures = {}    # path -> (size, mtime_ns)
+        self.pending = {}       # path -> (signature, first change, last change)
+        self.digests = {}       # partition -> digest of the last reported content
+        self.snapshots = {}     # partition -> snapshot path
+        self.superseded = set()    # older snapshot paths, deleted once no upload uses them
+        self.last_scan = 0
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if isinstance(self.watcher, InotifyWatcher) else "polling"
+
+    def files(self) -> dict:
+        """path -> partition of every file currently matching the patterns"""
+        files = {}
+        for partition, patterns in self.patterns.items():
+            for pattern in patterns:
+                for path in glob.glob(pattern):
+                    files[os.path.abspath(path)] = partition
+        return files
+
+    def scan(self) -> dict:
+        """Watch the directories of all patterns and return the matching files"""
+        for patterns in self.patterns.values():
+            for pattern in patterns:
+                for directory in glob.glob(os.path.dirname(pattern) or "."):
+                    self.watcher.watch(os.path.abspath(directory))
+        self.last_scan = time.monotonic()
+        return self.files()
+
+    def baseline(self, files: dict):
+        """Take the current content as already flashed"""
+        for path, partition in files.items():
+            self.signatures[path] = _signature(path)
+        for partition in set(files.values()):
+            newest = max((path for path in files if files[path] == partition), key=os.path.getmtime)
+            self.digests[partition] = file_digest(newest)
+
+    def run(self, cancel: CancelToken, flash_now: bool = False):
+        files = self.scan()
+        if not flash_now:
+            self.baseline(files)
+        else:
+            self.pending = {path: (None, time.monotonic(), 0) for path in files}
+        self.log(f"👀 Watching {len(files)} file(s) using {self.mode}")
+
+        try:
+            while not cancel.cancelled:
+                if time.monotonic() - self.last_scan > RESCAN_INTERVAL:
+                    files = self.scan()
+                timeout = self.debounce if self.pending else RESCAN_INTERVAL
+                self.watcher.wait(timeout, cancel)
+                self.check(files)
+                if self.on_tick is not None:
+                    self.on_tick()
+        finally:
+            self.watcher.close()
+
+    def check(self, files: dict):
+        now = time.monotonic()
+        for path in files:
+            signature = _signature(path)
+            if signature != self.signatures.get(path):
+                first = self.pending[path][1] if path in self.pending else now
+                self.pending[path] = (signature, first, now)
+                self.signatures[path] = signature
+
+        changes = {}
+        first_change = None
+        for path, (signature, first, last) in list(self.pending.items()):
+            if now - last < self.debounce:
+                continue
+            del self.pending[path]
+            if signature is None and _signature(path) is None:
+                continue
+            partition = files.get(path)
+            change = self.snapshot(path, partition) if partition else None
+            if change is not None:
+                changes[partition] = change
+                first_change = first if first_change is None else min(first, first_change)
+
+        if changes:
+            # Report the wall clock time the first write was noticed
+            self.on_change(changes, time.time() - (time.monotonic() - first_change))
+        if self.superseded:
+            self.prune()
+
+    def prune(self):
+        """Delete superseded snapshots that no queued or running upload refers to"""
+        in_use = set(self.in_use()) if self.in_use is not None else set()
+        for snapshot in list(self.superseded - in_use):
+            try:
+                os.remove(snapshot)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Open elsewhere on Windows, try again on the next wake-up
+                continue
+            self.superseded.discard(snapshot)
+
+    def snapshot(self, path: str, partition: str):
+        """Copy a settled file aside; None if its content did not change"""
+        signature = _signature(path)
+        digest = file_digest(path)
+        if digest == self.digests.get(partition):
+            return None
+
+        snapshot = os.path.join(self.snapshot_dir, f"{partition}-{digest}.bin")
+        shutil.copyfile(path, snapshot)
+        if _signature(path) != signature or file_digest(snapshot) != digest:
+            # Rewritten while copying: wait for it to settle again
+            self.pending[path] = (_signature(path), time.monotonic(), time.monotonic())
+            return None
+
+        previous = self.snapshots.get(partition)
+        self.digests[partition] = digest
+        self.snapshots[partition] = snapshot
+        # A build can go back to the content of an older snapshot
+        self.superseded.discard(snapshot)
+        if previous and previous != snapshot:
+            self.superseded.add(previous)
+        return snapshot, digest
+
+
+def pending_images(engine) -> set:
+    """Image paths of the engine's queued and running jobs"""
+    return {path for job in engine.jobs() if job.state not in ota_engine.FINISHED_STATES
+            for path in job.images.values()}
+
+
+def main(args) -> int:
+    parser = argparse.ArgumentParser(prog="watch", description="Flash a device whenever the build output changes.")
+    parser.add_argument("host", help="ESP32 IP address or hostname")
+    parser.add_argument("-p", "--port", type=int, help="OTA port (default: the inventory's, else 3232)")
+    parser.add_argument("-a", "--auth", help="OTA password (default: the one stored for the host)")
+    parser.add_argument("-C", "--project", default=".", help="PlatformIO project directory (default: %(default)s)")
+    parser.add_argument("-f", "--firmware", action="append",
+                        help=f"Firmware pattern, may be repeated (default: {DEFAULT_PATTERNS['app'][0]})")
+    parser.add_argument("-s", "--filesystem", action="append",
+                        help=f"Filesystem pattern, may be repeated (default: {DEFAULT_PATTERNS['spiffs'][0]})")
+    parser.add_argument("--no-filesystem", action="store_true", help="Only watch the firmware")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE,
+                        help="Seconds a file must be unchanged before flashing (default: %(default)s)")
+    parser.add_argument("--poll", action="store_true", help="Poll instead of using inotify")
+    parser.add_argument("--now", action="store_true", help="Flash the current build right away")
+    options = parser.parse_args(args)
+
+    patterns = {"app": options.firmware or DEFAULT_PATTERNS["app"]}
+    if not options.no_filesystem:
+        patterns["spiffs"] = options.filesystem or DEFAULT_PATTERNS["spiffs"]
+    patterns = {partition: [os.path.join(options.project, pattern) for pattern in partition_patterns]
+                for partition, partition_patterns in patterns.items()}
+
+    engine = ota_engine.UploadEngine(workers=1)
+    events = engine.subscribe()
+    cancel = CancelToken()
+    jobs = {}   # job id -> time the change was noticed
+
+    def on_change(changes: dict, detected: float):
+        images = {partition: path for partition, (path, digest) in changes.items()}
+        # A newer build supersedes queued or running uploads of the same partitions
+        for job in engine.jobs():
+            if job.state not in ota_engine.FINISHED_STATES and set(job.images) <= set(images):
+                engine.cancel(job.id)
+        for partition, (path, digest) in changes.items():
+            print(f"🔁 {partition} changed (MD5 {digest})")
+        job = engine.submit(options.host, images, password=options.auth, port=options.port)
+        jobs[job.id] = detected
+
+    def report_events():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                return
+            if event["type"] == "log":
+                print(f"[{event['job']}] {event['message']}")
+            elif event["type"] == "state" and event["state"] in ota_engine.FINISHED_STATES:
+                detected = jobs.pop(event["job"], None)
+                if event["state"] == ota_engine.SUCCESS and detected is not None:
+                    print(f"⏱️ Flashed {time.time() - detected:.1f} s after the change")
+
+    watcher = BuildWatcher(patterns, on_change, debounce=options.debounce, use_inotify=not options.poll,
+                           on_tick=report_events, in_use=lambda: pending_images(engine))
+    try:
+        watcher.run(cancel, flash_now=options.now)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cancel.cancel()
+        engine.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+
+import espota
+import ota_engine
+import ota_images
+from ota_cancel import CancelToken
+from ota_fakedevice import FakeDevice
+
+
+CYCLES = 10
+IMAGE_SIZE = 256 * 1024
+# Slow enough that every upload is still transferring when it is cancelled
+LINK_RATE = 64 * 1024
+
+
+def open_fds():
+    """Open file descriptors of this process, None where /proc is not available"""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def settled(measure, expected, timeout: float = 3):
+    """measure() once it returns expected, or its last value after timeout (threads wind down asynchronously)"""
+    deadline = time.time() + timeout
+    value = measure()
+    while value != expected and time.time() < deadline:
+        time.sleep(0.05)
+        value = measure()
+    return value
+
+
+def wait_for_sessions(device, count: int):
+    """Wait until the fake device has closed its side of count sessions"""
+    deadline = time.time() + 5
+    while len(device.uploads) < count and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(device.uploads) == count
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CLEVERCOFFEE_OTA_HOME", str(tmp_path / "data"))
+    return tmp_path
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes([0xE9]) + os.urandom(IMAGE_SIZE - 1))
+    return str(path)
+
+
+@pytest.fixture
+def device():
+    device = FakeDevice(rate=LINK_RATE).start()
+    yield device
+    device.stop()
+
+
+def serve_and_cancel(device, image_path) -> CancelToken:
+    """Start an upload to device, cancel it halfway and return its token once serve() has returned"""
+    sessions = len(device.uploads)
+    cancel = CancelToken()
+    transferring = threading.Event()
+    result = []
+
+    def progress(fraction):
+        if fraction > 0:
+            transferring.set()
+
+    thread = threading.Thread(target=lambda: result.append(
+        espota.serve("127.0.0.1", "127.0.0.1", device.port, 0, "", image_path, cancel=cancel, progress=progress)))
+    thread.start()
+    assert transferring.wait(10), "upload did not start"
+    cancel.cancel()
+    thread.join(5)
+    assert not thread.is_alive(), "serve() did not return after cancel"
+    assert result == [1]
+    wait_for_sessions(device, sessions + 1)
+    return cancel
+
+
+def test_serve_releases_everything_when_cancelled(device, image_path):
+    serve_and_cancel(device, image_path)
+    fds, threads = open_fds(), threading.active_count()
+
+    for _ in range(CYCLES):
+        cancel = serve_and_cancel(device, image_path)
+        assert cancel.open_resources() == 0
+
+    assert settled(threading.active_count, threads) == threads
+    assert settled(open_fds, fds) == fds
+    assert ota_images.registry.stats()["refs"].get(image_path, 0) == 0
+
+
+def test_engine_releases_everything_when_cancelled(data_dir, device, image_path):
+    def cycle():
+        sessions = len(device.uploads)
+        engine = ota_engine.UploadEngine(workers=2, history_path=str(data_dir / "history.sqlite3"), connect_port=0)
+        events = engine.subscribe()
+        job = engine.submit("127.0.0.1", {"app": image_path}, port=device.port)
+        while True:
+            event = events.get(timeout=10)
+            if event["type"] == "progress" and event["percent"] > 0:
+                break
+            assert event.get("state") not in ota_engine.FINISHED_STATES, event
+        assert engine.cancel(job.id)
+        engine.shutdown()
+        assert job.state == ota_engine.CANCELLED
+        assert job.cancel.open_resources() == 0
+        wait_for_sessions(device, sessions + 1)
+
+    cycle()
+    fds, threads = open_fds(), threading.active_count()
+
+    for _ in range(CYCLES):
+        cycle()
+
+    assert settled(threading.active_count, threads) == threads
+    assert settled(open_fds, fds) == fds
@@ -0,0 +1,69 @@
+import os
+import random
+
+import pytest
+
+from ota_delta import DELTA_MAGIC, DeltaPatcher, apply_delta, make_delta
+
+
+def firmware(seed: int = 1, size: int = 128 * 1024) -> bytes:
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+
+def rebuilt(base: bytes) -> bytes:
+    """base with code inserted, a function moved a little and a few constants changed, like a new build"""
+    target = bytearray(base)
+    target[1000:1000] = os.urandom(700)
+    for offset in range(40_000, 60_000, 16):
+        target[offset] = (target[offset] + 4) & 0xFF
+    target[90_000:90_008] = b"v2.0.0\0\0"
+    return bytes(target)
+
+
+def patch_in_chunks(base: bytes, delta: bytes, size: int) -> bytes:
+    patcher = DeltaPatcher(lambda offset, length: base[offset:offset + length])
+    out = bytearray()
+    for start in range(0, len(delta), size):
+        out += patcher.feed(delta[start:start + size])
+    out += patcher.finish()
+    assert patcher.written == len(out)
+    return bytes(out)
+
+
+@pytest.mark.parametrize("base, target", [
+    (firmware(), rebuilt(firmware())),
+    (firmware(), firmware()),
+    (firmware(1), firmware(2)),
+    (b"", firmware()),
+    (firmware(), b""),
+], ids=["rebuilt", "same", "unrelated", "empty base", "empty target"])
+def test_delta_reproduces_the_target(base, target):
+    delta = make_delta(base, target)
+
+    assert delta.startswith(DELTA_MAGIC)
+    assert apply_delta(base, delta) == target
+    for size in (1, 7, 1460, len(delta)):
+        assert patch_in_chunks(base, delta, size) == target
+
+
+def test_delta_of_a_rebuild_is_small():
+    base = firmware()
+    assert len(make_delta(base, rebuilt(base))) < len(base) // 10
+
+
+@pytest.mark.parametrize("damage", [
+    lambda delta: delta[:-10],
+    lambda delta: delta + b"trailing",
+    lambda delta: b"XXXX" + delta[4:],
+    lambda delta: delta[:4] + bytes(len(delta) - 4),
+], ids=["truncated", "trailing data", "magic", "stream"])
+def test_damaged_delta_is_rejected(damage):
+    base = firmware()
+    with pytest.raises(ValueError):
+        apply_delta(base, damage(make_delta(base, rebuilt(base))))
+
+
+def test_delta_against_another_base_is_rejected():
+    base = firmware()
+    with pytest.raises(ValueError):
+        apply_delta(base[:1000], make_delta(base, rebuilt(base)))
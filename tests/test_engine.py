@@ -0,0 +1,161 @@
+import os
+import time
+
+import pytest
+
+import espota
+import ota_engine
+from ota_delta import FirmwareArchive
+from ota_fakedevice import FakeDevice
+from ota_profiles import TransportProfile
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("CLEVERCOFFEE_OTA_HOME", str(tmp_path / "data"))
+    return tmp_path
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes([0xE9]) + os.urandom(64 * 1024 - 1))
+    return str(path)
+
+
+@pytest.fixture
+def engine(data_dir):
+    engine = ota_engine.UploadEngine(workers=2, history_path=str(data_dir / "history.sqlite3"), connect_port=0)
+    yield engine
+    engine.shutdown()
+
+
+def test_batch_with_a_bad_target_queues_nothing(engine, image_path):
+    with pytest.raises(ValueError):
+        engine.submit_batch([{"host": "127.0.0.1", "images": {"app": image_path}},
+                             {"host": "127.0.0.1", "images": {"bogus": image_path}}])
+    assert engine.jobs() == []
+
+
+def firmware_images(tmp_path):
+    """Paths of a base image and a rebuild of it that is worth a delta"""
+    base = bytes([0xE9]) + os.urandom(128 * 1024 - 1)
+    target = bytearray(base)
+    target[5000:5000] = os.urandom(600)
+    target[100_000:100_008] = b"v2.0.0\0\0"
+    paths = tmp_path / "base.bin", tmp_path / "target.bin"
+    paths[0].write_bytes(base)
+    paths[1].write_bytes(bytes(target))
+    return [str(path) for path in paths]
+
+
+def flash(engine, device, path: str) -> ota_engine.UploadJob:
+    job = engine.submit("127.0.0.1", {"app": path}, port=device.port)
+    deadline = time.time() + 30
+    while job.state not in ota_engine.FINISHED_STATES and time.time() < deadline:
+        time.sleep(0.05)
+    assert job.state == ota_engine.SUCCESS, job.error
+    return job
+
+
+def commands(device) -> list:
+    return [(upload["command"], upload["result"]) for upload in device.uploads]
+
+
+@pytest.fixture
+def delta_engine(data_dir):
+    engine = ota_engine.UploadEngine(workers=1, history_path=str(data_dir / "history.sqlite3"), connect_port=0,
+                                     delta=True, archive=FirmwareArchive(data_dir / "archive"))
+    yield engine
+    engine.shutdown()
+
+
+@pytest.fixture
+def fake_device():
+    devices = []
+
+    def start(**options):
+        devices.append(FakeDevice(**options).start())
+        return devices[-1]
+
+    yield start
+    for device in devices:
+        device.stop()
+
+
+def test_firmware_is_sent_as_delta(delta_engine, fake_device, tmp_path):
+    base, target = firmware_images(tmp_path)
+    device = fake_device(deltas=True)
+
+    flash(delta_engine, device, base)
+    job = flash(delta_engine, device, target)
+
+    assert commands(device) == [(espota.FLASH, "ok"), (espota.DELTA, "ok")]
+    with open(target, 'rb') as f:
+        assert device.firmware == f.read()
+    assert job.bytes_total < os.path.getsize(target) // 4
+    assert delta_engine.inventory.get("127.0.0.1").deltas is True
+
+
+def test_refused_delta_falls_back_to_the_image(delta_engine, fake_device, tmp_path):
+    base, target = firmware_images(tmp_path)
+    device = fake_device(deltas=True)
+
+    flash(delta_engine, device, base)
+    device.firmware = os.urandom(1024)      # flashed by something else since
+    flash(delta_engine, device, target)
+
+    assert commands(device) == [(espota.FLASH, "ok"), (espota.DELTA, "other base"), (espota.FLASH, "ok")]
+    with open(target, 'rb') as f:
+        assert device.firmware == f.read()
+    # It answered, so it does take deltas
+    assert delta_engine.inventory.get("127.0.0.1").deltas is True
+
+
+def test_unanswered_delta_falls_back_and_is_not_tried_again(delta_engine, fake_device, tmp_path):
+    base, target = firmware_images(tmp_path)
+    device = fake_device(deltas=False)
+
+    flash(delta_engine, device, base)
+    started = time.time()
+    flash(delta_engine, device, target)
+
+    assert time.time() - started < espota.DELTA_PROBE_TIMEOUT + 5
+    assert commands(device)[0] == (espota.FLASH, "ok")
+    assert set(commands(device)[1:-1]) == {(espota.DELTA, "ignored")}
+    assert commands(device)[-1] == (espota.FLASH, "ok")
+    assert delta_engine.inventory.get("127.0.0.1").deltas is False
+
+    flash(delta_engine, device, base)
+    assert commands(device)[-1] == (espota.FLASH, "ok")
+    assert commands(device)[-2][0] == espota.FLASH
+
+
+def wait_until(condition, timeout: float = 10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_out_of_tune_device_is_tuned_again_when_idle(engine, image_path, fake_device, monkeypatch):
+    device = fake_device()
+    calls = []
+
+    def retune(host, port, password, target=None, store=None, cancel=None, log=print):
+        calls.append((host, port, target, cancel.cancelled))
+        # The first calibration is still running when the next upload is submitted
+        if len(calls) == 1 and cancel.sleep(10):
+            return None
+        store.mark_tuned(host, store.get(host), 1024 * 1024)
+
+    monkeypatch.setattr(ota_engine, "autotune", retune)
+    engine.profiles.set("127.0.0.1", TransportProfile(throughput=1024 * 1024, stale=True))
+
+    flash(engine, device, image_path)
+    assert wait_until(lambda: len(calls) == 1)
+    flash(engine, device, image_path)
+
+    assert wait_until(lambda: len(calls) == 2)
+    assert calls == [("127.0.0.1", device.port, "127.0.0.1", False)] * 2
+    assert wait_until(lambda: not engine.profiles.get("127.0.0.1").stale)
@@ -0,0 +1,75 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import ota_images
+from ota_images import ImageRegistry
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = []
+    for name in ("firmware.bin", "littlefs.bin"):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(256 * 1024))
+        paths.append(str(path))
+    return paths
+
+
+def test_different_images_load_in_parallel(paths, monkeypatch):
+    # Each load only finishes once the other one has started
+    both_loading = threading.Barrier(2, timeout=5)
+
+    class SlowImage(ota_images.Image):
+        def __init__(self, *args):
+            both_loading.wait()
+            super().__init__(*args)
+
+    monkeypatch.setattr(ota_images, "Image", SlowImage)
+    registry = ImageRegistry()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        images = list(executor.map(registry.acquire, paths))
+
+    assert [image.path for image in images] == paths
+    assert registry.stats()["images"] == 2
+
+
+def test_same_image_is_loaded_once(paths, monkeypatch):
+    loads = []
+
+    class CountedImage(ota_images.Image):
+        def __init__(self, *args):
+            loads.append(args[0])
+            super().__init__(*args)
+
+    monkeypatch.setattr(ota_images, "Image", CountedImage)
+    registry = ImageRegistry()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        images = list(executor.map(registry.acquire, [paths[0]] * 8))
+
+    assert loads == [paths[0]]
+    assert all(image is images[0] for image in images)
+    assert images[0].refs == 8
+    for image in images:
+        registry.release(image)
+    assert registry.stats()["images"] == 0
+
+
+def test_failed_load_can_be_retried(paths, monkeypatch):
+    registry = ImageRegistry()
+    original = ota_images.Image
+
+    class FailingImage(original):
+        def __init__(self, *args):
+            raise IOError("changed while it was being read")
+
+    monkeypatch.setattr(ota_images, "Image", FailingImage)
+    with pytest.raises(IOError):
+        registry.acquire(paths[0])
+
+    monkeypatch.setattr(ota_images, "Image", original)
+    image = registry.acquire(paths[0])
+    assert image.refs == 1
+    registry.release(image)
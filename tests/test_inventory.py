@@ -0,0 +1,20 @@
+from ota_inventory import DeviceInventory
+from ota_routes import Route
+
+
+def test_processes_do_not_drop_each_others_updates(tmp_path):
+    path = tmp_path / "inventory.json"
+    gui, daemon = DeviceInventory(path), DeviceInventory(path)
+    gui.add("silvia", "silvia.local")
+    daemon.get("silvia")
+
+    gui.record_upload("silvia", "app", "firmware-md5")
+    daemon.record_route("silvia", Route("wlan0", "192.168.1.5"))
+    daemon.record_deltas("silvia", True)
+    gui.record_upload("silvia", "spiffs", "filesystem-md5")
+
+    for inventory in (gui, daemon, DeviceInventory(path)):
+        device = inventory.get("silvia")
+        assert (device.firmware_digest, device.filesystem_digest) == ("firmware-md5", "filesystem-md5")
+        assert device.route == {"name": "wlan0", "address": "192.168.1.5"}
+        assert device.deltas is True
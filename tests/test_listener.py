@@ -0,0 +1,156 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import ota_listener
+from ota_cancel import CancelToken, Cancelled
+from ota_listener import ConnectBackListener, claim_address
+
+
+@pytest.fixture
+def listener():
+    listener = ConnectBackListener(bind="127.0.0.1", port=0, pool_size=2)
+    yield listener
+    listener.close()
+
+
+def connect(port: int, source: str = "127.0.0.1") -> socket.socket:
+    """Connect to the listener like a device, from source"""
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5, source_address=(source, 0))
+    sock.settimeout(5)
+    return sock
+
+
+def closed_by_listener(sock: socket.socket) -> bool:
+    try:
+        return sock.recv(1) == b""
+    except ConnectionResetError:
+        return True
+
+
+def test_concurrent_sessions_with_one_peer_get_their_own_connection(listener):
+    first, second = listener.claim("127.0.0.1"), listener.claim("127.0.0.1")
+    assert {first.port, second.port} == set(listener.ports)
+
+    devices = [connect(second.port), connect(first.port)]
+    for slot, device, message in ((first, devices[1], b"first"), (second, devices[0], b"second")):
+        connection = slot.wait(5)
+        device.sendall(message)
+        assert connection.recv(16) == message
+        connection.close()
+        slot.release()
+    for device in devices:
+        device.close()
+    assert listener.sessions() == 0
+
+
+def test_connections_are_routed_by_peer(listener):
+    try:
+        other = connect(listener.ports[0], source="127.0.0.2")
+    except OSError:
+        pytest.skip("127.0.0.2 is not a loopback address here")
+    other.close()
+
+    local, remote = listener.claim("127.0.0.1"), listener.claim("127.0.0.2")
+    assert local.port == remote.port
+
+    device = connect(remote.port, source="127.0.0.2")
+    connection = remote.wait(5)
+    assert connection.getpeername()[0] == "127.0.0.2"
+    with pytest.raises(socket.timeout):
+        local.wait(0.3)
+    for sock in (device, connection):
+        sock.close()
+    local.release()
+    remote.release()
+
+
+def test_claim_waits_for_a_free_port(listener):
+    slots = [listener.claim("127.0.0.1"), listener.claim("127.0.0.1")]
+    with pytest.raises(socket.timeout):
+        listener.claim("127.0.0.1", timeout=0.3)
+
+    claimed = []
+    waiting = threading.Thread(target=lambda: claimed.append(listener.claim("127.0.0.1", timeout=5)))
+    waiting.start()
+    time.sleep(0.3)
+    assert not claimed
+    slots[1].release()
+    waiting.join(5)
+
+    assert claimed and claimed[0].port == slots[1].port
+    # Other peers are not held up by the busy ports of this one
+    listener.claim("127.0.0.2", timeout=0).release()
+    for slot in (slots[0], claimed[0]):
+        slot.release()
+
+
+def test_claim_and_wait_can_be_cancelled(listener):
+    cancel = CancelToken()
+    slots = [listener.claim("127.0.0.1"), listener.claim("127.0.0.1")]
+    threading.Timer(0.2, cancel.cancel).start()
+    with pytest.raises(Cancelled):
+        listener.claim("127.0.0.1", timeout=5, cancel=cancel)
+    with pytest.raises(Cancelled):
+        slots[0].wait(5, cancel=cancel)
+    for slot in slots:
+        slot.release()
+
+
+def test_unexpected_connections_are_closed(listener):
+    nobody = connect(listener.ports[0])
+    assert closed_by_listener(nobody)
+    nobody.close()
+
+    slot = listener.claim("127.0.0.1")
+    device = connect(slot.port)
+    connection = slot.wait(5)
+    # A second connection from the same peer is not handed to the session
+    late = connect(slot.port)
+    assert closed_by_listener(late)
+    assert slot.connection is connection
+    for sock in (device, connection, late):
+        sock.close()
+    slot.release()
+
+
+def test_running_listener_keeps_its_ports(listener):
+    with pytest.raises(OSError):
+        ConnectBackListener(bind="127.0.0.1", port=listener.ports[0], pool_size=1)
+
+
+def test_restarted_listener_binds_its_port_again():
+    first = ConnectBackListener(bind="127.0.0.1", port=0, pool_size=1)
+    port = first.ports[0]
+    slot = first.claim("127.0.0.1")
+    device = connect(port)
+    # Closed on the listener's side first, so the port is left in TIME_WAIT
+    slot.wait(5).close()
+    assert closed_by_listener(device)
+    device.close()
+    first.close()
+
+    ConnectBackListener(bind="127.0.0.1", port=port, pool_size=1).close()
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.options = []
+
+    def setsockopt(self, level, option, value):
+        self.options.append((level, option, value))
+
+
+def test_ports_are_claimed_exclusively_where_reusing_them_would_share_them(monkeypatch):
+    # Windows: SO_REUSEADDR would let a second flasher bind the same port
+    monkeypatch.setattr(ota_listener.socket, "SO_EXCLUSIVEADDRUSE", -5, raising=False)
+    sock = RecordingSocket()
+    claim_address(sock)
+    assert sock.options == [(socket.SOL_SOCKET, -5, 1)]
+
+    monkeypatch.delattr(ota_listener.socket, "SO_EXCLUSIVEADDRUSE")
+    sock = RecordingSocket()
+    claim_address(sock)
+    assert sock.options == [(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)]
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+pytest.importorskip("littlefs")
+
+from ota_littlefs import BLOCK_SIZE, build_image, main
+
+
+IMAGE_SIZE = 64 * BLOCK_SIZE
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = tmp_path / "data"
+    (data_dir / "js").mkdir(parents=True)
+    (data_dir / "index.html").write_text("<html>CleverCoffee</html>")
+    (data_dir / "js" / "app.js").write_bytes(os.urandom(20 * 1024))
+    return data_dir
+
+
+def build(data_dir, tmp_path, name: str, **options):
+    return build_image(str(data_dir), str(tmp_path / name), IMAGE_SIZE, cache_dir=tmp_path / "cache",
+                       log=lambda message: None, **options)
+
+
+def test_same_directory_gives_the_same_image(data_dir, tmp_path):
+    first = build(data_dir, tmp_path, "first.bin")
+    # A fresh cache, so the image is encoded again rather than reused
+    second = build_image(str(data_dir), str(tmp_path / "second.bin"), IMAGE_SIZE, cache_dir=tmp_path / "other",
+                         log=lambda message: None)
+
+    assert not first.reused and not second.reused
+    assert first.md5 == second.md5
+    assert (tmp_path / "first.bin").read_bytes() == (tmp_path / "second.bin").read_bytes()
+    assert first.files == 2 and first.size == IMAGE_SIZE
+
+
+def test_unchanged_directory_reuses_the_image(data_dir, tmp_path):
+    first = build(data_dir, tmp_path, "image.bin")
+    again = build(data_dir, tmp_path, "image.bin")
+
+    assert again.reused and again.md5 == first.md5
+
+
+def test_changed_file_gives_another_image(data_dir, tmp_path):
+    first = build(data_dir, tmp_path, "image.bin")
+    (data_dir / "index.html").write_text("<html>CleverCoffee 2</html>")
+    changed = build(data_dir, tmp_path, "image.bin")
+
+    assert not changed.reused and changed.md5 != first.md5
+
+
+def test_data_directory_larger_than_the_partition_is_refused(data_dir, tmp_path):
+    (data_dir / "big.bin").write_bytes(os.urandom(IMAGE_SIZE))
+    with pytest.raises(ValueError, match="more than fits"):
+        build(data_dir, tmp_path, "image.bin")
+
+
+def test_data_directory_filling_the_partition_is_reported(data_dir, tmp_path, capsys, monkeypatch):
+    monkeypatch.setenv("CLEVERCOFFEE_OTA_HOME", str(tmp_path / "home"))
+    # Fits by size, but not with the filesystem's own metadata
+    (data_dir / "big.bin").write_bytes(os.urandom(IMAGE_SIZE - 32 * 1024))
+
+    assert main([str(data_dir), "-o", str(tmp_path / "image.bin"), "--size", str(IMAGE_SIZE)]) == 1
+    assert capsys.readouterr().err.startswith("❌ Cannot add")
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+import urllib.request
+from urllib.error import HTTPError
+
+import pytest
+
+import ota_mirror
+from ota_download import etag_path, partial_path
+
+
+REPO = "rancilio-pid/clevercoffee"
+TAG = "v4.0.0"
+NAME = "firmware.bin"
+CONTENT = os.urandom(300 * 1024)
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+class RecordingHandler(ota_mirror.MirrorHandler):
+    def send_response(self, code, message=None):
+        self.server.requests.append((self.command, self.headers.get("Range"), code))
+        super().send_response(code, message)
+
+
+class Mirror:
+    """A flasher's release cache, shared on a loopback port"""
+
+    def __init__(self, root):
+        self.cache = ota_mirror.ReleaseCache(root)
+        self.server = ota_mirror.MirrorServer(("127.0.0.1", 0), self.cache)
+        self.server.RequestHandlerClass = RecordingHandler
+        self.server.requests = []
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path: str, headers=None):
+        request = urllib.request.Request(self.url + path, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, b""
+
+
+@pytest.fixture
+def mirrors(tmp_path):
+    """A mirror with a verified release and a second flasher, each serving its own cache"""
+    first, second = Mirror(tmp_path / "first"), Mirror(tmp_path / "second")
+    path = first.cache.path(TAG, NAME)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(CONTENT)
+    first.cache.verify(TAG, NAME, DIGEST)
+    yield first, second
+    first.close()
+    second.close()
+
+
+@pytest.fixture
+def published(monkeypatch):
+    monkeypatch.setattr(ota_mirror, "fetch_release_digests", lambda repo, tag: {NAME: DIGEST})
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    def unreachable(repo, tag):
+        raise OSError("api.github.com unreachable")
+
+    monkeypatch.setattr(ota_mirror, "fetch_release_digests", unreachable)
+
+
+def fetch(mirror, second):
+    return ota_mirror.fetch_release_asset(REPO, TAG, NAME, second.cache, [mirror.url], log=lambda message: None)
+
+
+def test_fetches_from_mirror_and_shares_it(mirrors, published):
+    first, second = mirrors
+    path = fetch(first, second)
+
+    assert path.read_bytes() == CONTENT
+    assert second.cache.digest(TAG, NAME) == DIGEST
+    assert second.get(f"/{REPO}/releases/download/{TAG}/{NAME}") == (200, CONTENT)
+
+
+def test_refetch_is_revalidated(mirrors, published):
+    first, second = mirrors
+    fetch(first, second)
+    fetch(first, second)
+
+    assert [code for command, range_header, code in first.server.requests] == [200, 304]
+
+
+def interrupted(second, content: bytes, etag: str = f'"{DIGEST}"'):
+    part = partial_path(second.cache.path(TAG, NAME))
+    part.parent.mkdir(parents=True)
+    part.write_bytes(content)
+    etag_path(part).write_text(etag)
+
+
+def test_interrupted_fetch_resumes(mirrors, published):
+    first, second = mirrors
+    interrupted(second, CONTENT[:100 * 1024])
+
+    assert fetch(first, second).read_bytes() == CONTENT
+    assert first.server.requests == [("GET", f"bytes={100 * 1024}-", 206)]
+
+
+def test_interrupted_fetch_of_another_build_starts_over(mirrors, published):
+    first, second = mirrors
+    interrupted(second, os.urandom(100 * 1024), etag='"an-older-build"')
+
+    assert fetch(first, second).read_bytes() == CONTENT
+    assert first.server.requests == [("GET", f"bytes={100 * 1024}-", 200)]
+
+
+def test_complete_partial_fetch_starts_over(mirrors, published):
+    first, second = mirrors
+    interrupted(second, CONTENT)
+
+    assert fetch(first, second).read_bytes() == CONTENT
+    assert first.server.requests == [("GET", f"bytes={len(CONTENT)}-", 416), ("GET", None, 200)]
+
+
+def test_unpublished_digest_is_not_shared(mirrors, offline):
+    first, second = mirrors
+    path = fetch(first, second)
+
+    assert path.read_bytes() == CONTENT
+    assert second.cache.digest(TAG, NAME) is None
+    assert second.get(f"/{REPO}/releases/download/{TAG}/{NAME}")[0] == 404
+
+
+def test_malformed_if_modified_since_is_ignored(mirrors):
+    first, second = mirrors
+    status, body = first.get(f"/{REPO}/releases/download/{TAG}/{NAME}", {"If-Modified-Since": "yesterday"})
+
+    assert (status, body) == (200, CONTENT)
@@ -0,0 +1,53 @@
+import hashlib
+import os
+
+import pytest
+
+import ota_images
+import ota_preflight
+from ota_preflight import run_preflight
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes([0xE9]) + os.urandom(64 * 1024))
+    return str(path)
+
+
+def quiet(message):
+    pass
+
+
+def test_malformed_host_fails_without_keeping_images(image_path):
+    result = run_preflight("a..b", {"app": image_path}, log=quiet)
+
+    assert not result.ok
+    assert result.problems == ["Cannot resolve hostname: a..b"]
+    result.release()
+    assert ota_images.registry.stats()["refs"].get(image_path, 0) == 0
+
+
+def test_failing_resolver_gives_images_back(image_path):
+    def resolver(host):
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        run_preflight("device", {"app": image_path}, log=quiet, resolver=resolver)
+    assert ota_images.registry.stats()["refs"].get(image_path, 0) == 0
+
+
+@pytest.mark.parametrize("matches", [True, False])
+def test_release_digest_mismatch_fails(image_path, monkeypatch, matches):
+    with open(image_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest() if matches else "0" * 64
+    monkeypatch.setattr(ota_preflight, "fetch_release_digests", lambda repo, tag: {"firmware.bin": digest})
+    monkeypatch.setattr(ota_preflight, "COMMON_PORTS", [])
+
+    result = run_preflight("device", {"app": image_path}, release=("owner/repo", "v1"), log=quiet,
+                           resolver=lambda host: "127.0.0.1")
+    try:
+        assert result.ok == matches
+        assert result.digest_mismatch != matches
+    finally:
+        result.release()
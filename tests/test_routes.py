@@ -0,0 +1,249 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import espota
+import ota_routes
+from ota_fakedevice import FakeDevice
+from ota_routes import InvitationRace, Route, RoutePlan, plan_routes
+
+LAN = Route("eth0", "192.168.1.10", "255.255.255.0")
+WLAN = Route("wlan0", "192.168.1.20", "255.255.255.0")
+DOCKER = Route("docker0", "172.17.0.1", "255.255.0.0")
+LINK_LOCAL = Route("usb0", "169.254.3.4", "255.255.0.0")
+LOOPBACK = Route("lo", "127.0.0.1", "255.0.0.0")
+
+
+@pytest.fixture
+def interfaces(monkeypatch):
+    """Pretends the host has the given routes, with source as the routing table's pick"""
+    def set_interfaces(routes, source=""):
+        monkeypatch.setattr(ota_routes, "local_routes", lambda: list(routes))
+        monkeypatch.setattr(ota_routes, "source_address", lambda target: source)
+    return set_interfaces
+
+
+def names(routes) -> list:
+    return [route.name for route in routes]
+
+
+def test_remembered_route_comes_first(interfaces):
+    interfaces([LOOPBACK, LAN, WLAN], source=LAN.address)
+
+    assert names(plan_routes("192.168.1.50").routes) == ["eth0", "wlan0"]
+    assert names(plan_routes("192.168.1.50", remembered={"name": "wlan0", "address": "192.168.1.99"}).routes) \
+        == ["wlan0", "eth0"]
+
+
+def test_no_fallback_while_an_interface_is_on_the_subnet(interfaces):
+    interfaces([LOOPBACK, DOCKER, LAN], source=LAN.address)
+    plan = plan_routes("192.168.1.50")
+
+    assert names(plan.routes) == ["eth0"]
+    assert plan.fallback == []
+
+
+def test_other_interfaces_are_fallback_without_one_on_the_subnet(interfaces):
+    # Routed through a gateway: the routing table's pick first, the rest only later
+    interfaces([LOOPBACK, DOCKER, LAN], source=LAN.address)
+    plan = plan_routes("10.8.0.5")
+
+    assert names(plan.routes) == ["eth0"]
+    assert names(plan.fallback) == ["docker0"]
+
+    # Without a route to the device, all of them are raced at once
+    interfaces([LOOPBACK, DOCKER, LAN])
+    plan = plan_routes("10.8.0.5")
+
+    assert names(plan.routes) == ["docker0", "eth0"]
+    assert plan.fallback == []
+
+
+def test_source_address_without_an_interface_is_added(interfaces):
+    interfaces([LAN], source="10.0.0.2")
+    plan = plan_routes("10.8.0.5")
+
+    assert [route.address for route in plan.routes] == ["10.0.0.2"]
+    assert names(plan.fallback) == ["eth0"]
+
+
+def test_link_local_interfaces_only_count_for_link_local_devices(interfaces):
+    interfaces([LOOPBACK, LINK_LOCAL, LAN])
+
+    assert names(plan_routes("192.168.1.50").routes) == ["eth0"]
+    assert names(plan_routes("10.8.0.5").routes) == ["eth0"]
+    assert names(plan_routes("169.254.7.7").routes) == ["usb0"]
+
+
+def test_plan_is_limited(interfaces):
+    interfaces([Route(f"eth{n}", f"192.168.1.{n + 10}", "255.255.255.0") for n in range(6)])
+
+    assert names(plan_routes("192.168.1.50", limit=2).routes) == ["eth0", "eth1"]
+
+
+def test_routing_table_decides_for_other_targets(interfaces):
+    interfaces([LOOPBACK, LAN], source=LAN.address)
+
+    assert names(plan_routes("127.0.0.1").routes) == ["lo"]
+    assert plan_routes("esp.local").routes == []
+    assert plan_routes("fe80::1").routes == []
+
+
+class Responder:
+    """Loopback UDP device answering invitations from the addresses in answer"""
+
+    def __init__(self, answer=()):
+        self.answer = set(answer)
+        self.invitations = []
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.udp.settimeout(0.1)
+        self.address = self.udp.getsockname()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                data, peer = self.udp.recvfrom(256)
+            except socket.timeout:
+                continue
+            self.invitations.append(peer[0])
+            if peer[0] in self.answer:
+                self.udp.sendto(b"OK", peer)
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self.udp.close()
+
+
+@pytest.fixture
+def second_loopback():
+    """127.0.0.2, a second local address to race invitations from"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind(("127.0.0.2", 0))
+    except OSError:
+        pytest.skip("127.0.0.2 is not a loopback address here")
+    finally:
+        sock.close()
+    return Route("127.0.0.2", "127.0.0.2", "255.0.0.0")
+
+
+@pytest.fixture
+def responder():
+    responders = []
+
+    def start(answer=()):
+        responders.append(Responder(answer))
+        return responders[-1]
+    yield start
+    for device in responders:
+        device.stop()
+
+
+def test_first_answer_wins(responder, second_loopback):
+    device = responder(answer=[second_loopback.address])
+    race = InvitationRace(device.address, [LOOPBACK, second_loopback], delay=0.1)
+
+    assert race.invite(b"invitation", 5) == "OK"
+    assert race.winner is second_loopback
+    assert race.invited == 2
+    assert race.socket.getsockname()[0] == second_loopback.address
+    race.socket.close()
+
+
+def test_route_answered_within_its_head_start_races_alone(responder, second_loopback):
+    device = responder(answer=[LOOPBACK.address, second_loopback.address])
+    race = InvitationRace(device.address, [LOOPBACK, second_loopback], delay=1)
+
+    assert race.invite(b"invitation", 5) == "OK"
+    assert race.winner is LOOPBACK
+    assert race.invited == 1
+    assert device.invitations == [LOOPBACK.address]
+    race.socket.close()
+
+
+def test_unanswered_race_times_out(responder):
+    device = responder()
+    race = InvitationRace(device.address, [LOOPBACK], delay=0.1)
+
+    with pytest.raises(socket.timeout):
+        race.invite(b"invitation", 0.5)
+    assert device.invitations == [LOOPBACK.address]
+
+
+class RoutedDevice(FakeDevice):
+    """FakeDevice not reached from the addresses in unreachable, and slow to answer the others"""
+
+    def __init__(self, unreachable=(), answer_delay: float = 0, **options):
+        super().__init__(**options)
+        self.unreachable = set(unreachable)
+        self.answer_delay = answer_delay
+
+    def session(self, invitation: str, peer):
+        if peer[0] in self.unreachable:
+            return
+        time.sleep(self.answer_delay)
+        super().session(invitation, peer)
+
+
+@pytest.fixture
+def races(monkeypatch):
+    """Addresses of the routes of each invitation race espota.serve() runs"""
+    races = []
+
+    class RecordedRace(InvitationRace):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            races.append([route.address for route in self.routes])
+
+    monkeypatch.setattr(espota, "InvitationRace", RecordedRace)
+    return races
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes([0xE9]) + os.urandom(32 * 1024 - 1))
+    return str(path)
+
+
+def serve(device, image_path, plan, password="") -> int:
+    return espota.serve("127.0.0.1", "0.0.0.0", device.port, 0, password, image_path, routes=plan,
+                        progress=lambda fraction: None)
+
+
+def test_fallback_joins_after_a_timeout(races, image_path, second_loopback, monkeypatch):
+    monkeypatch.setattr(espota, "TIMEOUT", 0.5)
+    unreachable = Route("127.0.0.3", "127.0.0.3", "255.0.0.0")
+    device = RoutedDevice(unreachable=[unreachable.address]).start()
+    plan = RoutePlan([unreachable], [second_loopback])
+    try:
+        assert serve(device, image_path, plan) == 0
+    finally:
+        device.stop()
+
+    assert races == [[unreachable.address], [unreachable.address, second_loopback.address]]
+    assert plan.winner is second_loopback
+    assert device.uploads[-1]["result"] == "ok"
+
+
+def test_lost_authentication_is_retried_over_the_winner_only(races, image_path, second_loopback, monkeypatch):
+    monkeypatch.setattr(espota, "AUTH_TIMEOUT", 0.5)
+    # Answering after the race delay lets the invitation over the second route reset the challenge
+    device = RoutedDevice(password="secret", answer_delay=ota_routes.RACE_DELAY + 0.2).start()
+    plan = RoutePlan([LOOPBACK, second_loopback])
+    try:
+        assert serve(device, image_path, plan, password="secret") == 0
+    finally:
+        device.stop()
+
+    assert races == [[LOOPBACK.address, second_loopback.address], [LOOPBACK.address]]
+    assert plan.winner is LOOPBACK
+    assert device.uploads[-1]["result"] == "ok"
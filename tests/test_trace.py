@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import espota
+import ota_trace
+from ota_fakedevice import FakeDevice
+from ota_trace import DEFAULT_TOLERANCE, Replay, SessionRecorder, load_trace, phases, replay
+
+IMAGE_SIZE = 128 * 1024
+# Slow enough for the transfer time to dominate the noise of the loopback
+LINK_RATE = 512 * 1024
+# Scheduling noise allowed on top of the relative tolerance, in seconds
+SLACK = 0.1
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes([0xE9]) + os.urandom(IMAGE_SIZE - 1))
+    return str(path)
+
+
+def record(image_path, **device_options) -> SessionRecorder:
+    """Recording of an upload of image_path to a FakeDevice"""
+    device = FakeDevice(password="secret", rate=LINK_RATE, **device_options).start()
+    recorder = SessionRecorder()
+    try:
+        espota.serve("127.0.0.1", "127.0.0.1", device.port, 0, "secret", image_path, trace=recorder,
+                     progress=lambda fraction: None)
+    finally:
+        device.stop()
+    return recorder
+
+
+def test_phases_of_a_recorded_session(image_path):
+    recorded = phases(record(image_path).to_dict())
+
+    assert recorded["end"] == 0
+    assert recorded["invitations"] == 1
+    assert set(recorded) >= {"invitation", "auth", "connect", "transfer", "result"}
+    assert recorded["transfer"] >= IMAGE_SIZE / LINK_RATE * 0.8
+
+
+def test_replay_reproduces_the_session(image_path):
+    result = replay(record(image_path).to_dict(), log=lambda message: None)
+    recorded, replayed = result["recorded"], result["replayed"]
+
+    assert replayed["end"] == recorded["end"] == 0
+    assert abs(replayed["transfer"] - recorded["transfer"]) <= recorded["transfer"] * DEFAULT_TOLERANCE + SLACK
+
+
+def test_replay_reproduces_a_failed_session(image_path):
+    result = replay(record(image_path, corrupt_rate=1).to_dict(), log=lambda message: None)
+
+    assert result["recorded"]["end"] != 0
+    assert result["replayed"]["end"] == result["recorded"]["end"]
+
+
+def test_saved_trace_replays_from_the_command_line(image_path, tmp_path):
+    path = str(tmp_path / "session.json.gz")
+    recorder = record(image_path)
+    recorder.save(path)
+
+    assert load_trace(path)["events"] == recorder.events
+    assert ota_trace.main(["replay", path, "--tolerance", "1"]) == 0
+
+
+def test_replay_ignores_as_many_invitations_as_recorded():
+    trace = {"size": 1000, "events": [
+        [0.0, "invite"], [1.0, "invite"], [1.2, "reply", "OK"], [1.3, "connect"],
+        [1.5, "ack", 500], [2.5, "ack", 1000], [2.6, "result", "OK"], [2.6, "end", 0],
+    ]}
+    device = Replay(trace)
+
+    assert device.ignored_invitations == 1
+    assert device.invitation_delay == pytest.approx(0.2)
+    assert device.connect_delay == pytest.approx(0.1)
+    assert device.abort_at is None
+    # Progress is scaled to the replayed image and interpolated between acks
+    assert device.ack_time(1000, 2000) == pytest.approx(0.2)
+    assert device.ack_time(1500, 2000) == pytest.approx(0.7)
+    assert device.ack_time(2000, 2000) == pytest.approx(1.2)
+
+
+def test_replay_breaks_off_where_the_recording_did():
+    trace = {"size": 1000, "events": [
+        [0.0, "invite"], [0.1, "reply", "OK"], [0.2, "connect"], [0.5, "ack", 250], [10.5, "end", 1],
+    ]}
+
+    assert Replay(trace).abort_at == 0.25
@@ -0,0 +1,39 @@
+import os
+
+from ota_watch import BuildWatcher
+
+
+def test_snapshots_are_kept_while_an_upload_uses_them(tmp_path):
+    build = tmp_path / "firmware.bin"
+    uploading = set()
+    watcher = BuildWatcher({"app": [str(build)]}, on_change=None, use_inotify=False,
+                           snapshot_dir=str(tmp_path / "snapshots"), in_use=lambda: uploading)
+
+    build.write_bytes(b"first build")
+    first, digest = watcher.snapshot(str(build), "app")
+    uploading.add(first)
+    build.write_bytes(b"second build")
+    second, digest = watcher.snapshot(str(build), "app")
+
+    watcher.prune()
+    assert os.path.exists(first) and os.path.exists(second)
+
+    uploading.clear()
+    watcher.prune()
+    assert not os.path.exists(first) and os.path.exists(second)
+
+
+def test_snapshot_of_reverted_build_is_not_deleted(tmp_path):
+    build = tmp_path / "firmware.bin"
+    watcher = BuildWatcher({"app": [str(build)]}, on_change=None, use_inotify=False,
+                           snapshot_dir=str(tmp_path / "snapshots"))
+
+    build.write_bytes(b"first build")
+    first, digest = watcher.snapshot(str(build), "app")
+    build.write_bytes(b"second build")
+    watcher.snapshot(str(build), "app")
+    build.write_bytes(b"first build")
+    reverted, digest = watcher.snapshot(str(build), "app")
+
+    watcher.prune()
+    assert reverted == first and os.path.exists(first)